@@ -15,7 +15,10 @@ logger = getLogger(__name__)
 def schema_adapter(registry, body, schema=None, **kwargs):
     try:
         schema.context['registry'] = registry
-        res = schema.load(loads(body))
+        if isinstance(body, (str, bytes)):
+            body = loads(body)
+
+        res = schema.load(body)
         logger.info(
             "[schema_adapter] Deserialize body=%r with schema=%r: %r",
             body, schema, res)
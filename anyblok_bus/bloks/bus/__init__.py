@@ -22,6 +22,9 @@ class Bus(Blok):
         from . import bus  # noqa
         from . import profile  # noqa
         from . import message  # noqa
+        from . import outbox  # noqa
+        from . import inbox  # noqa
+        from . import checkpoint  # noqa
 
     @classmethod
     def reload_declaration_module(cls, reload):
@@ -31,3 +34,9 @@ class Bus(Blok):
         reload(profile)
         from . import message
         reload(message)
+        from . import outbox
+        reload(outbox)
+        from . import inbox
+        reload(inbox)
+        from . import checkpoint
+        reload(checkpoint)
@@ -8,10 +8,16 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
 from anyblok.config import Configuration
+from anyblok_bus.codec import encode, serialize
+from anyblok_bus.connection import get_blocking_connection
+from anyblok_bus.publisher import publisher_pool
 from .exceptions import PublishException, TwiceQueueConsumptionException
+from concurrent.futures import Future
 from pika.exceptions import ChannelClosed
+from uuid import uuid4
 import logging
 import pika
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -21,47 +27,247 @@ class Bus:
     """ Namespace Bus """
 
     @classmethod
-    def publish(cls, exchange, routing_key, data, contenttype):
+    def use_outbox(cls, outbox=None):
+        """Return True if the messages must be inserted in the outbox"""
+        if outbox is None:
+            return Configuration.get('bus_publish_mode') == 'outbox'
+
+        return outbox
+
+    @classmethod
+    def encode_message(cls, routing_key, data, contenttype, properties=None,
+                       content_encoding=None):
+        """Serialize and compress the data with the codecs of
+        ``anyblok_bus.codec``
+
+        :param routing_key: name of the routing key
+        :param data: python object, str or bytes
+        :param contenttype: the mimestype of the data
+        :param properties: dict of extra ``pika.BasicProperties`` arguments,
+                           if a ``content_encoding`` is given the data are
+                           considered as already compressed
+        :param content_encoding: the compression, by default the
+                                 configuration ``bus_compression``
+        :rtype: tuple (routing_key, body, contenttype, properties)
+        """
+        properties = dict(properties or {})
+        if (
+            'message_id' not in properties and
+            Configuration.get('bus_message_id')
+        ):
+            # the same id is kept by the outbox and the retries
+            properties['message_id'] = uuid4().hex
+
+        # date of publication, the order of the replay of Model.Bus.Message
+        properties.setdefault('timestamp', int(time.time()))
+        if properties.get('content_encoding'):
+            # the data are already compressed
+            return routing_key, serialize(data, contenttype), contenttype, (
+                properties)
+
+        body, content_encoding = encode(data, contenttype, content_encoding)
+        if content_encoding:
+            properties['content_encoding'] = content_encoding
+
+        return routing_key, body, contenttype, properties
+
+    @classmethod
+    def publish(cls, exchange, routing_key, data, contenttype, outbox=None,
+                content_encoding=None):
         """Publish a message in an exchange with a routing key through
         rabbitmq with the profile given by the anyblok configuration
 
+        The connection and the channel are taken from the process
+        publisher pool, they are kept open for the next publications
+
+        In outbox mode the message is only inserted in ``Model.Bus.Outbox``,
+        it is published by the relay once the transaction is committed
+
         :param exchange: name of the exchange
         :param routing_key: name of the routing key
-        :param data: str or unitcode to send through rabbitmq
+        :param data: str or bytes to send through rabbitmq, the other
+                     python objects are serialized by the codec of the
+                     content type
         :param contenttype: the mimestype of the data
+        :param outbox: if True use the outbox, by default the configuration
+                       ``bus_publish_mode`` is used
+        :param content_encoding: the compression of the body (``gzip``,
+                                 ``zstd``), by default the configuration
+                                 ``bus_compression``
         :exception: PublishException
         """
-        profile_name = Configuration.get('bus_profile')
-        channel = _connection = None
+        routing_key, body, contenttype, properties = cls.encode_message(
+            routing_key, data, contenttype, content_encoding=content_encoding)
+        if cls.use_outbox(outbox):
+            cls.registry.Bus.Outbox.push(
+                exchange, [(routing_key, body, contenttype, properties)])
+            logger.info("Message pushed in the outbox %r->%r",
+                        exchange, routing_key)
+            return
+
         try:
-            with cls.registry.begin_nested():  # savepoint
-                profile = cls.registry.Bus.Profile.query().filter_by(
-                    name=profile_name
-                ).one_or_none()
-                parameters = pika.URLParameters(profile.url.url)
-                _connection = pika.BlockingConnection(parameters)
-                channel = _connection.channel()
-                channel.confirm_delivery()
+            with publisher_pool.channel(cls.get_profile_url()) as channel:
                 try:
                     channel.basic_publish(
                         exchange=exchange,
                         routing_key=routing_key,
-                        body=data,
+                        body=body,
                         properties=pika.BasicProperties(
-                            content_type=contenttype, delivery_mode=1)
+                            content_type=contenttype, delivery_mode=1,
+                            **properties)
                     )
                     logger.info("Message published %r->%r",
                                 exchange, routing_key)
                 except pika.exceptions.UnroutableError:
-                    raise PublishException("Message cannot be published")
+                    raise PublishException(
+                        "Message cannot be published")
+        except Exception as e:
+            cls.publish_failed(e)
+            raise
+
+    @classmethod
+    def publish_failed(cls, error):
+        """Log the failure of the publication, the cached url of the profile
+        is forgotten if the broker is not reached with it
+
+        :param error: the exception raised by the publication
+        """
+        logger.error("publishing failed with : %r", error)
+        if not isinstance(error, PublishException):
+            publisher_pool.forget_profile(Configuration.get('bus_profile'))
+
+    @classmethod
+    def get_profile_url(cls):
+        """Return the url of the profile given by the anyblok configuration,
+        the url is cached by the publisher pool of the process until the
+        profile is updated or deleted, the publication fails or
+        ``profile_url_ttl`` seconds passed
+
+        :exception: PublishException if the profile does not exist
+        """
+        profile_name = Configuration.get('bus_profile')
+        url = publisher_pool.get_profile_url(profile_name)
+        if url is not None:
+            return url
+
+        with cls.registry.begin_nested():  # savepoint
+            profile = cls.registry.Bus.Profile.query().filter_by(
+                name=profile_name
+            ).one_or_none()
+
+        if profile is None:
+            raise PublishException(
+                "The bus profile %r does not exist" % profile_name)
+
+        url = profile.url.url
+        publisher_pool.set_profile_url(profile_name, url)
+        return url
+
+    @classmethod
+    def publish_async(cls, exchange, routing_key, data, contenttype,
+                      outbox=None, content_encoding=None):
+        """Publish a message in an exchange with a routing key through
+        rabbitmq without waiting
+
+        The message is put in the queue of the background publisher of the
+        process, the publisher confirms are pipelined
+
+        ::
+
+            future = registry.Bus.publish_async(
+                'exchange', 'routing_key', data, 'application/json')
+            ...
+            future.result()  # raise PublishException if not published
+
+        In outbox mode the message is inserted in ``Model.Bus.Outbox`` and
+        the future is already done
+
+        :param exchange: name of the exchange
+        :param routing_key: name of the routing key
+        :param data: str or bytes to send through rabbitmq, the other
+                     python objects are serialized by the codec of the
+                     content type
+        :param contenttype: the mimestype of the data
+        :param outbox: if True use the outbox, by default the configuration
+                       ``bus_publish_mode`` is used
+        :param content_encoding: the compression of the body, by default the
+                                 configuration ``bus_compression``
+        :rtype: concurrent.futures.Future
+        :exception: PublishException if the profile does not exist or if the
+                    queue of the publisher is full
+        """
+        if cls.use_outbox(outbox):
+            cls.publish(exchange, routing_key, data, contenttype, outbox=True,
+                        content_encoding=content_encoding)
+            future = Future()
+            future.set_result(True)
+            return future
+
+        routing_key, body, contenttype, properties = cls.encode_message(
+            routing_key, data, contenttype, content_encoding=content_encoding)
+
+        publisher = publisher_pool.async_publisher(cls.get_profile_url())
+        if publisher.connection_failed:
+            # read the profile again for the next messages
+            publisher_pool.forget_profile(Configuration.get('bus_profile'))
+
+        return publisher.publish(exchange, routing_key, body, contenttype,
+                                 properties=properties)
+
+    @classmethod
+    def publish_many(cls, exchange, messages, outbox=None):
+        """Publish many messages in an exchange through rabbitmq with the
+        profile given by the anyblok configuration
+
+        All the messages are published on one channel, the publisher confirms
+        are waited once for the whole batch
+
+        ::
+
+            registry.Bus.publish_many('exchange', [
+                ('routing_key', data, 'application/json'),
+                ('routing_key', data, 'application/json',
+                 {'priority': 5}),
+            ])
+
+        :param exchange: name of the exchange
+        :param messages: iterable of ``(routing_key, data, contenttype)`` or
+                         ``(routing_key, data, contenttype, properties)``
+                         where properties is a dict of extra
+                         ``pika.BasicProperties`` arguments, the data are
+                         serialized and compressed as by ``publish``
+        :param outbox: if True use the outbox, by default the configuration
+                       ``bus_publish_mode`` is used
+        :rtype: the number of published messages
+        :exception: PublishException, with the ``unroutable`` and ``nacked``
+                    messages, as given by the caller
+        """
+        if cls.use_outbox(outbox):
+            count = cls.registry.Bus.Outbox.push(
+                exchange, (cls.encode_message(*message)
+                           for message in messages))
+            logger.info("%d messages pushed in the outbox for %r",
+                        count, exchange)
+            return count
+
+        try:
+            url = cls.get_profile_url()
+            with publisher_pool.batch_channel(url) as channel:
+                count, unroutable, nacked = channel.publish(
+                    exchange, messages,
+                    encode=lambda message: cls.encode_message(*message))
+
+            logger.info("%d messages published on %r", count, exchange)
+            if unroutable or nacked:
+                raise PublishException(
+                    "%d messages cannot be published" % (
+                        len(unroutable) + len(nacked)),
+                    unroutable=unroutable, nacked=nacked)
+
+            return count
         except Exception as e:
-            logger.error("publishing failed with : %r", e)
+            cls.publish_failed(e)
             raise
-        finally:
-            if channel and not channel.is_closed:
-                channel.close()
-            if _connection and not _connection.is_closed:
-                _connection.close()
 
     @classmethod
     def get_consumers(cls):
@@ -96,8 +302,7 @@ class Bus:
         profile = cls.registry.Bus.Profile.query().filter_by(
             name=profile_name
         ).one_or_none()
-        parameters = pika.URLParameters(profile.url.url)
-        connection = pika.BlockingConnection(parameters)
+        connection = get_blocking_connection(profile.url.url)
         unexisting_queues = []
         for processes, definitions in cls.get_consumers():
             for queue, Model, consumer in definitions:
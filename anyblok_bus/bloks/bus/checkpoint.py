@@ -0,0 +1,44 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok import Declarations
+from anyblok.column import Integer, String, DateTime, Json
+from datetime import datetime
+
+
+@Declarations.register(Declarations.Model.Bus.Message)
+class Checkpoint:
+    """Position of a replay of ``Model.Bus.Message``, saved in the
+    transaction of each chunk of consumed messages
+    """
+    name = String(primary_key=True)
+    position = Json()
+    consumed = Integer(default=0, nullable=False)
+    errors = Integer(default=0, nullable=False)
+    create_date = DateTime(nullable=False, default=datetime.now)
+    edit_date = DateTime(nullable=False, default=datetime.now,
+                         auto_update=True)
+
+    @classmethod
+    def get_position(cls, name):
+        """Return the values of the replay key of the last replayed
+        message, None if the replay is not started"""
+        checkpoint = cls.query().filter_by(name=name).one_or_none()
+        return checkpoint.position if checkpoint else None
+
+    @classmethod
+    def save(cls, name, position, consumed=0, errors=0):
+        """Save the position of the replay and add the counters of the
+        chunk"""
+        checkpoint = cls.query().filter_by(name=name).one_or_none()
+        if checkpoint is None:
+            cls.insert(name=name, position=position, consumed=consumed,
+                       errors=errors)
+        else:
+            checkpoint.position = position
+            checkpoint.consumed += consumed
+            checkpoint.errors += errors
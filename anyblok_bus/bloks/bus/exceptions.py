@@ -8,7 +8,16 @@
 
 
 class PublishException(Exception):
-    """Exception Error for Publish a message through rabbitmq"""
+    """Exception Error for Publish a message through rabbitmq
+
+    :param unroutable: list of ``(index, message)`` returned by rabbitmq
+    :param nacked: list of ``(index, message)`` refused by rabbitmq
+    """
+
+    def __init__(self, *args, unroutable=None, nacked=None):
+        super(PublishException, self).__init__(*args)
+        self.unroutable = unroutable or []
+        self.nacked = nacked or []
 
 
 class TwiceQueueConsumptionException(Exception):
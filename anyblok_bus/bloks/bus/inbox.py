@@ -0,0 +1,47 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok import Declarations
+from anyblok.column import String, DateTime
+from datetime import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@Declarations.register(Declarations.Model.Bus)
+class Inbox:
+    """Ids of the messages consumed by the idempotent consumers, inserted in
+    the same transaction as the consumer, a message delivered again is not
+    consumed twice
+    """
+    queue = String(primary_key=True)
+    message_id = String(primary_key=True)
+    create_date = DateTime(nullable=False, default=datetime.now, index=True)
+
+    @classmethod
+    def record(cls, queue, message_id):
+        """Insert the id of the consumed message
+
+        :exception: sqlalchemy.exc.IntegrityError if the message was already
+                    consumed, the transaction must be rolled back
+        """
+        cls.registry.execute(cls.__table__.insert(), [
+            dict(queue=queue, message_id=message_id,
+                 create_date=datetime.now())])
+
+    @classmethod
+    def purge(cls, before):
+        """Delete the ids of the messages consumed before the date, they
+        must not be delivered again
+
+        :rtype: the number of deleted ids
+        """
+        count = cls.query().filter(cls.create_date < before).delete(
+            synchronize_session=False)
+        logger.info('%d message ids purged from the inbox', count)
+        return count
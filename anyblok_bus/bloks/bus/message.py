@@ -9,35 +9,105 @@
 from anyblok import Declarations
 from anyblok.column import Integer, String, LargeBinary, Text, DateTime
 from anyblok_bus.status import MessageStatus
-from datetime import datetime
+from .exceptions import PublishException
+from asyncio import iscoroutine, new_event_loop
+from datetime import datetime, timedelta
+from sqlalchemy import Index, func, select, tuple_
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 
 @Declarations.register(Declarations.Model.Bus)
 class Message:
+    """Messages in error of the consumers
+
+    The messages are replayed in the order of ``sequence`` (100 by default),
+    ``publish_date`` (the timestamp of the message, else its date of
+    reception) and ``id`` (the sequence of the database), the composite
+    indexes follow this order.
+    """
     id = Integer(primary_key=True)
-    create_date = DateTime(nullable=False, default=datetime.now)
+    create_date = DateTime(nullable=False, default=datetime.now, index=True)
     edit_date = DateTime(nullable=False, default=datetime.now,
                          auto_update=True)
     content_type = String(default='application/json', nullable=False)
+    content_encoding = String()
     message = LargeBinary(nullable=False)
     sequence = Integer(default=100, nullable=False)
     error = Text()
     queue = String(nullable=False)
     model = String(nullable=False)
     method = String(nullable=False)
+    publish_date = DateTime(nullable=False, default=datetime.now)
+
+    @classmethod
+    def define_table_args(cls):
+        table_args = super(Message, cls).define_table_args()
+        return table_args + (
+            Index('ix_bus_message_replay', cls.sequence, cls.publish_date,
+                  cls.id),
+            Index('ix_bus_message_queue', cls.queue, cls.sequence,
+                  cls.publish_date, cls.id),
+            Index('ix_bus_message_model', cls.model, cls.method,
+                  cls.sequence, cls.publish_date, cls.id),
+        )
+
+    @classmethod
+    def get_entry(cls, queue, model, method, message, content_type=None,
+                  content_encoding=None, error=None, sequence=100,
+                  publish_date=None):
+        """Return the values of one message to insert, without content type
+        the message gets the default content type of the column, without
+        publish date the message is considered as published now"""
+        now = datetime.now()
+        return dict(create_date=now, edit_date=now, queue=queue, model=model,
+                    method=method, message=message,
+                    content_type=content_type or 'application/json',
+                    content_encoding=content_encoding, error=error,
+                    sequence=sequence, publish_date=publish_date or now)
+
+    @classmethod
+    def insert_many(cls, entries):
+        """Insert the messages with one multi-rows insert
+
+        :param entries: list of the values given by ``get_entry``
+        :rtype: the number of inserted messages
+        """
+        if entries:
+            cls.registry.execute(cls.__table__.insert(), entries)
+
+        return len(entries)
 
     def consume(self):
-        """Try to consume on message to import it in database"""
+        """Try to consume on message to import it in database
+
+        :rtype: the status of the consumer, ``MessageStatus.ERROR`` if the
+                message is kept in error
+        """
         logger.info('consume %r', self)
         error = ""
         try:
             Model = self.registry.get(self.model)
             savepoint = self.registry.begin_nested()
-            status = getattr(Model, self.method)(
-                body=self.message.decode('utf-8'))
+            consumer = getattr(Model, self.method)
+            body = consumer.consumer.decode(
+                self.message, self.content_type, self.content_encoding)
+            if consumer.consumer.batch_size:
+                status = consumer(body=[body])
+                if isinstance(status, (list, tuple)):
+                    status = status[0]
+            else:
+                status = consumer(body=body)
+
+            if iscoroutine(status):
+                loop = new_event_loop()
+                try:
+                    status = loop.run_until_complete(status)
+                finally:
+                    loop.close()
+
             savepoint.commit()
         except Exception as e:
             savepoint.rollback()
@@ -49,15 +119,325 @@ class Message:
         if status is MessageStatus.ERROR or status is None:
             logger.info('%s Finished with an error %r', self, error)
             self.error = error
-        else:
-            self.delete()
+            return MessageStatus.ERROR
+
+        self.delete()
+        return status
+
+    @classmethod
+    def get_replay_key(cls):
+        """Columns of the order of the replay, the last one is unique"""
+        return cls.sequence, cls.publish_date, cls.id
+
+    @classmethod
+    def get_replay_position(cls, message):
+        """Return the values of the replay key of the message, they are
+        saved in json by the checkpoints"""
+        return [message.sequence, message.publish_date.isoformat(),
+                message.id]
+
+    @classmethod
+    def get_replay_clause(cls, position):
+        """Return the where clause of the messages after the position"""
+        sequence, publish_date, id_ = position
+        return tuple_(*cls.get_replay_key()) > tuple_(
+            sequence, datetime.fromisoformat(publish_date), id_)
 
     @classmethod
-    def consume_all(cls):
-        """Try to consume all the message, ordered by the sequence"""
-        query = cls.query().order_by(cls.sequence)
-        for consumer in query.all():
+    def get_filter_clauses(cls, queue=None, model=None, method=None,
+                           after=None, before=None):
+        """Return the where clauses on the columns of the table
+
+        :param queue: only the messages of the queue
+        :param model: only the messages of the model
+        :param method: only the messages of the method
+        :param after: only the messages created since this date
+        :param before: only the messages created before this date
+        """
+        columns = cls.__table__.c
+        clauses = []
+        if queue is not None:
+            clauses.append(columns.queue == queue)
+        if model is not None:
+            clauses.append(columns.model == model)
+        if method is not None:
+            clauses.append(columns.method == method)
+        if after is not None:
+            clauses.append(columns.create_date >= after)
+        if before is not None:
+            clauses.append(columns.create_date < before)
+
+        return clauses
+
+    @classmethod
+    def get_replay_query(cls, *elements, **filters):
+        """Query of the messages to replay
+
+        :param elements: entities of the query, the model by default
+        :param filters: queue, model, method, after and before, see
+                        ``get_filter_clauses``
+        """
+        return cls.query(*elements).filter(*cls.get_filter_clauses(**filters))
+
+    @classmethod
+    def get_replay_partitions(cls, key='queue', **filters):
+        """Return the partitions of the messages to replay, the messages of
+        one partition have the same value of the column ``key``
+
+        :param key: queue, model or method
+        :param filters: see ``get_filter_clauses``
+        :rtype: list of ``(value, number of messages)``, the biggest
+                partitions first
+        """
+        column = getattr(cls, key)
+        count = func.count(cls.id)
+        query = cls.get_replay_query(column, count, **filters)
+        return [tuple(row)
+                for row in query.group_by(column).order_by(
+                    count.desc(), column).all()]
+
+    @classmethod
+    def iter_replay(cls, query, batch_size=1000, position=None):
+        """Yield the messages of the query by chunks, in the order of the
+        replay key
+
+        The chunks are read by keyset pagination, each query starts after
+        the last message of the previous chunk, only one chunk is loaded at
+        a time whatever the number of stored messages.
+
+        :param query: query given by ``get_replay_query``
+        :param batch_size: maximum number of messages by chunk
+        :param position: position of the last replayed message given by
+                         ``get_replay_position``, None to start from the
+                         first message
+        :rtype: iterator of ``(position, messages)``, the position is the
+                one of the last message of the chunk
+        """
+        key = cls.get_replay_key()
+        while True:
+            chunk = query
+            if position is not None:
+                chunk = chunk.filter(cls.get_replay_clause(position))
+
+            messages = chunk.order_by(*key).limit(batch_size).all()
+            if not messages:
+                return
+
+            position = cls.get_replay_position(messages[-1])
+            yield position, messages
+
+    @classmethod
+    def consume_all(cls, batch_size=1000, checkpoint=None, commit=True,
+                    **filters):
+        """Try to consume all the message, in the order of the replay key
+
+        The messages are read and consumed by chunks of ``batch_size``, each
+        chunk is committed, a long replay is not one long transaction. With
+        a ``checkpoint`` the position of the replay is saved in
+        ``Model.Bus.Message.Checkpoint`` and committed with each chunk, a
+        replay stopped by a crash is resumed by the next call with the same
+        checkpoint, after the last committed chunk. The checkpoint is
+        deleted once all the messages are replayed.
+
+        :param batch_size: number of messages by chunk
+        :param checkpoint: name of the checkpoint of the replay
+        :param commit: commit after each chunk, False to only flush them in
+                       the transaction of the caller, always True with a
+                       checkpoint
+        :param filters: queue, model, method, after and before, see
+                        ``get_filter_clauses``
+        :rtype: the number of consumed messages and of messages in error
+        """
+        Checkpoint = cls.registry.Bus.Message.Checkpoint
+        position = None
+        if checkpoint is not None:
+            position = Checkpoint.get_position(checkpoint)
+            commit = True
+
+        consumed = errors = 0
+        start = time.monotonic()
+        query = cls.get_replay_query(**filters)
+        for position, messages in cls.iter_replay(query, batch_size,
+                                                  position):
+            chunk_errors = 0
+            for message in messages:
+                try:
+                    status = message.consume()
+                except Exception:
+                    logger.exception('Error while trying to consume message '
+                                     '%r', message.id)
+                    status = MessageStatus.ERROR
+
+                chunk_errors += status is MessageStatus.ERROR
+
+            consumed += len(messages) - chunk_errors
+            errors += chunk_errors
+            if checkpoint is not None:
+                Checkpoint.save(checkpoint, position,
+                                len(messages) - chunk_errors, chunk_errors)
+
+            if commit:
+                cls.registry.commit()
+            else:
+                cls.registry.flush()
+
+            logger.info('%d messages replayed (%d in error), %.1f msg/s',
+                        consumed + errors, errors,
+                        (consumed + errors) / (time.monotonic() - start))
+
+        if checkpoint is not None:
+            Checkpoint.query().filter_by(name=checkpoint).delete(
+                synchronize_session=False)
+            cls.registry.commit()
+
+        return consumed, errors
+
+    @classmethod
+    def get_republish_properties(cls, message):
+        """Return the properties of the message published again, the body
+        is kept as it is stored"""
+        properties = {'timestamp': int(message.publish_date.timestamp())}
+        if message.content_encoding:
+            properties['content_encoding'] = message.content_encoding
+
+        return properties
+
+    @classmethod
+    def republish(cls, batch_size=1000, **filters):
+        """Publish the messages again in their queue, by the default
+        exchange, to be consumed by the workers
+
+        The messages are read by chunks of ``batch_size`` as by
+        ``consume_all``, each chunk is published by ``Bus.publish_many`` on
+        one channel in confirm mode. The confirmed messages are deleted by
+        one query and the chunk is committed. The unroutable messages (the
+        queue does not exist) are kept with an error, the nacked ones are
+        kept to be published again by the next call.
+
+        :param batch_size: number of messages by chunk
+        :param filters: queue, model, method, after and before, see
+                        ``get_filter_clauses``
+        :rtype: the number of published messages
+        """
+        published = 0
+        start = time.monotonic()
+        query = cls.get_replay_query(**filters)
+        for position, messages in cls.iter_replay(query, batch_size):
+            failed = set()
             try:
-                consumer.consume()
-            except Exception:
-                pass
+                cls.registry.Bus.publish_many('', [
+                    (message.queue, message.message, message.content_type,
+                     cls.get_republish_properties(message))
+                    for message in messages], outbox=False)
+            except PublishException as e:
+                failed = {index for index, message in e.unroutable + e.nacked}
+                for index, message in e.unroutable:
+                    messages[index].error = "Unroutable message"
+
+            ids = [message.id for index, message in enumerate(messages)
+                   if index not in failed]
+            if ids:
+                cls.query().filter(cls.id.in_(ids)).delete(
+                    synchronize_session=False)
+
+            cls.registry.commit()
+            published += len(ids)
+            logger.info('%d messages republished, %.1f msg/s', published,
+                        published / (time.monotonic() - start))
+
+        return published
+
+    @classmethod
+    def delete_many(cls, batch_size=1000, commit=True, **filters):
+        """Delete the messages by batches of ``batch_size``, without loading
+        them, each batch is deleted by one query and committed
+
+        :param batch_size: maximum number of messages deleted by query
+        :param commit: commit after each batch, the table is not locked
+                       during the whole deletion
+        :param filters: queue, model, method, after and before, see
+                        ``get_filter_clauses``
+        :rtype: the number of deleted messages
+        """
+        table = cls.__table__
+        # the derived table allows the LIMIT of the subquery with MySQL
+        ids = select(table.c.id).where(
+            *cls.get_filter_clauses(**filters)).limit(batch_size).subquery()
+        query = table.delete().where(table.c.id.in_(select(ids.c.id)))
+        count = 0
+        while True:
+            deleted = cls.registry.execute(query).rowcount
+            count += deleted
+            if commit:
+                cls.registry.commit()
+
+            if deleted < batch_size:
+                break
+
+        logger.info('%d messages deleted', count)
+        return count
+
+    @classmethod
+    def purge(cls, days, batch_size=1000, commit=True, **filters):
+        """Delete the messages created more than ``days`` days ago, see
+        ``delete_many``
+
+        :rtype: the number of deleted messages
+        """
+        return cls.delete_many(
+            batch_size=batch_size, commit=commit,
+            before=datetime.now() - timedelta(days=days), **filters)
+
+    @classmethod
+    def reassign(cls, values, batch_size=1000, commit=True, **filters):
+        """Change the queue, the model or the method of the messages, after
+        the rename of a consumer
+
+        ::
+
+            registry.Bus.Message.reassign(
+                {'model': 'Model.New', 'method': 'consume'},
+                model='Model.Old')
+
+        The messages are updated by batches of ``batch_size`` ids, read by
+        keyset pagination on the id, one update by batch, without loading
+        the messages.
+
+        :param values: dict of the new queue, model and method
+        :param batch_size: maximum number of messages updated by query
+        :param commit: commit after each batch
+        :param filters: queue, model, method, after and before, see
+                        ``get_filter_clauses``
+        :rtype: the number of updated messages
+        :exception: ValueError if another column is given
+        """
+        unknown = set(values) - {'queue', 'model', 'method'}
+        if unknown:
+            raise ValueError("Only the queue, the model and the method can "
+                             "be reassigned, not %r" % sorted(unknown))
+
+        table = cls.__table__
+        query = select(table.c.id).where(
+            *cls.get_filter_clauses(**filters)).order_by(
+                table.c.id).limit(batch_size)
+        count = 0
+        chunk = query
+        while True:
+            ids = cls.registry.execute(chunk).scalars().all()
+            if not ids:
+                break
+
+            count += cls.registry.execute(
+                table.update().where(table.c.id.in_(ids)).values(
+                    edit_date=datetime.now(), **values)).rowcount
+            if commit:
+                cls.registry.commit()
+
+            if len(ids) < batch_size:
+                break
+
+            # the next batch starts after the last id of this one
+            chunk = query.where(table.c.id > ids[-1])
+
+        logger.info('%d messages reassigned to %r', count, values)
+        return count
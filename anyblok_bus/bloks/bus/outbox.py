@@ -0,0 +1,103 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok import Declarations
+from anyblok.column import (
+    Integer, String, LargeBinary, Text, DateTime, Json)
+from .exceptions import PublishException
+from datetime import datetime
+from itertools import groupby
+from operator import attrgetter
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@Declarations.register(Declarations.Model.Bus)
+class Outbox:
+    """Messages to publish, they are inserted in the same transaction as the
+    data and published by the relay only once the transaction is committed
+    """
+    id = Integer(primary_key=True)
+    create_date = DateTime(nullable=False, default=datetime.now)
+    exchange = String(default='', nullable=False)
+    routing_key = String(nullable=False)
+    content_type = String(default='application/json', nullable=False)
+    message = LargeBinary(nullable=False)
+    properties = Json()
+    error = Text()
+
+    @classmethod
+    def get_entry(cls, exchange, routing_key, data, contenttype,
+                  properties=None):
+        """Return the values of one entry of the outbox"""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        return dict(exchange=exchange, routing_key=routing_key,
+                    content_type=contenttype, message=data,
+                    properties=properties, create_date=datetime.now())
+
+    @classmethod
+    def push(cls, exchange, messages):
+        """Insert the messages in the outbox with one multi-rows insert
+
+        :param exchange: name of the exchange
+        :param messages: iterable of ``(routing_key, data, contenttype)`` or
+                         ``(routing_key, data, contenttype, properties)``
+        :rtype: the number of inserted messages
+        """
+        entries = [cls.get_entry(exchange, *message)
+                   for message in messages]
+        if entries:
+            cls.registry.execute(cls.__table__.insert(), entries)
+
+        return len(entries)
+
+    @classmethod
+    def relay(cls, batch_size=1000):
+        """Publish the oldest messages of the outbox and delete them once
+        rabbitmq confirmed them
+
+        The entries are locked (``SKIP LOCKED``) so many relays can run at
+        the same time, but only one relay keeps the order of the messages.
+        The unroutable messages are kept with an error, the nacked ones are
+        kept to be published again by the next call.
+
+        :param batch_size: maximum number of messages published
+        :rtype: the number of published messages
+        """
+        entries = cls.query().filter(cls.error.is_(None)).order_by(
+            cls.id).limit(batch_size).with_for_update(skip_locked=True).all()
+        published = []
+        for exchange, group in groupby(entries, key=attrgetter('exchange')):
+            group = list(group)
+            failed = set()
+            try:
+                cls.registry.Bus.publish_many(
+                    exchange,
+                    [(entry.routing_key, entry.message, entry.content_type,
+                      entry.properties or {})
+                     for entry in group],
+                    outbox=False)
+            except PublishException as e:
+                failed = {index for index, message in e.unroutable + e.nacked}
+                logger.warning('%d messages of the outbox cannot be '
+                               'published on %r', len(failed), exchange)
+                for index, message in e.unroutable:
+                    group[index].error = "Unroutable message"
+
+            published.extend(
+                entry.id for index, entry in enumerate(group)
+                if index not in failed)
+
+        if published:
+            cls.query().filter(cls.id.in_(published)).delete(
+                synchronize_session=False)
+
+        logger.debug('%d messages relayed from the outbox', len(published))
+        return len(published)
@@ -8,6 +8,8 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
 from anyblok.column import String, Selection, URL
+from anyblok_bus.publisher import publisher_pool
+from sqlalchemy import inspect
 import logging
 
 logger = logging.getLogger(__name__)
@@ -25,3 +27,21 @@ class Profile:
         },
         default='disconnected', nullable=False
     )
+
+    @classmethod
+    def forget_cached_url(cls, target):
+        # the old name too if the profile is renamed
+        for name in inspect(target).attrs.name.history.sum():
+            publisher_pool.forget_profile(name)
+
+    @classmethod
+    def after_insert_orm_event(cls, mapper, connection, target):
+        cls.forget_cached_url(target)
+
+    @classmethod
+    def after_update_orm_event(cls, mapper, connection, target):
+        cls.forget_cached_url(target)
+
+    @classmethod
+    def after_delete_orm_event(cls, mapper, connection, target):
+        cls.forget_cached_url(target)
@@ -0,0 +1,91 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from collections import deque
+
+
+class CircuitBreaker:
+    """Open the circuit of a consumer when its messages fail too much
+
+    ::
+
+        breaker = CircuitBreaker(errors=10, error_rate=0.5, window=100)
+        ...
+        state = breaker.record(error=True)
+        if state == CircuitBreaker.OPEN:
+            # stop to consume, call breaker.half_open() after the cooldown
+            # and consume one message to probe the consumer
+
+    * **closed**: the messages are consumed, the circuit opens after
+      ``errors`` consecutive errors, or when ``error_rate`` of the last
+      ``window`` messages are in error
+    * **open**: the messages are not consumed during ``cooldown`` seconds
+    * **half-open**: one message is consumed, the circuit is closed if it is
+      consumed without error, else opened again
+
+    :param errors: number of consecutive errors, 0 to not check them
+    :param error_rate: ratio of the messages in error, 0 to not check it
+    :param window: number of the last messages checked by the error rate
+    :param cooldown: seconds before the probe of an open circuit
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, errors=10, error_rate=0, window=100, cooldown=30):
+        self.errors = errors
+        self.error_rate = error_rate
+        self.window = max(window, 1)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.reset()
+
+    def reset(self):
+        self._consecutive = 0
+        self._results = deque(maxlen=self.window)
+        self._error_count = 0
+
+    def record(self, error):
+        """Record the result of a consumed message
+
+        :param error: True if the message is in error
+        :rtype: the new state, None if it does not change
+        """
+        if self.state == self.OPEN:
+            # message consumed before the opening
+            return None
+
+        if self.state == self.HALF_OPEN:
+            return self.set_state(self.OPEN if error else self.CLOSED)
+
+        if len(self._results) == self.window:
+            self._error_count -= self._results[0]
+
+        self._results.append(error)
+        self._error_count += error
+        self._consecutive = self._consecutive + 1 if error else 0
+        if self.errors and self._consecutive >= self.errors:
+            return self.set_state(self.OPEN)
+
+        if (
+            self.error_rate and len(self._results) == self.window and
+            self._error_count >= self.error_rate * self.window
+        ):
+            return self.set_state(self.OPEN)
+
+        return None
+
+    def half_open(self):
+        """Called after the cooldown, the next result closes or opens the
+        circuit"""
+        self.set_state(self.HALF_OPEN)
+
+    def set_state(self, state):
+        self.state = state
+        self.reset()
+        return state
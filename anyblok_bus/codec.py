@@ -0,0 +1,176 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import gzip
+from json import dumps, loads
+from anyblok.config import Configuration
+from logging import getLogger
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = getLogger(__name__)
+
+serializers = {}
+compressors = {}
+unknown_encodings = set()
+
+
+class CodecException(Exception):
+    """Exception for an unknown content type or content encoding"""
+
+
+def register_serializer(content_type, serialize, deserialize):
+    """Register the functions to serialize the python objects to bytes, and
+    to deserialize them, for a content type
+
+    :param content_type: the mimestype of the message
+    :param serialize: function(data) -> bytes
+    :param deserialize: function(bytes) -> data
+    """
+    serializers[content_type] = (serialize, deserialize)
+
+
+def register_compressor(content_encoding, compress, decompress):
+    """Register the functions to compress and decompress the body of the
+    messages, for a content encoding
+
+    :param content_encoding: the content encoding of the message
+    :param compress: function(bytes) -> bytes
+    :param decompress: function(bytes) -> bytes
+    """
+    compressors[content_encoding] = (compress, decompress)
+
+
+def get_serializer(content_type):
+    content_type = (content_type or '').split(';')[0].strip()
+    if content_type not in serializers:
+        raise CodecException("No serializer for %r" % content_type)
+
+    return serializers[content_type]
+
+
+def get_compressor(content_encoding):
+    if content_encoding not in compressors:
+        raise CodecException("No compressor for %r" % content_encoding)
+
+    return compressors[content_encoding]
+
+
+def serialize(data, content_type):
+    """Return the body of the message, str and bytes are considered as
+    already serialized"""
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+
+    return get_serializer(content_type)[0](data)
+
+
+def deserialize(body, content_type):
+    return get_serializer(content_type)[1](body)
+
+
+def compress(body, content_encoding):
+    if not content_encoding:
+        return body
+
+    return get_compressor(content_encoding)[0](body)
+
+
+def decompress(body, content_encoding):
+    """Return the decompressed body, the body is kept as it is if the
+    content encoding is not a registered compressor: other clients (Spring
+    AMQP, kombu) set a charset (``utf-8``) or ``binary`` in this header"""
+    if not content_encoding:
+        return body
+
+    if content_encoding not in compressors:
+        if content_encoding not in unknown_encodings:
+            unknown_encodings.add(content_encoding)
+            logger.warning("No compressor for the content encoding %r, the "
+                           "messages are not decompressed", content_encoding)
+
+        return body
+
+    return compressors[content_encoding][1](body)
+
+
+def encode(data, content_type, content_encoding=None):
+    """Serialize and compress the data
+
+    If no content encoding is given, the body is compressed with the
+    compressor of the configuration ``bus_compression`` when its size is
+    upper or equal to ``bus_compression_threshold``
+
+    :param data: python object, str or bytes
+    :param content_type: the mimestype of the message
+    :param content_encoding: the content encoding of the message
+    :rtype: tuple (body, content_encoding)
+    """
+    body = serialize(data, content_type)
+    if content_encoding is None:
+        content_encoding = Configuration.get('bus_compression')
+        threshold = Configuration.get('bus_compression_threshold', 1024)
+        if not content_encoding or len(body) < (threshold or 0):
+            return body, None
+
+    return compress(body, content_encoding), content_encoding
+
+
+def decode(body, content_type, content_encoding=None, deserialized=False,
+           raw=False):
+    """Decompress and decode the body of a message
+
+    :param body: bytes of the message
+    :param content_type: the mimestype of the message
+    :param content_encoding: the content encoding of the message
+    :param deserialized: if True return the python object given by the
+                         serializer of the content type, else the text
+    :param raw: if True return the decompressed body, without copy if the
+                body is not compressed
+    """
+    body = decompress(body, content_encoding)
+    if raw:
+        return body
+
+    if deserialized:
+        return deserialize(body, content_type)
+
+    return body.decode('utf-8')
+
+
+register_serializer('application/json',
+                    lambda data: dumps(data).encode('utf-8'),
+                    lambda body: loads(body.decode('utf-8')))
+register_serializer('text/plain',
+                    lambda data: str(data).encode('utf-8'),
+                    lambda body: body.decode('utf-8'))
+register_serializer('application/octet-stream', bytes, bytes)
+register_compressor('identity', bytes, bytes)
+register_compressor('gzip', gzip.compress, gzip.decompress)
+
+if msgpack is not None:
+    register_serializer(
+        'application/msgpack',
+        lambda data: msgpack.packb(data, use_bin_type=True),
+        lambda body: msgpack.unpackb(body, raw=False))
+    serializers['application/x-msgpack'] = serializers['application/msgpack']
+
+if zstandard is not None:
+    register_compressor(
+        'zstd',
+        lambda body: zstandard.ZstdCompressor().compress(body),
+        lambda body: zstandard.ZstdDecompressor().decompress(body))
@@ -20,6 +20,12 @@ Configuration.add_application_properties('gunicorn', ['bus'],
                                          add_default_group=False)
 
 
+def get_env_flag(name):
+    """Return True if the environment variable is set to 1, true or yes,
+    the other values ("0", "false", ...) are False"""
+    return os.environ.get(name, '').strip().lower() in ('1', 'true', 'yes')
+
+
 @Configuration.add(
     'bus', label="Bus - options", must_be_loaded_by_unittest=True
 )
@@ -30,3 +36,149 @@ def define_bus_broker(group):
     group.add_argument('--bus-processes', type=int,
                        default=os.environ.get('ANYBLOK_BUS_PROCESSES', 4),
                        help="Number of process")
+    group.add_argument('--bus-publisher-pool-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_PUBLISHER_POOL_SIZE', 4),
+                       help="Number of idle publisher connections kept "
+                            "open by process, 0 to close the connection "
+                            "after each publication")
+    group.add_argument('--bus-publish-mode',
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_PUBLISH_MODE', 'direct'),
+                       choices=['direct', 'outbox'],
+                       help="direct: publish the message immediately, "
+                            "outbox: insert the message in Model.Bus.Outbox "
+                            "to be published by anyblok_bus_relay after the "
+                            "commit")
+    group.add_argument('--bus-message-id', action='store_true',
+                       default=get_env_flag('ANYBLOK_BUS_MESSAGE_ID'),
+                       help="Publish the messages with an unique message_id, "
+                            "needed by the idempotent consumers")
+    group.add_argument('--bus-relay-batch-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_RELAY_BATCH_SIZE', 1000),
+                       help="Number of messages published by the relay in "
+                            "one batch")
+    group.add_argument('--bus-relay-interval', type=float,
+                       default=os.environ.get('ANYBLOK_BUS_RELAY_INTERVAL', 1),
+                       help="Seconds waited by the relay when the outbox is "
+                            "empty")
+    group.add_argument('--bus-async-queue-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_ASYNC_QUEUE_SIZE', 10000),
+                       help="Maximum number of messages waiting in the "
+                            "queue of the background publisher, 0 for no "
+                            "limit")
+    group.add_argument('--bus-compression',
+                       default=os.environ.get('ANYBLOK_BUS_COMPRESSION'),
+                       help="Content encoding used to compress the "
+                            "published messages: gzip, zstd (if zstandard is "
+                            "installed)")
+    group.add_argument('--bus-compression-threshold', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_COMPRESSION_THRESHOLD', 1024),
+                       help="Minimal size in bytes of the compressed "
+                            "messages")
+    group.add_argument('--bus-prefetch', type=int,
+                       default=os.environ.get('ANYBLOK_BUS_PREFETCH', 1),
+                       help="Number of unacked messages delivered to a "
+                            "consumer, used by the consumers without "
+                            "prefetch")
+    group.add_argument('--bus-prefetch-adaptive', action='store_true',
+                       default=get_env_flag('ANYBLOK_BUS_PREFETCH_ADAPTIVE'),
+                       help="Adapt the prefetch of the channel from the "
+                            "latency of the consumers and the rate of the "
+                            "acks, starting from --bus-prefetch")
+    group.add_argument('--bus-prefetch-max', type=int,
+                       default=os.environ.get('ANYBLOK_BUS_PREFETCH_MAX', 1000),
+                       help="Maximum prefetch of the adaptive mode")
+    group.add_argument('--bus-group-commit-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_GROUP_COMMIT_SIZE', 0),
+                       help="Commit the consumed messages every N messages, "
+                            "0 to commit each message")
+    group.add_argument('--bus-group-commit-delay', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_GROUP_COMMIT_DELAY', 100),
+                       help="Maximum milliseconds between the consumation of "
+                            "a message and the commit of its group")
+    group.add_argument('--bus-error-buffer-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_ERROR_BUFFER_SIZE', 100),
+                       help="Save the messages in error by N in one insert, "
+                            "0 to save each message in error at once")
+    group.add_argument('--bus-error-buffer-delay', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_ERROR_BUFFER_DELAY', 100),
+                       help="Maximum milliseconds between the consumation of "
+                            "a message in error and its save")
+    group.add_argument('--bus-breaker-errors', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_BREAKER_ERRORS', 0),
+                       help="Pause a consumer after N consecutive messages "
+                            "in error, 0 to never pause it")
+    group.add_argument('--bus-breaker-error-rate', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_BREAKER_ERROR_RATE', 0),
+                       help="Pause a consumer when this ratio of its last "
+                            "messages are in error, 0 to never pause it")
+    group.add_argument('--bus-breaker-window', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_BREAKER_WINDOW', 100),
+                       help="Number of the last messages checked by the "
+                            "error rate")
+    group.add_argument('--bus-breaker-cooldown', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_BREAKER_COOLDOWN', 30),
+                       help="Seconds of pause of the consumer before "
+                            "consuming one message to probe it")
+    group.add_argument('--bus-executor-threads', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_EXECUTOR_THREADS', 0),
+                       help="Number of threads which consume the messages "
+                            "of a worker process, 0 to consume them in the "
+                            "thread of the connection")
+    group.add_argument('--bus-statement-timeout', action='store_true',
+                       default=get_env_flag('ANYBLOK_BUS_STATEMENT_TIMEOUT'),
+                       help="Use the timeout of the consumers as the "
+                            "statement timeout of their transactions "
+                            "(PostgreSQL)")
+    group.add_argument('--bus-inbox-cache-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_INBOX_CACHE_SIZE', 10000),
+                       help="Number of the ids of the messages consumed by "
+                            "the idempotent consumers kept by the process "
+                            "to skip the duplicates without query")
+    group.add_argument('--bus-reconnect-delay', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_RECONNECT_DELAY', 1),
+                       help="Seconds of the first reconnection delay of a "
+                            "worker, doubled by failed attempt, a random "
+                            "part of the delay is waited")
+    group.add_argument('--bus-reconnect-max-delay', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_RECONNECT_MAX_DELAY', 30),
+                       help="Maximum seconds of the reconnection delay")
+    group.add_argument('--bus-replay-processes', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_REPLAY_PROCESSES', 1),
+                       help="Number of processes of anyblok_bus_replay, the "
+                            "partitions of the stored messages are replayed "
+                            "concurrently")
+    group.add_argument('--bus-replay-partition',
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_REPLAY_PARTITION', 'queue'),
+                       choices=['queue', 'model', 'method'],
+                       help="Column of Model.Bus.Message which partitions "
+                            "the replay, the messages of a partition are "
+                            "replayed in order by one process")
+    group.add_argument('--bus-replay-batch-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_BUS_REPLAY_BATCH_SIZE', 1000),
+                       help="Number of messages replayed and committed in "
+                            "one chunk")
+    group.add_argument('--bus-replay-checkpoint',
+                       default=os.environ.get('ANYBLOK_BUS_REPLAY_CHECKPOINT'),
+                       help="Name of the checkpoints of the replay, a "
+                            "stopped replay is resumed by the next one with "
+                            "the same name")
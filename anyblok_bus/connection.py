@@ -0,0 +1,65 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Create the connections to the broker of an url
+
+The ``memory://`` urls give the connections of the in process broker
+(:mod:`anyblok_bus.memory`), the other ones the pika connections.
+"""
+from pika import BlockingConnection, SelectConnection, URLParameters
+from pika.adapters.asyncio_connection import AsyncioConnection
+from .memory import (
+    MemoryAsyncioConnection, MemoryBlockingConnection, MemorySelectConnection,
+    is_memory_url)
+
+
+def get_blocking_connection(url):
+    """Return a connection with the same api as ``pika.BlockingConnection``
+    """
+    if is_memory_url(url):
+        return MemoryBlockingConnection(url)
+
+    return BlockingConnection(URLParameters(url))
+
+
+def get_select_connection(url, on_open_callback=None,
+                          on_open_error_callback=None,
+                          on_close_callback=None):
+    """Return a connection with the same api as ``pika.SelectConnection``
+    """
+    if is_memory_url(url):
+        return MemorySelectConnection(
+            url, on_open_callback=on_open_callback,
+            on_open_error_callback=on_open_error_callback,
+            on_close_callback=on_close_callback)
+
+    return SelectConnection(
+        parameters=URLParameters(url),
+        on_open_callback=on_open_callback,
+        on_open_error_callback=on_open_error_callback,
+        on_close_callback=on_close_callback)
+
+
+def get_asyncio_connection(url, on_open_callback=None,
+                           on_open_error_callback=None,
+                           on_close_callback=None, custom_ioloop=None):
+    """Return a connection with the same api as
+    ``pika.adapters.asyncio_connection.AsyncioConnection``
+    """
+    if is_memory_url(url):
+        return MemoryAsyncioConnection(
+            url, on_open_callback=on_open_callback,
+            on_open_error_callback=on_open_error_callback,
+            on_close_callback=on_close_callback,
+            custom_ioloop=custom_ioloop)
+
+    return AsyncioConnection(
+        parameters=URLParameters(url),
+        on_open_callback=on_open_callback,
+        on_open_error_callback=on_open_error_callback,
+        on_close_callback=on_close_callback,
+        custom_ioloop=custom_ioloop)
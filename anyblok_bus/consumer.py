@@ -5,10 +5,12 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+from asyncio import iscoroutinefunction
 from anyblok.common import add_autodocs
 from anyblok.model.plugins import ModelPluginBase
 from logging import getLogger
 from .adapter import schema_adapter
+from .codec import decode
 
 logger = getLogger(__name__)
 
@@ -18,20 +20,161 @@ class BusConfigurationException(Exception):
 
 
 class ConsumerDescription:
-    def __init__(self, queue_name, processes, adapter, **kwargs):
+    def __init__(self, queue_name, processes, adapter, deserialize=False,
+                 prefetch=None, batch_size=None, batch_timeout=0.2,
+                 concurrency=None, is_async=False, weight=1, retry=None,
+                 max_retries=3, backoff=2, timeout=None, idempotent=False,
+                 raw=False, **kwargs):
         self.queue_name = queue_name
         self.processes = processes
         self.adapter = adapter
+        self.deserialize = deserialize
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.concurrency = concurrency
+        self.is_async = is_async
+        self.weight = weight
+        self.retry = retry
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.idempotent = idempotent
+        self.raw = raw
         self.kwargs = kwargs
 
+    def get_retry_delay(self, retries):
+        """Return the delay in milliseconds before the retry of a message
+        already retried ``retries`` times"""
+        return int(self.retry * self.backoff ** retries)
+
+    def get_retry_queue(self, retries):
+        """Return the delay queue of the retry of a message already retried
+        ``retries`` times"""
+        return '%s.retry.%d' % (self.queue_name,
+                                self.get_retry_delay(retries))
+
+    def get_retry_queues(self):
+        """Return the delay queues of the consumer with their delays in
+        milliseconds"""
+        queues = {}
+        for retries in range(self.max_retries):
+            queues[self.get_retry_queue(retries)] = self.get_retry_delay(
+                retries)
+
+        return queues
+
+    def get_retries(self, properties):
+        """Return the number of retries of the message, counted by the
+        ``x-death`` header that the delay queues add"""
+        prefix = '%s.retry.' % self.queue_name
+        deaths = (getattr(properties, 'headers', None) or {}).get(
+            'x-death') or []
+        return sum(death.get('count', 1) for death in deaths
+                   if str(death.get('queue', '')).startswith(prefix))
+
+    def can_retry(self, properties):
+        """Return True if the message in error must be retried"""
+        return bool(self.retry) and (
+            self.get_retries(properties) < self.max_retries)
+
+    def decode(self, body, content_type=None, content_encoding=None):
+        """Decompress the body of the message and decode it, in text or in
+        python object if the consumer is declared with ``deserialize=True``,
+        the bytes are kept if it is declared with ``raw=True``
+        """
+        return decode(body, content_type, content_encoding=content_encoding,
+                      deserialized=self.deserialize, raw=self.raw)
+
     def adapt(self, registry, body):
         if not self.adapter:
             return body
 
+        if self.batch_size:
+            return [self.adapter(registry, x, **self.kwargs) for x in body]
+
         return self.adapter(registry, body, **self.kwargs)
 
 
-def bus_consumer(queue_name=None, adapter=None, processes=0, **kwargs):
+def check_consumer_options(batch_size=None, weight=1, retry=None,
+                           max_retries=3, backoff=2, timeout=None,
+                           idempotent=False, deserialize=False, raw=False):
+    """Raise BusConfigurationException if the options of ``bus_consumer``
+    are not compatible"""
+    if raw and deserialize:
+        raise BusConfigurationException(
+            "A consumer can not be raw and deserialize the messages")
+
+    if not isinstance(weight, int) or weight < 1:
+        raise BusConfigurationException(
+            "The weight must be a positive integer, not %r" % weight)
+
+    if retry is not None:
+        if batch_size:
+            raise BusConfigurationException(
+                "The batch consumers can not be retried")
+
+        if retry <= 0 or max_retries < 1 or backoff < 1:
+            raise BusConfigurationException(
+                "The retry must be positive with at least one retry and a "
+                "backoff upper or equal to 1")
+
+    if idempotent and batch_size:
+        raise BusConfigurationException(
+            "The batch consumers can not be idempotent")
+
+    if timeout is not None and timeout <= 0:
+        raise BusConfigurationException(
+            "The timeout must be positive, not %r" % timeout)
+
+
+def bus_consumer(queue_name=None, adapter=None, processes=0,
+                 deserialize=False, prefetch=None, batch_size=None,
+                 batch_timeout=0.2, concurrency=None, weight=1, retry=None,
+                 max_retries=3, backoff=2, timeout=None, idempotent=False,
+                 raw=False, **kwargs):
+    """Declare the decorated method as the consumer of a queue
+
+    :param queue_name: name of the consumed queue
+    :param adapter: function to transform the body before the consumer
+    :param processes: number of dedicated processes, 0 to share the
+                      processes defined by ``bus_processes``
+    :param deserialize: if True the body is deserialized by the codec of its
+                        content type before the adapter, else the body is
+                        the text of the message
+    :param prefetch: number of unacked messages delivered to the consumer,
+                     by default ``bus_prefetch``
+    :param batch_size: if given the consumer gets a list of at most
+                       ``batch_size`` bodies and returns one status for the
+                       whole batch or a list of statuses, one by message
+    :param batch_timeout: maximum seconds waited to fill a batch
+    :param concurrency: maximum number of messages consumed at the same time
+                        by a consumer declared with ``async def``, by
+                        default the prefetch
+    :param weight: share of the consumer in the worker process, a consumer
+                   of weight 3 consumes 3 messages when a consumer of
+                   weight 1 consumes one
+    :param retry: milliseconds before the first retry of a message in
+                  error, the message is published in a delay queue
+                  dead-lettered to the consumed queue. By default the
+                  message in error is saved in ``Model.Bus.Message``
+    :param max_retries: number of retries before the message is saved in
+                        ``Model.Bus.Message``
+    :param backoff: multiplier of the delay between two retries
+    :param timeout: time budget in seconds of one message (or one batch),
+                    the stack of a slower consumer is logged, a consumer
+                    declared with ``async def`` is cancelled. The consumers
+                    with a timeout are not called in the thread of the
+                    connection, the heartbeats go on during the call
+    :param idempotent: if True the ``message_id`` of the consumed messages
+                       are saved in ``Model.Bus.Inbox`` in the transaction of
+                       the consumer, a message delivered again is acked
+                       without calling the consumer
+    :param raw: if True the body is given to the adapter and to the consumer
+                as the bytes of the message, only decompressed, for the
+                binary formats and the big messages (no copy to text)
+    :param kwargs: extra arguments given to the adapter
+    """
     if adapter is None and 'schema' in kwargs:
         adapter = schema_adapter  # keep compatibility
 
@@ -42,11 +185,27 @@ def bus_consumer(queue_name=None, adapter=None, processes=0, **kwargs):
     if queue_name is None:
         raise BusConfigurationException("No queue name")
 
+    check_consumer_options(batch_size=batch_size, weight=weight,
+                           retry=retry, max_retries=max_retries,
+                           backoff=backoff, timeout=timeout,
+                           idempotent=idempotent, deserialize=deserialize,
+                           raw=raw)
+
     def wrapper(method):
+        is_async = iscoroutinefunction(method)
+        if is_async and batch_size:
+            raise BusConfigurationException(
+                "The batch consumers can not be declared with async def")
+
         add_autodocs(method, autodoc)
         method.is_a_bus_consumer = True
         method.consumer = ConsumerDescription(
-            queue_name, processes, adapter, **kwargs)
+            queue_name, processes, adapter, deserialize=deserialize,
+            prefetch=prefetch, batch_size=batch_size,
+            batch_timeout=batch_timeout, concurrency=concurrency,
+            is_async=is_async, weight=weight, retry=retry,
+            max_retries=max_retries, backoff=backoff, timeout=timeout,
+            idempotent=idempotent, raw=raw, **kwargs)
         return classmethod(method)
 
     return wrapper
@@ -115,6 +274,7 @@ class BusConsumerPlugin(ModelPluginBase):
             return getattr(super(new_base, cls), consumer)(body=data)
 
         wrapper.__name__ = consumer
+        wrapper.consumer = consumer_description
         setattr(new_base, consumer, classmethod(wrapper))
         properties['bus_consumers'].append(
             (consumer_description.queue_name,
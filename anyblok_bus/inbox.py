@@ -0,0 +1,75 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import threading
+from collections import OrderedDict
+from anyblok.config import Configuration
+
+
+class DuplicateMessage(Exception):
+    """The message was already consumed by the idempotent consumer"""
+
+
+class InboxCache:
+    """Bounded LRU of the ids of the messages committed in
+    ``Model.Bus.Inbox`` by the process
+
+    The cache is shared by the workers of the process, it survives the
+    reconnections which deliver again the last consumed messages. Only the
+    committed ids are added, a message found in the cache is a duplicate
+    without query, the other ones are checked by the primary key of the
+    inbox.
+
+    :param size: maximum number of ids
+    """
+
+    caches = {}
+    lock = threading.Lock()
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, size=None):
+        """Return the cache of the process for the size, by default
+        ``bus_inbox_cache_size``"""
+        if size is None:
+            size = Configuration.get('bus_inbox_cache_size', 10000)
+
+        with cls.lock:
+            if size not in cls.caches:
+                cls.caches[size] = cls(size)
+
+            return cls.caches[size]
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._ids:
+                self._ids.move_to_end(key)
+                return True
+
+            return False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, key):
+        """Add the key ``(queue, message_id)`` of a committed message"""
+        if not self.size:
+            return
+
+        with self._lock:
+            self._ids[key] = True
+            self._ids.move_to_end(key)
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
@@ -0,0 +1,1175 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""In process stand-in of rabbitmq, used with the ``memory://`` urls
+
+Only the subset of pika used by anyblok_bus is implemented: the
+``SelectConnection`` and the ``BlockingConnection``, the exchanges (direct,
+fanout, topic and the default exchange), the queues, ``basic_qos``,
+``basic_consume``, ``basic_cancel``, ack / nack / reject, ``basic_get``,
+the publisher confirms and the mandatory returns. The queues declared with
+``x-message-ttl`` and ``x-dead-letter-exchange`` dead-letter their expired
+and rejected messages with the ``x-death`` header, as rabbitmq does.
+
+::
+
+    broker = MemoryBroker.get('memory://test')
+    broker.exchange_declare('exchange')
+    broker.queue_declare('queue')
+    broker.queue_bind('queue', 'exchange', 'routing_key')
+
+All the urls with the same host and path share the same broker.
+"""
+import asyncio
+import copy
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from functools import partial
+from logging import getLogger
+from pika import BasicProperties
+from pika.exceptions import (
+    AMQPConnectionError, ChannelClosedByBroker, ChannelClosedByClient,
+    ChannelWrongStateError, ConnectionClosedByBroker, ConnectionClosedByClient,
+    ConnectionWrongStateError, NackError, UnroutableError)
+from pika.frame import Method
+from pika.spec import Basic, Confirm, Exchange, Queue
+from pika.adapters.blocking_connection import ReturnedMessage
+
+logger = getLogger(__name__)
+
+MEMORY_SCHEME = 'memory://'
+
+
+def is_memory_url(url):
+    """Return True if the url targets the in process broker"""
+    return url.startswith(MEMORY_SCHEME)
+
+
+class MemoryIOLoop:
+    """IOLoop of the memory connections, it runs the callbacks scheduled by
+    the broker and the timers"""
+
+    def __init__(self):
+        self._callbacks = deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._running = False
+
+    def add_callback_threadsafe(self, callback):
+        with self._condition:
+            self._callbacks.append(callback)
+            self._condition.notify()
+
+    add_callback = add_callback_threadsafe
+
+    def call_later(self, delay, callback):
+        timer = [time.monotonic() + delay, next(self._sequence), callback]
+        with self._condition:
+            heapq.heappush(self._timers, timer)
+            self._condition.notify()
+
+        return timer
+
+    def remove_timeout(self, timer):
+        timer[2] = None
+
+    def _get_ready(self, timeout):
+        with self._condition:
+            if not self._callbacks and not self._stopping:
+                delay = timeout
+                if self._timers:
+                    next_timer = self._timers[0][0] - time.monotonic()
+                    delay = next_timer if delay is None else min(
+                        delay, next_timer)
+
+                if delay is None or delay > 0:
+                    self._condition.wait(delay)
+
+            ready = list(self._callbacks)
+            self._callbacks.clear()
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                callback = heapq.heappop(self._timers)[2]
+                if callback is not None:
+                    ready.append(callback)
+
+        return ready
+
+    def process_events(self, timeout=0):
+        """Run the ready callbacks, wait at most ``timeout`` seconds if there
+        is none (None to wait without limit)
+
+        :rtype: number of called callbacks
+        """
+        ready = self._get_ready(timeout)
+        for callback in ready:
+            callback()
+
+        return len(ready)
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                raise RuntimeError('IOLoop is not reentrant and is already '
+                                   'running')
+
+            self._running = True
+            self._stopping = False
+
+        try:
+            while True:
+                with self._condition:
+                    if self._stopping:
+                        break
+
+                self.process_events(None)
+        finally:
+            with self._condition:
+                self._running = False
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+
+class MemoryMessage:
+
+    def __init__(self, exchange, routing_key, body, properties):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.redelivered = False
+        self.expiration = None
+
+
+class MemoryConsumer:
+
+    def __init__(self, channel, queue, consumer_tag, callback, auto_ack,
+                 prefetch_count):
+        self.channel = channel
+        self.queue = queue
+        self.consumer_tag = consumer_tag
+        self.callback = callback
+        self.auto_ack = auto_ack
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+
+    def has_capacity(self):
+        if self.auto_ack:
+            return True
+
+        if self.prefetch_count and self.unacked >= self.prefetch_count:
+            return False
+
+        return self.channel.has_capacity()
+
+
+class MemoryQueue:
+
+    def __init__(self, name, durable=False, arguments=None):
+        self.name = name
+        self.durable = durable
+        self.arguments = arguments or {}
+        self.messages = deque()
+        self.consumers = []
+        self._next_consumer = 0
+
+    def get_consumer(self):
+        """Return the next consumer able to receive a message, round
+        robin"""
+        count = len(self.consumers)
+        for index in range(count):
+            consumer = self.consumers[(self._next_consumer + index) % count]
+            if consumer.has_capacity():
+                self._next_consumer = (self._next_consumer + index + 1) % (
+                    count)
+                return consumer
+
+        return None
+
+
+class MemoryBroker:
+    """Exchanges and queues of one virtual host of the in process broker"""
+
+    brokers = {}
+    lock = threading.RLock()
+
+    def __init__(self, name):
+        self.name = name
+        self.exchanges = {'': 'direct', 'amq.direct': 'direct',
+                          'amq.fanout': 'fanout', 'amq.topic': 'topic'}
+        self.bindings = {}
+        self.queues = {}
+        self.connections = []
+        self.running = True
+        self.connection_attempts = 0
+        self.hold_confirms = False
+        self._held_confirms = []
+        self._tag_sequence = itertools.count(1)
+        self._expiries = []
+        self._expiry_sequence = itertools.count()
+        self._expiry_condition = threading.Condition(self.lock)
+        self._expiry_thread = None
+        self._changed = threading.Condition(self.lock)
+
+    @classmethod
+    def get(cls, url):
+        """Return the broker of the url, created at the first call"""
+        name = url[len(MEMORY_SCHEME):].split('?')[0].rstrip('/')
+        with cls.lock:
+            if name not in cls.brokers:
+                cls.brokers[name] = cls(name)
+
+            return cls.brokers[name]
+
+    @classmethod
+    def reset_all(cls):
+        """Forget all the brokers, the open connections are closed"""
+        with cls.lock:
+            brokers, cls.brokers = cls.brokers, {}
+
+        for broker in brokers.values():
+            broker.stop()
+
+    def exchange_declare(self, exchange, exchange_type='direct',
+                         passive=False):
+        with self.lock:
+            if exchange not in self.exchanges:
+                if passive:
+                    raise ChannelClosedByBroker(
+                        404, "NOT_FOUND - no exchange %r" % exchange)
+
+                self.exchanges[exchange] = str(getattr(
+                    exchange_type, 'value', exchange_type))
+            elif not passive and self.exchanges[exchange] != str(getattr(
+                exchange_type, 'value', exchange_type)
+            ):
+                raise ChannelClosedByBroker(
+                    406, "PRECONDITION_FAILED - inequivalent arg 'type' for "
+                         "exchange %r" % exchange)
+
+    def queue_declare(self, queue, passive=False, durable=False,
+                      arguments=None):
+        with self.lock:
+            if not queue:
+                queue = 'amq.gen-%d' % next(self._tag_sequence)
+
+            if queue not in self.queues:
+                if passive:
+                    raise ChannelClosedByBroker(
+                        404, "NOT_FOUND - no queue %r" % queue)
+
+                self.queues[queue] = MemoryQueue(
+                    queue, durable=durable, arguments=arguments)
+            elif not passive and arguments is not None and (
+                self.queues[queue].arguments != arguments
+            ):
+                raise ChannelClosedByBroker(
+                    406, "PRECONDITION_FAILED - inequivalent arguments for "
+                         "queue %r" % queue)
+
+            memory_queue = self.queues[queue]
+            return Queue.DeclareOk(queue, len(memory_queue.messages),
+                                   len(memory_queue.consumers))
+
+    def queue_bind(self, queue, exchange, routing_key=None):
+        with self.lock:
+            if exchange not in self.exchanges:
+                raise ChannelClosedByBroker(
+                    404, "NOT_FOUND - no exchange %r" % exchange)
+            if queue not in self.queues:
+                raise ChannelClosedByBroker(
+                    404, "NOT_FOUND - no queue %r" % queue)
+
+            binding = (queue, routing_key or queue)
+            bindings = self.bindings.setdefault(exchange, [])
+            if binding not in bindings:
+                bindings.append(binding)
+
+    def queue_purge(self, queue):
+        with self.lock:
+            memory_queue = self.get_queue(queue)
+            count = len(memory_queue.messages)
+            memory_queue.messages.clear()
+            return count
+
+    def queue_delete(self, queue):
+        """Delete the queue, its consumers are cancelled"""
+        with self.lock:
+            memory_queue = self.queues.pop(queue, None)
+            for exchange, bindings in self.bindings.items():
+                bindings[:] = [x for x in bindings if x[0] != queue]
+
+            if memory_queue is None:
+                return 0
+
+            consumers = list(memory_queue.consumers)
+
+        for consumer in consumers:
+            consumer.channel.cancel_by_broker(consumer.consumer_tag)
+
+        return len(memory_queue.messages)
+
+    def get_queue(self, queue):
+        if queue not in self.queues:
+            raise ChannelClosedByBroker(
+                404, "NOT_FOUND - no queue %r" % queue)
+
+        return self.queues[queue]
+
+    @staticmethod
+    def topic_match(pattern, routing_key):
+        def match(words, keys):
+            if not words:
+                return not keys
+            if words[0] == '#':
+                return any(match(words[1:], keys[index:])
+                           for index in range(len(keys) + 1))
+            if not keys:
+                return False
+            if words[0] in ('*', keys[0]):
+                return match(words[1:], keys[1:])
+
+            return False
+
+        return match(pattern.split('.'), routing_key.split('.'))
+
+    def route(self, exchange, routing_key):
+        """Return the names of the queues which receive the message"""
+        exchange_type = self.exchanges[exchange]
+        if exchange == '':
+            return [routing_key] if routing_key in self.queues else []
+
+        queues = []
+        for queue, binding_key in self.bindings.get(exchange, []):
+            if exchange_type == 'fanout':
+                matched = True
+            elif exchange_type == 'topic':
+                matched = self.topic_match(binding_key, routing_key)
+            else:
+                matched = binding_key == routing_key
+
+            if matched and queue not in queues:
+                queues.append(queue)
+
+        return queues
+
+    def publish(self, exchange, routing_key, body, properties):
+        """Route and enqueue the message
+
+        :rtype: True if the message was routed to at least one queue
+        """
+        with self.lock:
+            if exchange not in self.exchanges:
+                raise ChannelClosedByBroker(
+                    404, "NOT_FOUND - no exchange %r" % exchange)
+
+            queues = self.route(exchange, routing_key)
+            for queue in queues:
+                self.enqueue(queue, MemoryMessage(
+                    exchange, routing_key, body, properties))
+
+            return bool(queues)
+
+    def enqueue(self, queue, message, front=False):
+        memory_queue = self.queues.get(queue)
+        if memory_queue is None:
+            return
+
+        ttl = memory_queue.arguments.get('x-message-ttl')
+        if ttl is not None:
+            message.expiration = time.monotonic() + ttl / 1000.
+            self.schedule_expiry(queue, message.expiration)
+
+        if front:
+            memory_queue.messages.appendleft(message)
+        else:
+            memory_queue.messages.append(message)
+
+        self.dispatch(memory_queue)
+
+    def dispatch(self, memory_queue):
+        """Deliver the messages of the queue to the consumers which have
+        some capacity"""
+        while memory_queue.messages:
+            consumer = memory_queue.get_consumer()
+            if consumer is None:
+                break
+
+            message = memory_queue.messages.popleft()
+            consumer.channel.deliver(consumer, message)
+
+        self._changed.notify_all()
+
+    def dispatch_all(self):
+        with self.lock:
+            for memory_queue in list(self.queues.values()):
+                self.dispatch(memory_queue)
+
+    def wait_for(self, predicate, timeout, interval=0.05):
+        """Wait until the predicate returns True or until the timeout
+
+        The predicate is evaluated, with the lock of the broker, after each
+        publish, delivery and settlement of the messages, and at least every
+        ``interval`` seconds for the changes made outside of the broker.
+
+        :param predicate: callable without argument
+        :param timeout: maximum seconds to wait
+        :rtype: the last result of the predicate
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                result = predicate()
+                remaining = deadline - time.monotonic()
+                if result or remaining <= 0:
+                    return result
+
+                self._changed.wait(min(remaining, interval))
+
+    def schedule_expiry(self, queue, expiration):
+        """Call ``expire`` on the queue at the expiration, the expirations
+        of all the queues are waited by one thread of the broker, which
+        stops when no message waits its expiration"""
+        with self.lock:
+            heapq.heappush(self._expiries, (
+                expiration, next(self._expiry_sequence), queue))
+            if self._expiry_thread is None:
+                self._expiry_thread = threading.Thread(
+                    target=self._run_expiries, daemon=True,
+                    name='memory-broker-%s-ttl' % self.name)
+                self._expiry_thread.start()
+            else:
+                self._expiry_condition.notify()
+
+    def _run_expiries(self):
+        with self.lock:
+            while self._expiries:
+                expiration, sequence, queue = self._expiries[0]
+                delay = expiration - time.monotonic()
+                if delay > 0:
+                    # woken up by an earlier expiration
+                    self._expiry_condition.wait(delay)
+                    continue
+
+                heapq.heappop(self._expiries)
+                self.expire(queue)
+
+            self._expiry_thread = None
+
+    def expire(self, queue):
+        """Dead-letter the expired messages at the head of the queue"""
+        with self.lock:
+            memory_queue = self.queues.get(queue)
+            if memory_queue is None:
+                return
+
+            now = time.monotonic()
+            messages = memory_queue.messages
+            while (
+                messages and messages[0].expiration is not None and
+                messages[0].expiration <= now
+            ):
+                self.dead_letter(memory_queue, messages.popleft(), 'expired')
+
+    def dead_letter(self, memory_queue, message, reason):
+        """Publish the message in the dead letter exchange of the queue,
+        with the ``x-death`` header, or drop it"""
+        exchange = memory_queue.arguments.get('x-dead-letter-exchange')
+        if exchange is None or exchange not in self.exchanges:
+            return
+
+        routing_key = memory_queue.arguments.get(
+            'x-dead-letter-routing-key', message.routing_key)
+        properties = copy.copy(message.properties)
+        headers = properties.headers = dict(properties.headers or {})
+        deaths = [dict(death) for death in headers.get('x-death', [])]
+        for death in deaths:
+            if (
+                death.get('queue') == memory_queue.name and
+                death.get('reason') == reason
+            ):
+                death['count'] += 1
+                death['time'] = datetime.now()
+                deaths.remove(death)
+                deaths.insert(0, death)
+                break
+        else:
+            deaths.insert(0, {
+                'count': 1, 'reason': reason, 'queue': memory_queue.name,
+                'time': datetime.now(), 'exchange': message.exchange,
+                'routing-keys': [message.routing_key]})
+
+        headers['x-death'] = deaths
+        for queue in self.route(exchange, routing_key):
+            self.enqueue(queue, MemoryMessage(
+                exchange, routing_key, message.body, properties))
+
+    def drop(self, queue, messages):
+        """Drop the rejected messages, or dead-letter them"""
+        memory_queue = self.queues.get(queue)
+        if memory_queue is None:
+            return
+
+        for message in messages:
+            self.dead_letter(memory_queue, message, 'rejected')
+
+    def requeue(self, queue, messages):
+        """Put back the messages at the head of the queue"""
+        for message in reversed(messages):
+            message.redelivered = True
+            memory_queue = self.queues.get(queue)
+            if memory_queue is not None:
+                memory_queue.messages.appendleft(message)
+
+        if queue in self.queues:
+            self.dispatch(self.queues[queue])
+
+    def connect(self, connection):
+        with self.lock:
+            self.connection_attempts += 1
+            if not self.running:
+                raise AMQPConnectionError(
+                    "The memory broker %r is stopped" % self.name)
+
+            self.connections.append(connection)
+
+    def disconnect(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def stop(self):
+        """Close all the connections as a broker shutdown does, the new
+        connections are refused until ``start`` is called"""
+        with self.lock:
+            self.running = False
+            connections = list(self.connections)
+
+        for connection in connections:
+            connection.close_by_broker(
+                ConnectionClosedByBroker(320, "CONNECTION_FORCED - shutdown"))
+
+    def start(self):
+        with self.lock:
+            self.running = True
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def release_confirms(self):
+        """Send the publisher confirms held while ``hold_confirms`` was
+        True, as a broker which is slow to confirm"""
+        with self.lock:
+            self.hold_confirms = False
+            held, self._held_confirms = self._held_confirms, []
+
+        for channel, frame in held:
+            if channel.is_open:
+                channel._schedule(channel._ack_nack_callback, frame)
+
+
+class MemoryChannel:
+    """Asynchronous channel, the equivalent of ``pika.channel.Channel``"""
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channel_number
+        self._state = 'open'
+        self._closing_reason = None
+        self._on_close_callbacks = []
+        self._on_cancel_callbacks = []
+        self._on_return_callbacks = []
+        self._ack_nack_callback = None
+        self._delivery_tag = 0
+        self._publish_tag = 0
+        self._prefetch_count = 0
+        self._global_prefetch_count = 0
+        self._consumers = {}
+        self._unacked = OrderedDict()
+        self._consumer_sequence = itertools.count(1)
+
+    def __int__(self):
+        return self.channel_number
+
+    def __repr__(self):
+        return '<MemoryChannel number=%s %s>' % (
+            self.channel_number, self._state)
+
+    @property
+    def is_open(self):
+        return self._state == 'open'
+
+    @property
+    def is_closing(self):
+        return self._state == 'closing'
+
+    @property
+    def is_closed(self):
+        return self._state == 'closed'
+
+    def _raise_if_not_open(self):
+        if not self.is_open:
+            raise ChannelWrongStateError('Channel is closed.')
+
+    def _schedule(self, callback, *args):
+        if callback is not None:
+            self.connection.add_callback_threadsafe(
+                partial(callback, *args))
+
+    def _frame(self, method):
+        return Method(self.channel_number, method)
+
+    def _call(self, callback, function, *args, **kwargs):
+        """Call the broker, a broker error closes the channel"""
+        self._raise_if_not_open()
+        try:
+            result = function(*args, **kwargs)
+        except ChannelClosedByBroker as reason:
+            self.close_by_broker(reason)
+            return None
+
+        self._schedule(callback, self._frame(result))
+        return result
+
+    def has_capacity(self):
+        if not self.is_open:
+            return False
+        if self._global_prefetch_count:
+            return len(self._unacked) < self._global_prefetch_count
+
+        return True
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self._on_cancel_callbacks.append(callback)
+
+    def add_on_return_callback(self, callback):
+        self._on_return_callbacks.append(callback)
+
+    def exchange_declare(self, exchange, exchange_type='direct',
+                         passive=False, durable=False, auto_delete=False,
+                         internal=False, arguments=None, callback=None):
+        return self._call(
+            callback, lambda: self.broker.exchange_declare(
+                exchange, exchange_type, passive) or Exchange.DeclareOk())
+
+    def queue_declare(self, queue, passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None,
+                      callback=None):
+        return self._call(
+            callback, self.broker.queue_declare, queue, passive=passive,
+            durable=durable, arguments=arguments)
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None,
+                   callback=None):
+        return self._call(
+            callback, lambda: self.broker.queue_bind(
+                queue, exchange, routing_key) or Queue.BindOk())
+
+    def queue_purge(self, queue, callback=None):
+        return self._call(
+            callback, lambda: Queue.PurgeOk(self.broker.queue_purge(queue)))
+
+    def queue_delete(self, queue, if_unused=False, if_empty=False,
+                     callback=None):
+        return self._call(
+            callback, lambda: Queue.DeleteOk(self.broker.queue_delete(queue)))
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False,
+                  callback=None):
+        self._raise_if_not_open()
+        with self.broker.lock:
+            if global_qos:
+                self._global_prefetch_count = prefetch_count
+            else:
+                self._prefetch_count = prefetch_count
+
+        self._schedule(callback, self._frame(Basic.QosOk()))
+        self.broker.dispatch_all()
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None,
+                      callback=None):
+        self._raise_if_not_open()
+        if not consumer_tag:
+            consumer_tag = 'ctag%d.%d' % (
+                self.channel_number, next(self._consumer_sequence))
+
+        with self.broker.lock:
+            try:
+                memory_queue = self.broker.get_queue(queue)
+            except ChannelClosedByBroker as reason:
+                self.close_by_broker(reason)
+                return consumer_tag
+
+            consumer = MemoryConsumer(
+                self, queue, consumer_tag, on_message_callback, auto_ack,
+                self._prefetch_count)
+            self._consumers[consumer_tag] = consumer
+            memory_queue.consumers.append(consumer)
+            self._schedule(
+                callback, self._frame(Basic.ConsumeOk(consumer_tag)))
+            self.broker.dispatch(memory_queue)
+
+        return consumer_tag
+
+    def _remove_consumer(self, consumer_tag):
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer is not None:
+            memory_queue = self.broker.queues.get(consumer.queue)
+            if memory_queue is not None and consumer in (
+                memory_queue.consumers
+            ):
+                memory_queue.consumers.remove(consumer)
+
+        return consumer
+
+    def basic_cancel(self, consumer_tag='', callback=None):
+        self._raise_if_not_open()
+        with self.broker.lock:
+            self._remove_consumer(consumer_tag)
+
+        self._schedule(callback, self._frame(Basic.CancelOk(consumer_tag)))
+
+    def cancel_by_broker(self, consumer_tag):
+        """Cancel the consumer as rabbitmq does when its queue is deleted"""
+        with self.broker.lock:
+            self._remove_consumer(consumer_tag)
+
+        for callback in self._on_cancel_callbacks:
+            self._schedule(callback, self._frame(Basic.Cancel(consumer_tag)))
+
+    def deliver(self, consumer, message):
+        """Called by the broker, with its lock, to give a message to the
+        consumer"""
+        self._delivery_tag += 1
+        delivery_tag = self._delivery_tag
+        if not consumer.auto_ack:
+            consumer.unacked += 1
+            self._unacked[delivery_tag] = (consumer.queue, consumer, message)
+
+        method = Basic.Deliver(consumer.consumer_tag, delivery_tag,
+                               message.redelivered, message.exchange,
+                               message.routing_key)
+        self.connection.add_callback_threadsafe(partial(
+            self._on_deliver, consumer, method, message))
+
+    def _on_deliver(self, consumer, method, message):
+        if not self.is_open:
+            return  # the message is requeued by the close
+
+        if consumer.consumer_tag not in self._consumers:
+            # cancelled consumer, pika rejects the message as well
+            if not consumer.auto_ack:
+                self.basic_reject(method.delivery_tag, requeue=True)
+
+            return
+
+        consumer.callback(self, method, message.properties, message.body)
+
+    def _pop_unacked(self, delivery_tag, multiple):
+        if multiple:
+            tags = [tag for tag in self._unacked
+                    if not delivery_tag or tag <= delivery_tag]
+        elif delivery_tag in self._unacked:
+            tags = [delivery_tag]
+        else:
+            self.close_by_broker(ChannelClosedByBroker(
+                406, "PRECONDITION_FAILED - unknown delivery tag %d" % (
+                    delivery_tag)))
+            return []
+
+        entries = []
+        for tag in tags:
+            queue, consumer, message = self._unacked.pop(tag)
+            consumer.unacked -= 1
+            entries.append((queue, message))
+
+        return entries
+
+    def _settle(self, delivery_tag, multiple, requeue):
+        self._raise_if_not_open()
+        with self.broker.lock:
+            entries = self._pop_unacked(delivery_tag, multiple)
+            by_queue = OrderedDict()
+            for queue, message in entries:
+                by_queue.setdefault(queue, []).append(message)
+
+            for queue, messages in by_queue.items():
+                if requeue:
+                    self.broker.requeue(queue, messages)
+                elif requeue is not None:
+                    self.broker.drop(queue, messages)
+
+            self.broker.dispatch_all()
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._settle(delivery_tag, multiple, None)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._settle(delivery_tag, multiple, requeue)
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        self._settle(delivery_tag, False, requeue)
+
+    def basic_get(self, queue, callback, auto_ack=False):
+        self._raise_if_not_open()
+        with self.broker.lock:
+            try:
+                memory_queue = self.broker.get_queue(queue)
+            except ChannelClosedByBroker as reason:
+                self.close_by_broker(reason)
+                return
+
+            if not memory_queue.messages:
+                self._schedule(callback, self, None, None, None)
+                return
+
+            message = memory_queue.messages.popleft()
+            self._delivery_tag += 1
+            if not auto_ack:
+                consumer = MemoryConsumer(self, queue, None, None, False, 0)
+                consumer.unacked = 1
+                self._unacked[self._delivery_tag] = (queue, consumer, message)
+
+            method = Basic.GetOk(self._delivery_tag, message.redelivered,
+                                 message.exchange, message.routing_key,
+                                 len(memory_queue.messages))
+            self._schedule(callback, self, method, message.properties,
+                           message.body)
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        self._raise_if_not_open()
+        self._ack_nack_callback = ack_nack_callback
+        self._schedule(callback, self._frame(Confirm.SelectOk()))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False):
+        self._raise_if_not_open()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        elif not isinstance(body, bytes):
+            body = bytes(body)
+
+        properties = properties or BasicProperties()
+        try:
+            routed = self.broker.publish(
+                exchange, routing_key, body, properties)
+        except ChannelClosedByBroker as reason:
+            self.close_by_broker(reason)
+            return
+
+        if mandatory and not routed:
+            method = Basic.Return(312, 'NO_ROUTE', exchange, routing_key)
+            for callback in self._on_return_callbacks:
+                self._schedule(callback, self, method, properties, body)
+
+        if self._ack_nack_callback is not None:
+            self._publish_tag += 1
+            frame = self._frame(Basic.Ack(self._publish_tag))
+            with self.broker.lock:
+                if self.broker.hold_confirms:
+                    self.broker._held_confirms.append((self, frame))
+                    return
+
+            self._schedule(self._ack_nack_callback, frame)
+
+    def _close(self, reason):
+        with self.broker.lock:
+            if self.is_closed:
+                return False
+
+            self._state = 'closed'
+            self._closing_reason = reason
+            for consumer_tag in list(self._consumers):
+                self._remove_consumer(consumer_tag)
+
+            by_queue = OrderedDict()
+            for queue, consumer, message in self._unacked.values():
+                by_queue.setdefault(queue, []).append(message)
+
+            self._unacked.clear()
+            for queue, messages in by_queue.items():
+                self.broker.requeue(queue, messages)
+
+        self.connection.remove_channel(self)
+        for callback in self._on_close_callbacks:
+            self._schedule(callback, self, reason)
+
+        return True
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if not self.is_open:
+            raise ChannelWrongStateError('Channel is closed.')
+
+        self._close(ChannelClosedByClient(reply_code, reply_text))
+
+    def close_by_broker(self, reason):
+        logger.debug('Memory channel %r closed by the broker: %r',
+                     self, reason)
+        self._close(reason)
+
+
+class MemoryConnection:
+    """Base of the memory connections"""
+
+    def __init__(self, url, ioloop=None):
+        self.url = url
+        self.broker = MemoryBroker.get(url)
+        self.ioloop = ioloop or MemoryIOLoop()
+        self._channels = {}
+        self._channel_sequence = itertools.count(1)
+        self._state = 'init'
+
+    @property
+    def is_open(self):
+        return self._state == 'open'
+
+    @property
+    def is_closing(self):
+        return self._state == 'closing'
+
+    @property
+    def is_closed(self):
+        return self._state == 'closed'
+
+    def add_callback_threadsafe(self, callback):
+        """Schedule the callback in the ioloop of the connection"""
+        self.ioloop.add_callback_threadsafe(callback)
+
+    def _open_channel(self):
+        if not self.is_open:
+            raise ConnectionWrongStateError('Connection is closed.')
+
+        channel = MemoryChannel(self, next(self._channel_sequence))
+        self._channels[channel.channel_number] = channel
+        return channel
+
+    def remove_channel(self, channel):
+        self._channels.pop(channel.channel_number, None)
+
+    def _close(self, reason):
+        if self.is_closed:
+            return False
+
+        self._state = 'closed'
+        for channel in list(self._channels.values()):
+            channel._close(reason)
+
+        self.broker.disconnect(self)
+        return True
+
+    def close_by_broker(self, reason):
+        self._close(reason)
+
+
+class MemorySelectConnection(MemoryConnection):
+    """Equivalent of ``pika.SelectConnection``"""
+
+    def __init__(self, url, on_open_callback=None,
+                 on_open_error_callback=None, on_close_callback=None,
+                 ioloop=None):
+        super(MemorySelectConnection, self).__init__(url, ioloop=ioloop)
+        self._on_close_callback = on_close_callback
+        try:
+            self.broker.connect(self)
+            self._state = 'open'
+            if on_open_callback is not None:
+                self.add_callback_threadsafe(
+                    partial(on_open_callback, self))
+        except AMQPConnectionError as error:
+            self._state = 'closed'
+            if on_open_error_callback is not None:
+                self.add_callback_threadsafe(
+                    partial(on_open_error_callback, self, error))
+
+    def channel(self, channel_number=None, on_open_callback=None):
+        channel = self._open_channel()
+        if on_open_callback is not None:
+            self.add_callback_threadsafe(
+                partial(on_open_callback, channel))
+
+        return channel
+
+    def _close(self, reason):
+        if super(MemorySelectConnection, self)._close(reason):
+            if self._on_close_callback is not None:
+                self.add_callback_threadsafe(
+                    partial(self._on_close_callback, self, reason))
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if self.is_closed:
+            raise ConnectionWrongStateError('Connection is closed.')
+
+        self._close(ConnectionClosedByClient(reply_code, reply_text))
+
+
+class MemoryAsyncioConnection(MemorySelectConnection):
+    """Equivalent of ``pika.adapters.asyncio_connection.AsyncioConnection``,
+    the ioloop is the asyncio event loop"""
+
+    def __init__(self, url, on_open_callback=None,
+                 on_open_error_callback=None, on_close_callback=None,
+                 custom_ioloop=None):
+        super(MemoryAsyncioConnection, self).__init__(
+            url, on_open_callback=on_open_callback,
+            on_open_error_callback=on_open_error_callback,
+            on_close_callback=on_close_callback,
+            ioloop=custom_ioloop or asyncio.get_event_loop())
+
+    def add_callback_threadsafe(self, callback):
+        self.ioloop.call_soon_threadsafe(callback)
+
+
+class MemoryBlockingChannel:
+    """Equivalent of ``pika.adapters.blocking_connection.BlockingChannel``
+    """
+
+    def __init__(self, impl, connection):
+        self._impl = impl
+        self.connection = connection
+        self._delivery_confirmation = False
+        self._confirms = []
+        self._returned = []
+
+    @property
+    def channel_number(self):
+        return self._impl.channel_number
+
+    @property
+    def is_open(self):
+        return self._impl.is_open
+
+    @property
+    def is_closed(self):
+        return self._impl.is_closed
+
+    def _flush_output(self, *waiters):
+        """Run the callbacks until one of the waiters returns True"""
+        while True:
+            self.connection.process_data_events(0)
+            if self._impl.is_closed:
+                raise self._impl._closing_reason
+            if not waiters or any(waiter() for waiter in waiters):
+                return
+
+            self.connection.process_data_events(0.01)
+
+    def _rpc(self, function, *args, **kwargs):
+        result = []
+        function(*args, callback=result.append, **kwargs)
+        self._flush_output(lambda: bool(result))
+        return result[0]
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        self._impl.close(reply_code, reply_text)
+        self.connection.process_data_events(0)
+
+    def confirm_delivery(self):
+        def on_confirm(frame):
+            self._confirms.append(frame.method)
+
+        def on_return(channel, method, properties, body):
+            self._returned.append(ReturnedMessage(method, properties, body))
+
+        self._rpc(self._impl.confirm_delivery, on_confirm)
+        self._impl.add_on_return_callback(on_return)
+        self._delivery_confirmation = True
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False):
+        self._confirms = []
+        self._returned = []
+        self._impl.basic_publish(exchange, routing_key, body,
+                                 properties=properties, mandatory=mandatory)
+        if not self._delivery_confirmation:
+            self._flush_output()
+            return
+
+        self._flush_output(lambda: bool(self._confirms))
+        if isinstance(self._confirms[0], Basic.Nack):
+            raise NackError(self._returned)
+        if self._returned:
+            raise UnroutableError(self._returned)
+
+    def exchange_declare(self, exchange, exchange_type='direct',
+                         passive=False, durable=False, auto_delete=False,
+                         internal=False, arguments=None):
+        return self._rpc(self._impl.exchange_declare, exchange,
+                         exchange_type=exchange_type, passive=passive)
+
+    def queue_declare(self, queue, passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None):
+        return self._rpc(self._impl.queue_declare, queue, passive=passive,
+                         durable=durable, arguments=arguments)
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        return self._rpc(self._impl.queue_bind, queue, exchange,
+                         routing_key=routing_key)
+
+    def queue_purge(self, queue):
+        return self._rpc(self._impl.queue_purge, queue)
+
+    def queue_delete(self, queue, if_unused=False, if_empty=False):
+        return self._rpc(self._impl.queue_delete, queue)
+
+    def basic_get(self, queue, auto_ack=False):
+        result = []
+        self._impl.basic_get(
+            queue, lambda *args: result.append(args[1:]), auto_ack=auto_ack)
+        self._flush_output(lambda: bool(result))
+        return result[0]
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._impl.basic_ack(delivery_tag, multiple)
+        self._flush_output()
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._impl.basic_nack(delivery_tag, multiple, requeue)
+        self._flush_output()
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        self._impl.basic_reject(delivery_tag, requeue)
+        self._flush_output()
+
+
+class MemoryBlockingConnection(MemoryConnection):
+    """Equivalent of ``pika.BlockingConnection``"""
+
+    def __init__(self, url):
+        super(MemoryBlockingConnection, self).__init__(url)
+        self.broker.connect(self)
+        self._state = 'open'
+
+    def channel(self, channel_number=None):
+        channel = MemoryBlockingChannel(self._open_channel(), self)
+        return channel
+
+    def process_data_events(self, time_limit=0):
+        """Run the callbacks scheduled by the broker"""
+        if self.ioloop.process_events(time_limit):
+            while self.ioloop.process_events(0):
+                pass
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if self.is_closed:
+            raise ConnectionWrongStateError('Connection is closed.')
+
+        self._close(ConnectionClosedByClient(reply_code, reply_text))
@@ -0,0 +1,100 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import math
+import time
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class AdaptivePrefetch:
+    """Compute the prefetch of a consumer from the latency of the handlers
+    and the rate of the acks
+
+    ::
+
+        adaptive = AdaptivePrefetch(initial=10, maximum=1000)
+        ...
+        prefetch = adaptive.record(handler_duration)
+        if prefetch is not None:
+            # consume again with the new prefetch
+            channel.basic_cancel(consumer_tag)
+            channel.basic_qos(prefetch_count=prefetch)
+            consumer_tag = channel.basic_consume(queue, on_message)
+
+    The values are evaluated once by ``interval`` seconds:
+
+    * when the handlers are idle more than ``idle_ratio`` of the time, the
+      worker waits the deliveries of the broker, the prefetch is doubled
+    * the prefetch is lowered when the buffered messages need more than
+      ``buffer_time`` seconds to be handled, the messages prefetched by one
+      worker are not given to the others
+
+    :param initial: prefetch at the start
+    :param maximum: the prefetch is never upper than this value
+    :param minimum: the prefetch is never lower than this value
+    """
+
+    interval = 1.
+    """Seconds between two evaluations of the prefetch"""
+
+    idle_ratio = 0.1
+    """Ratio of idle time of the handlers over which the prefetch grows"""
+
+    buffer_time = 1.
+    """Maximum seconds of work kept in the prefetched messages"""
+
+    def __init__(self, initial=1, maximum=1000, minimum=1):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.prefetch = min(max(initial, self.minimum), self.maximum)
+        self.reset()
+
+    def reset(self):
+        self._start = time.perf_counter()
+        self._count = 0
+        self._busy = 0.
+
+    def record(self, duration, count=1):
+        """Record the handling of messages
+
+        :param duration: seconds spent by the handler
+        :param count: number of acked messages
+        :rtype: the new prefetch, None if it does not change
+        """
+        self._count += count
+        self._busy += duration
+        elapsed = time.perf_counter() - self._start
+        if elapsed < self.interval:
+            return None
+
+        prefetch = self.compute(elapsed)
+        if prefetch != self.prefetch:
+            logger.debug(
+                'Adapt prefetch %d -> %d (%d acks in %.3fs, busy %.3fs)',
+                self.prefetch, prefetch, self._count, elapsed, self._busy)
+
+        self.reset()
+        if prefetch == self.prefetch:
+            return None
+
+        self.prefetch = prefetch
+        return prefetch
+
+    def compute(self, elapsed):
+        latency = self._busy / self._count if self._count else 0
+        upper = self.maximum
+        if latency:
+            upper = min(upper, max(
+                self.minimum, math.floor(self.buffer_time / latency)))
+
+        prefetch = self.prefetch
+        if self._busy < elapsed * (1 - self.idle_ratio):
+            prefetch *= 2
+
+        return max(min(prefetch, upper), self.minimum)
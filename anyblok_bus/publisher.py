@@ -0,0 +1,707 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import atexit
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from queue import Queue, Empty, Full
+from uuid import uuid4
+from anyblok.config import Configuration
+from anyblok_bus.bloks.bus.exceptions import PublishException
+from anyblok_bus.connection import (
+    get_blocking_connection, get_select_connection)
+from logging import getLogger
+import pika
+from pika import BasicProperties
+from pika.exceptions import AMQPError, NackError, UnroutableError
+from pika.spec import Basic
+
+logger = getLogger(__name__)
+
+
+def pop_confirmed(pending, method):
+    """Remove and return the entries confirmed by a Basic.Ack or a
+    Basic.Nack from the pending entries ordered by delivery tag
+
+    :param pending: OrderedDict {delivery tag: entry}
+    :param method: pika.spec.Basic.Ack or pika.spec.Basic.Nack
+    :rtype: list of the entries
+    """
+    if not method.multiple:
+        entry = pending.pop(method.delivery_tag, None)
+        return [] if entry is None else [entry]
+
+    entries = []
+    while pending:
+        tag = next(iter(pending))
+        if tag > method.delivery_tag:
+            break
+
+        entries.append(pending.pop(tag))
+
+    return entries
+
+
+def get_pika_version(version=None):
+    """Return the version of pika as a tuple (major, minor)"""
+    numbers = re.findall(r'\d+', version or pika.__version__)
+    return tuple(int(number) for number in numbers[:2])
+
+
+class BlockingChannelAdapter:
+    """Asynchronous channel wrapped by a ``pika.BlockingChannel``
+
+    The private api of the blocking channel (``_impl``, ``_flush_output``)
+    is only used through this adapter, for the versions of pika where it is
+    known, ``get`` returns None for the other ones.
+
+    :param channel: the pika.BlockingChannel
+    """
+
+    min_version = (1, 0)
+    max_version = (2, 0)
+    """The private api is known from min_version, until max_version
+    excluded"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.impl = channel._impl
+
+    @classmethod
+    def is_supported(cls, channel, version=None):
+        return (
+            cls.min_version <= get_pika_version(version) < cls.max_version
+            and hasattr(channel, '_impl') and hasattr(channel, '_flush_output')
+        )
+
+    @classmethod
+    def get(cls, channel):
+        """Return the adapter of the channel or None if the version of pika
+        is not supported"""
+        if cls.is_supported(channel):
+            return cls(channel)
+
+        logger.warning('The batch confirms are not supported with pika %s, '
+                       'the confirms are waited after each message',
+                       pika.__version__)
+        return None
+
+    def confirm_delivery(self, on_confirm, on_return):
+        self.impl.add_on_return_callback(on_return)
+        selected = []
+        self.impl.confirm_delivery(
+            ack_nack_callback=on_confirm,
+            callback=lambda frame: selected.append(frame))
+        self.process_until(lambda: bool(selected))
+
+    def basic_publish(self, *args, **kwargs):
+        """Publish without waiting the confirm"""
+        self.impl.basic_publish(*args, **kwargs)
+
+    def process_until(self, condition):
+        """Process the frames of the connection until the condition is
+        True"""
+        self.channel._flush_output(condition)
+
+
+class BatchChannel:
+    """Channel which publishes the messages without waiting and waits the
+    publisher confirms once for the whole batch
+
+    The blocking channel of pika waits the confirm after each message, so the
+    messages are published on the asynchronous channel which is wrapped by
+    the blocking channel (``BlockingChannelAdapter``) and the confirms are
+    tracked by delivery tag. With an unknown version of pika the confirms
+    are waited message by message.
+
+    :param connection: the pika.BlockingConnection
+    """
+
+    window = 10000
+    """Maximum number of unconfirmed messages, the publication waits the
+    confirms of the broker when it is reached"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.channel = connection.channel()
+        self._adapter = BlockingChannelAdapter.get(self.channel)
+        self._delivery_tag = 0
+        self._pending = OrderedDict()
+        self._message_ids = {}
+        self._unroutable = []
+        self._nacked = []
+        if self._adapter is None:
+            self.channel.confirm_delivery()
+        else:
+            self._adapter.confirm_delivery(self._on_confirm, self._on_return)
+
+    @property
+    def is_open(self):
+        return self.channel.is_open
+
+    def close(self):
+        try:
+            if self.channel.is_open:
+                self.channel.close()
+        except AMQPError:
+            pass
+
+    def _on_confirm(self, frame):
+        nack = isinstance(frame.method, Basic.Nack)
+        for index, message, message_id in pop_confirmed(
+            self._pending, frame.method
+        ):
+            self._message_ids.pop(message_id, None)
+            if nack:
+                self._nacked.append((index, message))
+
+    def _on_return(self, channel, method, properties, body):
+        tag = self._message_ids.get(properties.message_id)
+        if tag is not None:
+            index, message, message_id = self._pending[tag]
+            self._unroutable.append((index, message))
+
+    def publish(self, exchange, messages, encode=None):
+        """Publish the messages and wait the confirm of all of them
+
+        The messages are published as mandatory, a message without
+        ``message_id`` get one to match the message returned by the broker.
+        The messages are consumed one by one from the iterable, only the
+        unconfirmed ones are kept.
+
+        :param exchange: name of the exchange
+        :param messages: iterable of ``(routing_key, data, contenttype)`` or
+                         ``(routing_key, data, contenttype, properties)``
+                         where properties is a dict of extra
+                         ``pika.BasicProperties`` arguments
+        :param encode: callable which returns the published message from
+                       the message of the iterable, at its publication
+        :rtype: tuple (number of messages, unroutable, nacked), unroutable
+                and nacked are lists of ``(index, message)`` with the
+                messages of the iterable
+        """
+        self._unroutable = []
+        self._nacked = []
+        count = 0
+        try:
+            for index, message in enumerate(messages):
+                encoded = message if encode is None else encode(message)
+                routing_key, data, contenttype = encoded[:3]
+                properties = dict(content_type=contenttype, delivery_mode=1)
+                if len(encoded) > 3:
+                    properties.update(encoded[3])
+
+                if not properties.get('message_id'):
+                    properties['message_id'] = uuid4().hex
+
+                self._publish(exchange, index, message, routing_key, data,
+                              properties)
+                count += 1
+
+            if self._adapter is not None:
+                self._adapter.process_until(lambda: not self._pending)
+        except BaseException:
+            # the confirms of this batch could be mixed with the next one
+            self.close()
+            raise
+
+        return count, self._unroutable, self._nacked
+
+    def _publish(self, exchange, index, message, routing_key, data,
+                 properties):
+        if self._adapter is None:
+            try:
+                self.channel.basic_publish(
+                    exchange, routing_key, data,
+                    properties=BasicProperties(**properties), mandatory=True)
+            except UnroutableError:
+                self._unroutable.append((index, message))
+            except NackError:
+                self._nacked.append((index, message))
+
+            return
+
+        self._adapter.basic_publish(
+            exchange, routing_key, data,
+            properties=BasicProperties(**properties), mandatory=True)
+        self._delivery_tag += 1
+        self._pending[self._delivery_tag] = (
+            index, message, properties['message_id'])
+        self._message_ids[properties['message_id']] = self._delivery_tag
+        if len(self._pending) >= self.window:
+            self._adapter.process_until(
+                lambda: len(self._pending) < self.window)
+
+
+class AsyncPublisher(threading.Thread):
+    """Background thread which publishes the messages of a bounded queue
+    with an asynchronous connection
+
+    ::
+
+        future = publisher.publish(exchange, routing_key, data, contenttype)
+        future.result()  # wait the confirm of rabbitmq
+
+    The publisher confirms are pipelined, the future is resolved when
+    rabbitmq confirms the message (``multiple`` acks included) and fails
+    with a ``PublishException`` if the message is nacked, unroutable, not
+    confirmed after ``confirm_timeout`` seconds or if the connection is
+    lost before the confirm. At most ``window`` messages wait their
+    confirm, the next ones stay in the queue, so a full queue refuses the
+    new messages while the broker does not confirm. The thread reconnects
+    itself, the messages still in the queue are published on the new
+    connection.
+
+    :param url: url of the rabbitmq server
+    :param queue_size: maximum number of messages waiting in the queue
+    """
+
+    reconnect_delay = 1
+    window = 10000
+    """Maximum number of unconfirmed messages"""
+    confirm_timeout = 30
+    """Seconds before the failure of an unconfirmed message"""
+    connection_failed = False
+    """True while the connection to the url can not be opened"""
+
+    def __init__(self, url, queue_size=0):
+        super(AsyncPublisher, self).__init__(
+            name='anyblok-bus-publisher', daemon=True)
+        self.url = url
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._stopping = False
+        self._connection = None
+        self._channel = None
+        self._delivery_tag = 0
+        self._pending = OrderedDict()
+        self._message_ids = {}
+        self._timer = None
+
+    def publish(self, exchange, routing_key, data, contenttype,
+                properties=None):
+        """Put the message in the queue without waiting
+
+        :param exchange: name of the exchange
+        :param routing_key: name of the routing key
+        :param data: str or bytes to send through rabbitmq
+        :param contenttype: the mimestype of the data
+        :param properties: dict of extra ``pika.BasicProperties`` arguments
+        :rtype: concurrent.futures.Future
+        :exception: PublishException if the queue is full
+        """
+        properties = dict(properties or {})
+        properties.setdefault('content_type', contenttype)
+        properties.setdefault('delivery_mode', 1)
+        if not properties.get('message_id'):
+            properties['message_id'] = uuid4().hex
+
+        future = Future()
+        if self._stopping:
+            raise PublishException("The publisher is stopped")
+
+        try:
+            self._queue.put_nowait(
+                (future, exchange, routing_key, data, properties))
+        except Full:
+            raise PublishException("The publisher queue is full")
+
+        self._wakeup()
+        return future
+
+    def _wakeup(self):
+        with self._lock:
+            if self._scheduled or self._connection is None:
+                return
+
+            self._scheduled = True
+
+        self._connection.ioloop.add_callback_threadsafe(self._drain)
+
+    def run(self):
+        while not self._stopping:
+            self._connection = get_select_connection(
+                self.url,
+                on_open_callback=self.on_connection_open,
+                on_open_error_callback=self.on_connection_open_error,
+                on_close_callback=self.on_connection_closed)
+            self._connection.ioloop.start()
+            self._fail_pending("Connection lost before the confirm")
+            if not self._stopping:
+                time.sleep(self.reconnect_delay)
+
+        while not self._queue.empty():
+            future = self._queue.get_nowait()[0]
+            if future.set_running_or_notify_cancel():
+                future.set_exception(
+                    PublishException("The publisher is stopped"))
+
+    def on_connection_open(self, connection):
+        self.connection_failed = False
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_open_error(self, connection, err):
+        logger.error('Publisher connection open failed: %s', err)
+        self.connection_failed = True
+        connection.ioloop.stop()
+
+    def on_connection_closed(self, connection, reason):
+        self._channel = None
+        self._timer = None  # the timers are forgotten with the ioloop
+        if not self._stopping:
+            logger.warning('Publisher connection closed: %s', reason)
+
+        connection.ioloop.stop()
+
+    def on_channel_open(self, channel):
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.add_on_return_callback(self.on_return)
+        channel.confirm_delivery(
+            ack_nack_callback=self.on_confirm,
+            callback=lambda frame: self.on_confirm_selected(channel))
+
+    def on_channel_closed(self, channel, reason):
+        logger.warning('Publisher channel %i was closed: %s', channel, reason)
+        self._channel = None
+        self.close_connection()
+
+    def on_confirm_selected(self, channel):
+        self._channel = channel
+        self._delivery_tag = 0
+        with self._lock:
+            self._scheduled = False
+
+        if self._timer is None:
+            self._timer = self._connection.ioloop.call_later(
+                1, self._check_timeouts)
+
+        self._drain()
+
+    def _check_timeouts(self):
+        """Fail the futures of the messages not confirmed in time, they are
+        forgotten, their late confirm is ignored"""
+        now = time.monotonic()
+        while self._pending:
+            tag = next(iter(self._pending))
+            future, message_id, returned, deadline = self._pending[tag]
+            if deadline > now:
+                break
+
+            del self._pending[tag]
+            self._message_ids.pop(message_id, None)
+            future.set_exception(
+                PublishException("Message not confirmed after %r seconds" % (
+                    self.confirm_timeout)))
+
+        self._timer = None
+        if self._channel is not None:
+            self._timer = self._connection.ioloop.call_later(
+                1, self._check_timeouts)
+            self._drain()
+
+    def on_confirm(self, frame):
+        nack = isinstance(frame.method, Basic.Nack)
+        for future, message_id, returned, deadline in pop_confirmed(
+            self._pending, frame.method
+        ):
+            self._message_ids.pop(message_id, None)
+            if nack:
+                future.set_exception(PublishException("Message nacked"))
+            elif returned:
+                future.set_exception(
+                    PublishException("Message cannot be published"))
+            else:
+                future.set_result(True)
+
+        self._drain()
+
+    def on_return(self, channel, method, properties, body):
+        tag = self._message_ids.get(properties.message_id)
+        if tag is not None:
+            future, message_id, returned, deadline = self._pending[tag]
+            self._pending[tag] = (future, message_id, True, deadline)
+
+    def _drain(self):
+        with self._lock:
+            self._scheduled = False
+
+        while (
+            self._channel is not None and self._channel.is_open and
+            len(self._pending) < self.window
+        ):
+            try:
+                future, exchange, routing_key, data, properties = (
+                    self._queue.get_nowait())
+            except Empty:
+                break
+
+            if not future.set_running_or_notify_cancel():
+                continue  # cancelled by the caller
+
+            self._channel.basic_publish(
+                exchange, routing_key, data,
+                properties=BasicProperties(**properties), mandatory=True)
+            self._delivery_tag += 1
+            self._pending[self._delivery_tag] = (
+                future, properties['message_id'], False,
+                time.monotonic() + self.confirm_timeout)
+            self._message_ids[properties['message_id']] = self._delivery_tag
+
+        if self._stopping and not self._pending and self._queue.empty():
+            self.close_connection()
+
+    def close_connection(self):
+        if not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
+
+    def _fail_pending(self, reason):
+        while self._pending:
+            tag, (future, message_id, returned, deadline) = (
+                self._pending.popitem(last=False))
+            future.set_exception(PublishException(reason))
+
+        self._message_ids.clear()
+
+    def stop(self, timeout=None):
+        """Publish the messages of the queue, wait their confirms and close
+        the connection
+
+        :param timeout: maximum seconds to wait the end of the thread
+        """
+        self._stopping = True
+        if self._connection is not None:
+            self._connection.ioloop.add_callback_threadsafe(self._drain)
+
+        self.join(timeout)
+        if self.is_alive() and self._connection is not None:
+            # the unconfirmed messages are failed when the ioloop stops
+            self._connection.ioloop.add_callback_threadsafe(
+                self.close_connection)
+            self.join(timeout)
+
+
+class PublisherConnection:
+    """Connection to rabbitmq kept alive between two publications, with a
+    channel already in confirm mode
+
+    :param url: url of the rabbitmq server
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.connection = get_blocking_connection(url)
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
+        self._batch_channel = None
+
+    @property
+    def batch_channel(self):
+        """Channel to publish many messages with one wait of the confirms,
+        opened on the first use"""
+        if self._batch_channel is None or not self._batch_channel.is_open:
+            self._batch_channel = BatchChannel(self.connection)
+
+        return self._batch_channel
+
+    def is_usable(self):
+        """Return True if the connection and the channel can still be used
+
+        The pending frames are processed without waiting, this services the
+        heartbeats and detects a connection lost while it was idle in the pool
+        """
+        if self.connection.is_closed or self.channel.is_closed:
+            return False
+
+        try:
+            self.connection.process_data_events(time_limit=0)
+        except AMQPError as e:
+            logger.info('Pooled publisher connection on %r is lost: %r',
+                        self.url, e)
+            return False
+
+        return self.connection.is_open and self.channel.is_open
+
+    def close(self):
+        """Close the channel and the connection, errors are ignored because
+        the connection may be already lost"""
+        for item in (self.channel, self.connection):
+            try:
+                if item.is_open:
+                    item.close()
+            except AMQPError:
+                pass
+
+
+class PublisherPool:
+    """Per process pool of the publisher connections, by url
+
+    ::
+
+        with publisher_pool.channel(url) as channel:
+            channel.basic_publish(...)
+
+    The pool is fork safe: the connections opened by the parent process are
+    forgotten (never used nor closed) by the child process.
+
+    :param size: number of idle connections kept by url, by default the
+                 value of the configuration ``bus_publisher_pool_size``,
+                 0 means that the connection is closed after each use
+    """
+
+    profile_url_ttl = 60
+    """Seconds during which the url of a profile is cached, the profiles
+    changed by the other processes are read again after this delay"""
+
+    def __init__(self, size=None):
+        self.size = size
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._async_publishers = {}
+        self._profile_urls = {}
+
+    def get_size(self):
+        if self.size is not None:
+            return self.size
+
+        return Configuration.get('bus_publisher_pool_size', 4) or 0
+
+    def _check_pid(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # the sockets are shared with the parent process
+            self._pid = pid
+            self._lock = threading.Lock()
+            self._idle = {}
+            self._async_publishers = {}  # the threads are not forked
+
+    def acquire(self, url):
+        """Return an usable publisher connection for the url, taken from the
+        pool if possible"""
+        self._check_pid()
+        while True:
+            with self._lock:
+                idle = self._idle.get(url)
+                publisher = idle.pop() if idle else None
+
+            if publisher is None:
+                logger.debug('Open a new publisher connection on %r', url)
+                return PublisherConnection(url)
+
+            if publisher.is_usable():
+                return publisher
+
+            publisher.close()
+
+    def release(self, publisher):
+        """Give back the publisher connection to the pool, it is closed if
+        it can not be used anymore or if the pool is full"""
+        self._check_pid()
+        if publisher.connection.is_open and publisher.channel.is_open:
+            with self._lock:
+                idle = self._idle.setdefault(publisher.url, [])
+                if len(idle) < self.get_size():
+                    idle.append(publisher)
+                    return
+
+        publisher.close()
+
+    @contextmanager
+    def connection(self, url):
+        """Context manager which gives a publisher connection of the pool
+
+        :param url: url of the rabbitmq server
+        """
+        publisher = self.acquire(url)
+        pid = self._pid
+        try:
+            yield publisher
+        finally:
+            if pid == os.getpid():
+                self.release(publisher)
+
+    @contextmanager
+    def channel(self, url):
+        """Context manager which gives a channel in confirm mode
+
+        :param url: url of the rabbitmq server
+        """
+        with self.connection(url) as publisher:
+            yield publisher.channel
+
+    @contextmanager
+    def batch_channel(self, url):
+        """Context manager which gives a ``BatchChannel``
+
+        :param url: url of the rabbitmq server
+        """
+        with self.connection(url) as publisher:
+            yield publisher.batch_channel
+
+    def get_profile_url(self, name):
+        """Return the cached url of the profile, None if it is not cached
+        or if it is cached for more than ``profile_url_ttl`` seconds"""
+        url, expiry = self._profile_urls.get(name, (None, None))
+        if url is not None and expiry <= time.monotonic():
+            self._profile_urls.pop(name, None)
+            return None
+
+        return url
+
+    def set_profile_url(self, name, url):
+        self._profile_urls[name] = (
+            url, time.monotonic() + self.profile_url_ttl)
+
+    def forget_profile(self, name):
+        """Invalidate the cached url of the profile, called when the profile
+        is updated or deleted, and when the publication on its url fails"""
+        self._profile_urls.pop(name, None)
+
+    def async_publisher(self, url):
+        """Return the running ``AsyncPublisher`` of this process for the url
+
+        :param url: url of the rabbitmq server
+        """
+        self._check_pid()
+        with self._lock:
+            publisher = self._async_publishers.get(url)
+            if publisher is None or not publisher.is_alive():
+                publisher = AsyncPublisher(
+                    url, queue_size=Configuration.get(
+                        'bus_async_queue_size', 10000) or 0)
+                publisher.start()
+                self._async_publishers[url] = publisher
+
+        return publisher
+
+    def clear(self, timeout=None):
+        """Close all the idle connections of the pool and stop the
+        asynchronous publishers
+
+        :param timeout: maximum seconds to wait each asynchronous publisher
+        """
+        self._check_pid()
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            publishers, self._async_publishers = self._async_publishers, {}
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+        for publisher in publishers.values():
+            publisher.stop(timeout)
+
+
+publisher_pool = PublisherPool()
+atexit.register(publisher_pool.clear, timeout=5)
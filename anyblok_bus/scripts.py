@@ -5,6 +5,7 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+import json
 import os
 import signal
 import time
@@ -25,6 +26,18 @@ Configuration.add_application_properties(
     description='Bus for AnyBlok',
 )
 
+Configuration.add_application_properties(
+    'bus_relay', ['logging', 'bus'],
+    prog='Bus outbox relay for AnyBlok, version %r' % version,
+    description='Publish the messages of the outbox of AnyBlok / Bus',
+)
+
+Configuration.add_application_properties(
+    'bus_replay', ['logging', 'bus'],
+    prog='Bus replay for AnyBlok, version %r' % version,
+    description='Consume again the messages stored in Model.Bus.Message',
+)
+
 
 def bus_worker_process(logging_fd, consumers):
     """consume worker to process messages and execute the actor"""
@@ -131,3 +144,166 @@ def anyblok_bus():  # noqa
         pipe.close()
 
     return retcode
+
+
+def anyblok_bus_relay():
+    """Publish the messages inserted in the outbox by the committed
+    transactions
+    """
+    registry = start('bus_relay', loadwithoutmigration=True)
+    if not registry:
+        exit(1)
+
+    batch_size = Configuration.get('bus_relay_batch_size', 1000)
+    interval = Configuration.get('bus_relay_interval', 1)
+
+    def termhandler(signum, frame):
+        nonlocal running
+        logger.info("Stopping the relay...")
+        running = False
+
+    signal.signal(signal.SIGINT, termhandler)
+    signal.signal(signal.SIGTERM, termhandler)
+
+    running = True
+    logger.info("Relay is ready for action.")
+    while running:
+        try:
+            count = registry.Bus.Outbox.relay(batch_size=batch_size)
+            registry.commit()
+        except Exception:
+            logger.exception("Failed to relay the outbox")
+            registry.rollback()
+            count = 0
+
+        if count < batch_size:
+            time.sleep(interval)
+
+    registry.close()
+
+
+def split_partitions(partitions, processes):
+    """Split the partitions between the processes, each partition is given
+    to the process with the less messages, the biggest partitions first
+
+    :param partitions: list of ``(value, number of messages)``
+    :param processes: maximum number of processes
+    :rtype: list of the values of the partitions by process
+    """
+    loads = [[0, index, []] for index in range(max(processes, 1))]
+    for value, count in sorted(partitions, key=lambda partition: -partition[1]):
+        load = min(loads)
+        load[0] += count
+        load[2].append(value)
+
+    return [load[2] for load in loads if load[2]]
+
+
+def bus_replay_process(report_fd, partition, values):
+    """Replay the messages of the partitions, the number of consumed
+    messages and of messages in error by partition are written in the
+    report pipe"""
+    db_name = Configuration.get('db_name')
+    batch_size = Configuration.get('bus_replay_batch_size', 1000)
+    checkpoint = Configuration.get('bus_replay_checkpoint')
+    retcode = 0
+    with os.fdopen(report_fd, "w") as report:
+        registry = RegistryManager.get(db_name, loadwithoutmigration=True)
+        for value in values:
+            start_time = time.monotonic()
+            try:
+                consumed, errors = registry.Bus.Message.consume_all(
+                    batch_size=batch_size, commit=True,
+                    checkpoint=(
+                        '%s:%s' % (checkpoint, value) if checkpoint else None),
+                    **{partition: value})
+            except Exception:
+                logger.exception("Failed to replay the partition %r", value)
+                registry.rollback()
+                retcode = 1
+                continue
+
+            duration = time.monotonic() - start_time
+            logger.info("Partition %r replayed: %d messages (%d in error) "
+                        "in %.1f seconds", value, consumed + errors, errors,
+                        duration)
+            report.write(json.dumps([value, consumed, errors]) + '\n')
+
+        registry.close()
+
+    return retcode
+
+
+def wait_replay_processes(pipes, pids):
+    """Read the reports of the replay processes and wait their end
+
+    :rtype: the number of consumed messages, of messages in error and the
+            return code
+    """
+    consumed = errors = 0
+    for pipe in pipes:
+        for line in pipe:
+            value, partition_consumed, partition_errors = json.loads(line)
+            consumed += partition_consumed
+            errors += partition_errors
+
+        pipe.close()
+
+    retcode = 0
+    for pid in pids:
+        pid, rc = os.waitpid(pid, 0)
+        # a process killed by a signal has no exit status
+        retcode = max(retcode, rc >> 8, 1 if rc & 0x7f else 0)
+
+    return consumed, errors, retcode
+
+
+def anyblok_bus_replay():
+    """Consume again the messages stored in Model.Bus.Message, the
+    partitions are replayed concurrently by processes, the messages of one
+    partition are replayed in order
+    """
+    registry = start('bus_replay', loadwithoutmigration=True)
+    if not registry:
+        exit(1)
+
+    processes = Configuration.get('bus_replay_processes', 1)
+    partition = Configuration.get('bus_replay_partition', 'queue')
+    partitions = registry.Bus.Message.get_replay_partitions(partition)
+    registry.close()  # close the registry to recreate it in each process
+
+    start_time = time.monotonic()
+    replay_pipes = []
+    replay_processes = []
+    for values in split_partitions(partitions, processes):
+        logger.debug('Replay the partitions %r', values)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid != 0:
+            os.close(write_fd)
+            replay_pipes.append(os.fdopen(read_fd))
+            replay_processes.append(pid)
+            continue
+
+        os.close(read_fd)
+        return bus_replay_process(write_fd, partition, values)
+
+    def sighandler(signum, frame):
+        logger.info("Stopping the replay processes...")
+        for pid in replay_processes:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                logger.warning("Failed to stop pid %d.", pid)
+
+    signal.signal(signal.SIGINT, sighandler)
+    signal.signal(signal.SIGTERM, sighandler)
+
+    consumed, errors, retcode = wait_replay_processes(
+        replay_pipes, replay_processes)
+    duration = time.monotonic() - start_time
+    logger.info("%d messages replayed (%d in error) by %d processes in %.1f "
+                "seconds, %.1f msg/s", consumed + errors, errors,
+                len(replay_processes), duration,
+                (consumed + errors) / duration if duration else 0)
+    return retcode
@@ -0,0 +1,271 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Benchmarks of the consume path on the in memory broker
+
+They are skipped unless the environment variable ``ANYBLOK_BUS_BENCHMARK``
+is set, the minimal throughput (messages by second) can be given by
+``ANYBLOK_BUS_BENCHMARK_MIN_RATE``::
+
+    ANYBLOK_BUS_BENCHMARK=1 py.test anyblok_bus/tests/test_benchmark.py -s
+"""
+import os
+from json import dumps
+from time import sleep, perf_counter
+from threading import Thread
+from unittest import skipUnless
+from anyblok.tests.testcase import DBTestCase
+from anyblok.config import Configuration
+from anyblok.column import Integer
+from anyblok import Declarations
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.worker import ReconnectingWorker, Worker
+from anyblok_bus.memory import MemoryBroker
+
+memory_url = 'memory://benchmark'
+benchmark = skipUnless(os.environ.get('ANYBLOK_BUS_BENCHMARK'),
+                       'ANYBLOK_BUS_BENCHMARK is not set')
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class BenchmarkTestCase(DBTestCase):
+
+    messages = int(os.environ.get('ANYBLOK_BUS_BENCHMARK_MESSAGES', 2000))
+    min_rate = float(os.environ.get('ANYBLOK_BUS_BENCHMARK_MIN_RATE', 0))
+
+    @classmethod
+    def init_configuration_manager(cls, **env):
+        bus_profile = Configuration.get('bus_profile') or 'unittest'
+        env.update(dict(bus_profile=bus_profile))
+        super(BenchmarkTestCase, cls).init_configuration_manager(**env)
+
+    def start_worker(self, registry):
+        bus_profile = Configuration.get('bus_profile')
+        registry.Bus.Profile.insert(name=bus_profile, url=memory_url)
+        worker = Worker(registry, bus_profile,
+                        registry.Bus.get_consumers()[0][1],
+                        withautocommit=False)
+        thread = Thread(target=worker.start)
+        thread.start()
+        while not worker.is_ready():
+            sleep(0.01)
+
+        return worker, thread
+
+    def get_registry(self, add_in_registry):
+        MemoryBroker.reset_all()
+        broker = MemoryBroker.get(memory_url)
+        broker.queue_declare('benchmark_queue')
+        return self.init_registry_with_bloks(('bus',), add_in_registry)
+
+
+@benchmark
+class TestBenchmarkConsume(BenchmarkTestCase):
+
+    def add_in_registry(self):
+
+        latencies = self.latencies = []
+
+        @Declarations.register(Declarations.Model)
+        class Test:
+            id = Integer(primary_key=True)
+            number = Integer()
+
+            @bus_consumer(queue_name='benchmark_queue', deserialize=True)
+            def decorated_method(cls, body=None):
+                latencies.append(perf_counter() - body['sent'])
+                cls.insert(number=body['number'])
+                return MessageStatus.ACK
+
+    def report(self, name, elapsed):
+        rate = self.messages / elapsed
+        print('\n%s: %d messages in %.3fs, %.0f msg/s, latency p50=%.2fms '
+              'p99=%.2fms' % (
+                  name, self.messages, elapsed, rate,
+                  percentile(self.latencies, 50) * 1000,
+                  percentile(self.latencies, 99) * 1000))
+        self.assertGreaterEqual(rate, self.min_rate)
+
+    def test_consume_throughput(self):
+        registry = self.get_registry(self.add_in_registry)
+        worker, thread = self.start_worker(registry)
+        start = perf_counter()
+        registry.Bus.publish_many('', (
+            ('benchmark_queue',
+             dumps({'number': index, 'sent': perf_counter()}),
+             'application/json')
+            for index in range(self.messages)))
+        while len(self.latencies) < self.messages:
+            sleep(0.001)
+
+        elapsed = perf_counter() - start
+        worker.stop()
+        thread.join()
+        MemoryBroker.reset_all()
+        self.assertEqual(registry.Test.query().count(), self.messages)
+        self.report('consume', elapsed)
+
+
+@benchmark
+class TestBenchmarkDispatch(BenchmarkTestCase):
+    """Overhead of the worker and of the memory broker by message, the
+    consumer does nothing"""
+
+    def add_in_registry(self):
+
+        consumed = self.consumed = []
+
+        @Declarations.register(Declarations.Model)
+        class Test:
+            id = Integer(primary_key=True)
+
+            @bus_consumer(queue_name='benchmark_queue')
+            def decorated_method(cls, body=None):
+                consumed.append(None)
+                return MessageStatus.ACK
+
+    def test_noop_consumer_throughput(self):
+        registry = self.get_registry(self.add_in_registry)
+        registry.Bus.publish_many('', (
+            ('benchmark_queue', 'message', 'text/plain')
+            for index in range(self.messages)))
+        start = perf_counter()
+        worker, thread = self.start_worker(registry)
+        while len(self.consumed) < self.messages:
+            sleep(0.001)
+
+        elapsed = perf_counter() - start
+        worker.stop()
+        thread.join()
+        MemoryBroker.reset_all()
+        rate = self.messages / elapsed
+        print('\nno-op consumer: %d messages in %.3fs, %.0f msg/s, '
+              '%.1fus by message' % (
+                  self.messages, elapsed, rate, elapsed * 1e6 / self.messages))
+        self.assertGreaterEqual(rate, self.min_rate)
+
+
+@benchmark
+class TestBenchmarkReconnect(BenchmarkTestCase):
+    """Restart of the broker with many workers, the reconnections must be
+    spread by the jitter of the backoff"""
+
+    workers = int(os.environ.get('ANYBLOK_BUS_BENCHMARK_WORKERS', 20))
+    outage = 2
+
+    @classmethod
+    def init_configuration_manager(cls, **env):
+        env.update(dict(bus_reconnect_delay=0.05, bus_reconnect_max_delay=1))
+        super(TestBenchmarkReconnect, cls).init_configuration_manager(**env)
+
+    def add_in_registry(self):
+
+        @Declarations.register(Declarations.Model)
+        class Test:
+            id = Integer(primary_key=True)
+
+            @bus_consumer(queue_name='benchmark_queue')
+            def decorated_method(cls, body=None):
+                return MessageStatus.ACK
+
+    def test_reconnect_storm(self):
+        registry = self.get_registry(self.add_in_registry)
+        broker = MemoryBroker.get(memory_url)
+        bus_profile = Configuration.get('bus_profile')
+        registry.Bus.Profile.insert(name=bus_profile, url=memory_url)
+        consumers = registry.Bus.get_consumers()[0][1]
+        workers = [ReconnectingWorker(registry, bus_profile, consumers, False)
+                   for index in range(self.workers)]
+        threads = [Thread(target=worker.start) for worker in workers]
+        for thread in threads:
+            thread.start()
+
+        while not all(worker._consumer.is_ready() for worker in workers):
+            sleep(0.01)
+
+        broker.stop()
+        broker.connection_attempts = 0
+        sleep(self.outage)
+        broker.start()
+        restarted = perf_counter()
+        refused = broker.connection_attempts
+        reconnected = {}
+        while len(reconnected) < self.workers:
+            for index, worker in enumerate(workers):
+                if index not in reconnected and worker._consumer.is_ready():
+                    reconnected[index] = perf_counter() - restarted
+
+            sleep(0.001)
+
+        for worker in workers:
+            worker.stop()
+
+        for thread in threads:
+            thread.join()
+
+        MemoryBroker.reset_all()
+        delays = list(reconnected.values())
+        print('\nreconnect storm: %d workers, %d refused connections in '
+              '%ds, reconnected in p50=%.0fms p99=%.0fms' % (
+                  self.workers, refused, self.outage,
+                  percentile(delays, 50) * 1000,
+                  percentile(delays, 99) * 1000))
+        # without jitter all the workers retry at the same time
+        self.assertGreater(percentile(delays, 99) - min(delays), 0.05)
+
+
+@benchmark
+class TestBenchmarkReplay(BenchmarkTestCase):
+    """Keyset pagination of the replay on many stored messages, the chunks
+    must be read by the indexes whatever their position"""
+
+    stored = int(os.environ.get('ANYBLOK_BUS_BENCHMARK_STORED', 1000000))
+    queues = 10
+
+    def insert_stored_messages(self, registry):
+        Message = registry.Bus.Message
+        for offset in range(0, self.stored, 10000):
+            Message.insert_many([
+                Message.get_entry('queue_%d' % (index % self.queues),
+                                  'Model.Test', 'decorated_method', b'{}')
+                for index in range(offset, min(offset + 10000, self.stored))])
+
+    def read_chunks(self, registry, **filters):
+        Message = registry.Bus.Message
+        query = Message.get_replay_query(**filters)
+        latencies = []
+        start = perf_counter()
+        for position, messages in Message.iter_replay(query, 1000):
+            latencies.append(perf_counter() - start)
+            registry.expunge_all()
+            start = perf_counter()
+
+        return latencies
+
+    def test_replay_chunks(self):
+        registry = self.init_registry_with_bloks(('bus',), None)
+        self.insert_stored_messages(registry)
+        start = perf_counter()
+        partitions = registry.Bus.Message.get_replay_partitions()
+        print('\nreplay partitions of %d messages: %.3fs' % (
+            self.stored, perf_counter() - start))
+        self.assertEqual(len(partitions), self.queues)
+        for filters in ({}, {'queue': 'queue_0'}):
+            latencies = self.read_chunks(registry, **filters)
+            print('replay chunks %r: %d chunks of 1000 messages in %.1fs, '
+                  'p50=%.1fms p99=%.1fms last=%.1fms' % (
+                      filters, len(latencies), sum(latencies),
+                      percentile(latencies, 50) * 1000,
+                      percentile(latencies, 99) * 1000,
+                      latencies[-1] * 1000))
+            # the last chunk is read by the index, not after a sort
+            self.assertLess(latencies[-1], percentile(latencies, 50) * 10)
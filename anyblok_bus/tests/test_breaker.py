@@ -0,0 +1,51 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from unittest import TestCase
+from anyblok_bus.breaker import CircuitBreaker
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_open_after_consecutive_errors(self):
+        breaker = CircuitBreaker(errors=3)
+        self.assertIsNone(breaker.record(True))
+        self.assertIsNone(breaker.record(True))
+        self.assertIsNone(breaker.record(False))
+        self.assertIsNone(breaker.record(True))
+        self.assertIsNone(breaker.record(True))
+        self.assertEqual(breaker.record(True), CircuitBreaker.OPEN)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_open_on_error_rate(self):
+        breaker = CircuitBreaker(errors=0, error_rate=0.5, window=4)
+        self.assertIsNone(breaker.record(True))
+        self.assertIsNone(breaker.record(False))
+        self.assertIsNone(breaker.record(False))
+        self.assertIsNone(breaker.record(False))
+        # window: False, False, False, True
+        self.assertIsNone(breaker.record(True))
+        # window: False, False, True, True
+        self.assertEqual(breaker.record(True), CircuitBreaker.OPEN)
+
+    def test_ignore_results_when_open(self):
+        breaker = CircuitBreaker(errors=1)
+        self.assertEqual(breaker.record(True), CircuitBreaker.OPEN)
+        self.assertIsNone(breaker.record(False))
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_half_open_close(self):
+        breaker = CircuitBreaker(errors=1)
+        breaker.record(True)
+        breaker.half_open()
+        self.assertEqual(breaker.record(False), CircuitBreaker.CLOSED)
+        self.assertIsNone(breaker.record(False))
+
+    def test_half_open_open_again(self):
+        breaker = CircuitBreaker(errors=5)
+        breaker.half_open()
+        self.assertEqual(breaker.record(True), CircuitBreaker.OPEN)
@@ -0,0 +1,91 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from unittest import TestCase
+from anyblok_bus.codec import (
+    encode, decode, register_serializer, serializers, unknown_encodings,
+    CodecException)
+from json import dumps
+
+
+class TestCodec(TestCase):
+
+    def test_encode_str(self):
+        body, content_encoding = encode('{"a": 1}', 'application/json')
+        self.assertEqual(body, b'{"a": 1}')
+        self.assertIsNone(content_encoding)
+
+    def test_encode_bytes(self):
+        body, content_encoding = encode(b'\x00\x01', 'application/json')
+        self.assertEqual(body, b'\x00\x01')
+
+    def test_encode_json(self):
+        body, content_encoding = encode({'a': 1}, 'application/json')
+        self.assertEqual(body, dumps({'a': 1}).encode('utf-8'))
+
+    def test_encode_json_with_charset(self):
+        body, content_encoding = encode(
+            {'a': 1}, 'application/json; charset=utf-8')
+        self.assertEqual(body, dumps({'a': 1}).encode('utf-8'))
+
+    def test_encode_gzip(self):
+        data = {'a': 'x' * 10000}
+        body, content_encoding = encode(data, 'application/json', 'gzip')
+        self.assertEqual(content_encoding, 'gzip')
+        self.assertLess(len(body), 1000)
+        self.assertEqual(
+            decode(body, 'application/json', 'gzip', deserialized=True),
+            data)
+
+    def test_decode_text(self):
+        self.assertEqual(decode(b'{"a": 1}', 'application/json'), '{"a": 1}')
+
+    def test_decode_deserialized(self):
+        self.assertEqual(
+            decode(b'{"a": 1}', 'application/json', deserialized=True),
+            {'a': 1})
+
+    def test_decode_raw(self):
+        body = b'\x08\x96\x01'
+        self.assertIs(decode(body, 'application/x-protobuf', raw=True), body)
+
+    def test_decode_raw_gzip(self):
+        body, content_encoding = encode(b'\x08\x96\x01' * 1000,
+                                        'application/x-protobuf', 'gzip')
+        self.assertEqual(
+            decode(body, 'application/x-protobuf', 'gzip', raw=True),
+            b'\x08\x96\x01' * 1000)
+
+    def test_unknown_content_type(self):
+        with self.assertRaises(CodecException):
+            encode(object(), 'application/unknown')
+
+    def test_unknown_content_encoding(self):
+        with self.assertRaises(CodecException):
+            encode(b'{}', 'application/json', 'unknown')
+
+    def test_decode_charset_content_encoding(self):
+        for content_encoding in ('utf-8', 'UTF-8', 'binary'):
+            with self.assertLogs('anyblok_bus.codec', 'WARNING'):
+                unknown_encodings.discard(content_encoding)
+                self.assertEqual(
+                    decode(b'{"a": 1}', 'application/json',
+                           content_encoding=content_encoding,
+                           deserialized=True),
+                    {'a': 1})
+
+    def test_register_serializer(self):
+        register_serializer('application/x-test',
+                            lambda data: b'test', lambda body: 'test')
+        try:
+            body, content_encoding = encode(1, 'application/x-test')
+            self.assertEqual(body, b'test')
+            self.assertEqual(
+                decode(body, 'application/x-test', deserialized=True),
+                'test')
+        finally:
+            del serializers['application/x-test']
@@ -0,0 +1,29 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from anyblok_bus.config import get_env_flag
+
+
+class TestEnvFlag(TestCase):
+
+    def test_true_values(self):
+        for value in ('1', 'true', 'True', 'YES', ' yes '):
+            with patch.dict(os.environ, {'ANYBLOK_BUS_FLAG': value}):
+                self.assertTrue(get_env_flag('ANYBLOK_BUS_FLAG'), value)
+
+    def test_false_values(self):
+        for value in ('0', 'false', 'no', 'off', ''):
+            with patch.dict(os.environ, {'ANYBLOK_BUS_FLAG': value}):
+                self.assertFalse(get_env_flag('ANYBLOK_BUS_FLAG'), value)
+
+    def test_unset(self):
+        with patch.dict(os.environ):
+            os.environ.pop('ANYBLOK_BUS_FLAG', None)
+            self.assertFalse(get_env_flag('ANYBLOK_BUS_FLAG'))
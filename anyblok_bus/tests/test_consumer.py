@@ -85,6 +85,10 @@ class TestValidator(DBTestCase):
         with self.assertRaises(BusConfigurationException):
             self.init_registry(add_in_registry)
 
+    def test_decorator_raw_and_deserialize(self):
+        with self.assertRaises(BusConfigurationException):
+            bus_consumer(queue_name='test', raw=True, deserialize=True)
+
     def test_decorator_with_twice_the_same_name(self):
 
         def add_in_registry():
@@ -0,0 +1,59 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from unittest import TestCase
+from datetime import datetime, timedelta
+from anyblok.tests.testcase import DBTestCase
+from sqlalchemy.exc import IntegrityError
+from anyblok_bus.inbox import InboxCache
+
+
+class TestInboxCache(TestCase):
+
+    def test_least_recently_used(self):
+        cache = InboxCache(size=2)
+        cache.add(('queue', '1'))
+        cache.add(('queue', '2'))
+        self.assertIn(('queue', '1'), cache)
+        cache.add(('queue', '3'))
+        # 2 is the least recently used
+        self.assertNotIn(('queue', '2'), cache)
+        self.assertIn(('queue', '1'), cache)
+        self.assertIn(('queue', '3'), cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_without_cache(self):
+        cache = InboxCache(size=0)
+        cache.add(('queue', '1'))
+        self.assertNotIn(('queue', '1'), cache)
+
+    def test_one_cache_by_process(self):
+        self.assertIs(InboxCache.get(10), InboxCache.get(10))
+
+
+class TestInbox(DBTestCase):
+
+    def test_record_twice(self):
+        registry = self.init_registry_with_bloks(('bus',), None)
+        registry.Bus.Inbox.record('queue', 'id')
+        registry.Bus.Inbox.record('other queue', 'id')
+        savepoint = registry.begin_nested()
+        with self.assertRaises(IntegrityError):
+            registry.Bus.Inbox.record('queue', 'id')
+
+        savepoint.rollback()
+        self.assertEqual(registry.Bus.Inbox.query().count(), 2)
+
+    def test_purge(self):
+        registry = self.init_registry_with_bloks(('bus',), None)
+        registry.Bus.Inbox.insert(
+            queue='queue', message_id='old',
+            create_date=datetime.now() - timedelta(days=10))
+        registry.Bus.Inbox.record('queue', 'new')
+        self.assertEqual(registry.Bus.Inbox.purge(
+            datetime.now() - timedelta(days=1)), 1)
+        self.assertEqual(registry.Bus.Inbox.query().one().message_id, 'new')
@@ -0,0 +1,205 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from unittest import TestCase
+from json import dumps
+from threading import active_count
+from pika import BasicProperties
+from pika.exceptions import ChannelClosedByBroker, UnroutableError
+from anyblok_bus.connection import (
+    get_blocking_connection, get_select_connection)
+from anyblok_bus.memory import MemoryBroker
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, get_broker, is_settled, memory_url, wait_until)
+
+
+class TestMemoryBroker(TestCase):
+
+    def setUp(self):
+        self.broker = get_broker()
+        self.connection = get_blocking_connection(memory_url)
+        self.channel = self.connection.channel()
+
+    def tearDown(self):
+        if self.connection.is_open:
+            self.connection.close()
+
+        MemoryBroker.reset_all()
+
+    def test_publish_and_get(self):
+        self.channel.basic_publish('unittest_exchange', 'unittest', 'hello')
+        method, properties, body = self.channel.basic_get('unittest_queue')
+        self.assertEqual(body, b'hello')
+        self.assertEqual(method.routing_key, 'unittest')
+        self.channel.basic_ack(method.delivery_tag)
+        method, properties, body = self.channel.basic_get('unittest_queue')
+        self.assertIsNone(method)
+
+    def test_same_broker_by_url(self):
+        self.assertIs(MemoryBroker.get(memory_url + '/'), self.broker)
+        self.assertIsNot(MemoryBroker.get('memory://other'), self.broker)
+
+    def test_topic_and_fanout_routing(self):
+        self.broker.exchange_declare('topic', 'topic')
+        self.broker.exchange_declare('fanout', 'fanout')
+        self.broker.queue_declare('q1')
+        self.broker.queue_declare('q2')
+        self.broker.queue_bind('q1', 'topic', 'a.*.c')
+        self.broker.queue_bind('q2', 'topic', 'a.#')
+        self.broker.queue_bind('q1', 'fanout', 'whatever')
+        self.assertEqual(self.broker.route('topic', 'a.b.c'), ['q1', 'q2'])
+        self.assertEqual(self.broker.route('topic', 'a'), ['q2'])
+        self.assertEqual(self.broker.route('topic', 'b.b.c'), [])
+        self.assertEqual(self.broker.route('fanout', 'other'), ['q1'])
+        self.assertEqual(self.broker.route('', 'q2'), ['q2'])
+
+    def test_reject_requeue(self):
+        self.channel.basic_publish('unittest_exchange', 'unittest', 'hello')
+        method, properties, body = self.channel.basic_get('unittest_queue')
+        self.assertFalse(method.redelivered)
+        self.channel.basic_reject(method.delivery_tag)
+        method, properties, body = self.channel.basic_get('unittest_queue')
+        self.assertTrue(method.redelivered)
+
+    def test_close_requeue_unacked(self):
+        self.channel.basic_publish('unittest_exchange', 'unittest', 'hello')
+        self.channel.basic_get('unittest_queue')
+        self.assertEqual(
+            len(self.broker.queues['unittest_queue'].messages), 0)
+        self.channel.close()
+        self.assertEqual(
+            len(self.broker.queues['unittest_queue'].messages), 1)
+
+    def test_confirm_unroutable(self):
+        self.channel.confirm_delivery()
+        with self.assertRaises(UnroutableError):
+            self.channel.basic_publish('unittest_exchange', 'unknown',
+                                       'hello', mandatory=True)
+
+    def test_passive_declare_unexisting_queue(self):
+        with self.assertRaises(ChannelClosedByBroker) as ctx:
+            self.channel.queue_declare('unknown_queue', passive=True)
+
+        self.assertEqual(ctx.exception.args[0], 404)
+        self.assertTrue(self.channel.is_closed)
+
+    def test_unknown_delivery_tag(self):
+        with self.assertRaises(ChannelClosedByBroker) as ctx:
+            self.channel.basic_ack(10)
+
+        self.assertEqual(ctx.exception.args[0], 406)
+
+    def test_consume_with_prefetch(self):
+        received = []
+
+        def on_open(connection):
+            connection.channel(on_open_callback=on_channel_open)
+
+        def on_channel_open(channel):
+            channel.basic_qos(prefetch_count=2)
+            channel.basic_consume('unittest_queue', on_message)
+
+        def on_message(channel, method, properties, body):
+            received.append(method.delivery_tag)
+            if len(received) == 2:
+                connection.ioloop.stop()
+
+        for index in range(5):
+            self.channel.basic_publish(
+                'unittest_exchange', 'unittest', str(index),
+                properties=BasicProperties(content_type='text/plain'))
+
+        connection = get_select_connection(memory_url,
+                                           on_open_callback=on_open)
+        connection.ioloop.start()
+        self.assertEqual(received, [1, 2])
+        self.assertEqual(
+            len(self.broker.queues['unittest_queue'].messages), 3)
+        connection.close()
+        self.assertEqual(
+            len(self.broker.queues['unittest_queue'].messages), 5)
+
+    def test_stop_broker(self):
+        closed = []
+        connection = get_select_connection(
+            memory_url, on_close_callback=lambda c, r: closed.append(r))
+        self.broker.stop()
+        connection.ioloop.process_events(0)
+        self.assertEqual(closed[0].reply_code, 320)
+        self.assertTrue(self.connection.is_closed)
+        errors = []
+        get_select_connection(
+            memory_url, on_open_error_callback=lambda c, e: errors.append(e)
+        ).ioloop.process_events(0)
+        self.assertEqual(len(errors), 1)
+        self.broker.start()
+        self.assertTrue(get_blocking_connection(memory_url).is_open)
+
+    def test_ttl_and_dead_letter(self):
+        self.broker.queue_declare('delay', arguments={
+            'x-message-ttl': 10, 'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': 'unittest_queue'})
+        self.channel.basic_publish('', 'delay', 'hello')
+        queue = self.broker.queues['unittest_queue']
+        wait_until(lambda: queue.messages)
+        self.channel.basic_publish('', 'delay', 'hello')
+        self.assertEqual(len(self.broker.queues['delay'].messages), 1)
+        method, properties, body = self.channel.basic_get('unittest_queue')
+        self.assertEqual(body, b'hello')
+        death = properties.headers['x-death'][0]
+        self.assertEqual((death['queue'], death['reason'], death['count']),
+                         ('delay', 'expired', 1))
+        # the copy keeps the header, the next death is counted
+        self.channel.basic_ack(method.delivery_tag)
+        self.channel.basic_publish('', 'delay', body, properties)
+        wait_until(lambda: len(queue.messages) == 2)
+        self.channel.basic_get('unittest_queue')
+        method, properties, body = self.channel.basic_get('unittest_queue')
+        self.assertEqual(properties.headers['x-death'][0]['count'], 2)
+
+    def test_ttl_with_one_thread(self):
+        self.broker.queue_declare('delay', arguments={
+            'x-message-ttl': 50, 'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': 'unittest_queue'})
+        threads = active_count()
+        for index in range(1000):
+            self.broker.publish('', 'delay', str(index), BasicProperties())
+
+        # the expirations are waited by one thread of the broker
+        self.assertLessEqual(active_count(), threads + 1)
+        queue = self.broker.queues['unittest_queue']
+        wait_until(lambda: len(queue.messages) == 1000)
+        self.assertEqual([message.body for message in queue.messages],
+                         [str(index) for index in range(1000)])
+
+    def test_reject_dead_letter(self):
+        self.broker.queue_declare('dead')
+        self.broker.queue_declare('source', arguments={
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': 'dead'})
+        self.channel.basic_publish('', 'source', 'hello')
+        method, properties, body = self.channel.basic_get('source')
+        self.channel.basic_reject(method.delivery_tag, requeue=False)
+        method, properties, body = self.channel.basic_get('dead')
+        self.assertEqual(properties.headers['x-death'][0]['reason'],
+                         'rejected')
+
+
+class TestMemoryWorker(MemoryWorkerTestCase):
+
+    def test_consume_ok(self):
+        broker = get_broker()
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        worker, thread = self.start_worker(registry)
+        registry.Bus.publish('unittest_exchange', 'unittest',
+                             dumps({'label': 'label', 'number': 1}),
+                             'application/json')
+        wait_until(lambda: is_settled(broker))
+        self.assertEqual(registry.Test.query().count(), 1)
+        self.assertEqual(registry.Bus.Message.query().count(), 0)
+        self.stop_worker(worker, thread)
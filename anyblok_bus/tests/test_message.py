@@ -10,8 +10,13 @@ from anyblok_bus import bus_consumer
 from anyblok.column import Integer, String
 from marshmallow import Schema, fields
 from json import dumps
+from datetime import datetime
+import gzip
+from unittest.mock import patch
 from anyblok import Declarations
 from anyblok_bus.status import MessageStatus
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, get_broker, is_settled, wait_until)
 
 
 class OneSchema(Schema):
@@ -48,6 +53,21 @@ class TestMessage(DBTestCase):
         self.assertEqual(self.registry.Test.query().count(), 1)
         self.assertEqual(self.registry.Bus.Message.query().count(), 0)
 
+    def test_insert_many(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        Message = registry.Bus.Message
+        self.assertEqual(Message.insert_many([
+            Message.get_entry('test', 'Model.Test', 'decorated_method',
+                              dumps({'label': 'label'}).encode('utf-8'),
+                              error='error', sequence=x)
+            for x in range(3)]), 3)
+        self.assertEqual(Message.insert_many([]), 0)
+        self.assertEqual(
+            [(x.sequence, x.error, x.content_type)
+             for x in Message.query().order_by(Message.sequence)],
+            [(x, 'error', 'application/json') for x in range(3)])
+
     def test_message_ko(self):
         registry = self.init_registry_with_bloks(
             ('bus',), self.add_in_registry)
@@ -85,3 +105,270 @@ class TestMessage(DBTestCase):
         self.assertEqual(Test.query().count(), 2)
         self.assertEqual(Test.query().order_by(Test.id).all().number, [1, 2])
         self.assertEqual(self.registry.Bus.Message.query().count(), 0)
+
+    def insert_messages(self, registry, count, **kwargs):
+        for number in range(count):
+            registry.Bus.Message.insert(
+                message=dumps({'label': 'label', 'number': number}).encode(
+                    'utf-8'),
+                sequence=number,
+                model='Model.Test',
+                method='decorated_method',
+                **kwargs)
+
+    def test_message_consume_all_by_chunks(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.insert_messages(registry, 5, queue='test')
+        registry.Bus.Message.insert(
+            message=dumps({'label': 'label', 'number': 'other'}).encode(
+                'utf-8'),
+            sequence=3,
+            queue='test',
+            model='Model.Test',
+            method='decorated_method')
+        with patch.object(registry, 'commit',
+                          side_effect=registry.commit) as commit:
+            self.assertEqual(
+                registry.Bus.Message.consume_all(batch_size=2), (5, 1))
+            # one commit by chunk of 2 messages
+            self.assertEqual(commit.call_count, 3)
+
+        self.assertEqual(registry.Test.query().order_by(
+            registry.Test.id).all().number, [0, 1, 2, 3, 4])
+        self.assertEqual(registry.Bus.Message.query().count(), 1)
+
+    def test_message_consume_all_with_filters(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.insert_messages(registry, 2, queue='test')
+        self.insert_messages(registry, 3, queue='other')
+        self.assertEqual(
+            registry.Bus.Message.consume_all(queue='other'), (3, 0))
+        self.assertEqual(registry.Bus.Message.query().count(), 2)
+        self.assertEqual(
+            registry.Bus.Message.consume_all(before=datetime(2000, 1, 1)),
+            (0, 0))
+        self.assertEqual(registry.Bus.Message.query().count(), 2)
+
+    def test_message_consume_all_resumed_by_checkpoint(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.insert_messages(registry, 5, queue='test')
+        message = registry.Bus.Message.query().filter_by(sequence=1).one()
+        registry.Bus.Message.Checkpoint.save(
+            'replay', registry.Bus.Message.get_replay_position(message),
+            consumed=2)
+        self.assertEqual(
+            registry.Bus.Message.consume_all(batch_size=2,
+                                             checkpoint='replay'),
+            (3, 0))
+        self.assertEqual(registry.Test.query().order_by(
+            registry.Test.id).all().number, [2, 3, 4])
+        self.assertEqual(registry.Bus.Message.query().count(), 2)
+        self.assertEqual(registry.Bus.Message.Checkpoint.query().count(), 0)
+
+    def test_message_consume_all_by_publish_date(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        for number, publish_date in ((2, datetime(2019, 1, 2)),
+                                     (1, datetime(2019, 1, 1))):
+            registry.Bus.Message.insert(
+                message=dumps({'label': 'label', 'number': number}).encode(
+                    'utf-8'),
+                publish_date=publish_date,
+                queue='test',
+                model='Model.Test',
+                method='decorated_method')
+
+        registry.Bus.Message.consume_all()
+        self.assertEqual(registry.Test.query().order_by(
+            registry.Test.id).all().number, [1, 2])
+
+    def test_message_replay_partitions(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.insert_messages(registry, 2, queue='test')
+        self.insert_messages(registry, 3, queue='other')
+        self.assertEqual(registry.Bus.Message.get_replay_partitions(),
+                         [('other', 3), ('test', 2)])
+        self.assertEqual(
+            registry.Bus.Message.get_replay_partitions('method'),
+            [('decorated_method', 5)])
+
+    def test_message_delete_many(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.insert_messages(registry, 5, queue='test')
+        self.insert_messages(registry, 2, queue='other')
+        self.assertEqual(registry.Bus.Message.delete_many(
+            batch_size=2, commit=False, queue='test'), 5)
+        self.assertEqual(
+            registry.Bus.Message.query().all().queue, ['other', 'other'])
+
+    def test_message_purge(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.insert_messages(registry, 3, queue='test')
+        Message = registry.Bus.Message
+        Message.query().filter(Message.sequence < 2).update(
+            {'create_date': datetime(2000, 1, 1)}, synchronize_session=False)
+        self.assertEqual(Message.purge(30, commit=False), 2)
+        self.assertEqual(Message.query().one().sequence, 2)
+
+    def test_message_reassign(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.insert_messages(registry, 5, queue='test')
+        Message = registry.Bus.Message
+        Message.query().update({'model': 'Model.Old'},
+                               synchronize_session=False)
+        self.assertEqual(
+            Message.reassign({'model': 'Model.Test'}, batch_size=2,
+                             commit=False, model='Model.Old'), 5)
+        registry.expire_all()
+        self.assertEqual(Message.consume_all(), (5, 0))
+
+    def test_message_reassign_sparse_ids(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.insert_messages(registry, 4, queue='test')
+        Message = registry.Bus.Message
+        first = Message.query().order_by(Message.id).first()
+        # ids far apart, as after a purge
+        Message.query().filter(Message.id != first.id).update(
+            {'id': Message.id + 1000000}, synchronize_session=False)
+        Message.query().update({'model': 'Model.Old'},
+                               synchronize_session=False)
+        with patch.object(registry, 'execute',
+                          side_effect=registry.execute) as execute:
+            self.assertEqual(
+                Message.reassign({'model': 'Model.Test'}, batch_size=2,
+                                 commit=False, model='Model.Old'), 4)
+            statements = execute.call_count
+
+        # 2 batches of 2 ids, then the empty select: no empty update
+        self.assertEqual(statements, 5)
+
+    def test_message_reassign_unknown_column(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        with self.assertRaises(ValueError):
+            registry.Bus.Message.reassign({'error': None})
+
+    def test_message_compressed(self):
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        file_ = dumps({'label': 'label', 'number': 1})
+        message = registry.Bus.Message.insert(
+            message=gzip.compress(file_.encode('utf-8')),
+            content_encoding='gzip',
+            queue='test',
+            model='Model.Test',
+            method='decorated_method')
+        message.consume()
+        self.assertEqual(self.registry.Test.query().count(), 1)
+        self.assertEqual(self.registry.Bus.Message.query().count(), 0)
+
+    def test_message_deserialized(self):
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+                label = String()
+                number = Integer()
+
+                @bus_consumer(queue_name='test', deserialize=True)
+                def decorated_method(cls, body=None):
+                    cls.insert(**body)
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        file_ = dumps({'label': 'label', 'number': 1})
+        message = registry.Bus.Message.insert(
+            message=file_.encode('utf-8'),
+            queue='test',
+            model='Model.Test',
+            method='decorated_method')
+        message.consume()
+        self.assertEqual(self.registry.Test.query().one().number, 1)
+        self.assertEqual(self.registry.Bus.Message.query().count(), 0)
+
+    def test_message_batch_consumer(self):
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+                label = String()
+                number = Integer()
+
+                @bus_consumer(queue_name='test', schema=OneSchema(),
+                              batch_size=10)
+                def decorated_method(cls, body=None):
+                    cls.multi_insert(*body)
+                    return [MessageStatus.ACK] * len(body)
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        file_ = dumps({'label': 'label', 'number': 1})
+        message = registry.Bus.Message.insert(
+            message=file_.encode('utf-8'),
+            queue='test',
+            model='Model.Test',
+            method='decorated_method')
+        message.consume()
+        self.assertEqual(self.registry.Test.query().one().number, 1)
+        self.assertEqual(self.registry.Bus.Message.query().count(), 0)
+
+    def test_message_raw(self):
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+                size = Integer()
+
+                @bus_consumer(queue_name='test', raw=True)
+                def decorated_method(cls, body=None):
+                    assert isinstance(body, bytes)
+                    cls.insert(size=len(body))
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        message = registry.Bus.Message.insert(
+            message=b'\xff\x00\x01',
+            queue='test',
+            model='Model.Test',
+            method='decorated_method')
+        message.consume()
+        self.assertEqual(self.registry.Test.query().one().size, 3)
+        self.assertEqual(self.registry.Bus.Message.query().count(), 0)
+
+
+class TestMessageRepublish(MemoryWorkerTestCase):
+
+    def test_republish(self):
+        broker = get_broker()
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        Message = registry.Bus.Message
+        Message.insert_many([
+            Message.get_entry(
+                'unittest_queue', 'Model.Test', 'decorated_method',
+                dumps({'label': 'label', 'number': x}).encode('utf-8'))
+            for x in range(5)] + [
+            Message.get_entry(
+                'missing_queue', 'Model.Test', 'decorated_method',
+                dumps({'label': 'label', 'number': 5}).encode('utf-8'))])
+        worker, thread = self.start_worker(registry)
+        self.assertEqual(Message.republish(batch_size=2), 5)
+        wait_until(lambda: is_settled(broker))
+        self.stop_worker(worker, thread)
+        self.assertEqual(registry.Test.query().count(), 5)
+        message = Message.query().one()
+        self.assertEqual(message.queue, 'missing_queue')
+        self.assertEqual(message.error, 'Unroutable message')
@@ -0,0 +1,60 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import DBTestCase
+from anyblok.config import Configuration
+from json import dumps
+
+
+class TestOutbox(DBTestCase):
+
+    @classmethod
+    def init_configuration_manager(cls, **env):
+        env.update(dict(bus_publish_mode='outbox'))
+        super(TestOutbox, cls).init_configuration_manager(**env)
+
+    def test_publish_in_outbox(self):
+        registry = self.init_registry_with_bloks(('bus',), None)
+        self.assertEqual(Configuration.get('bus_publish_mode'), 'outbox')
+        registry.Bus.publish('unittest_exchange', 'unittest',
+                             dumps({'hello': 'world'}), 'application/json')
+        entry = registry.Bus.Outbox.query().one()
+        self.assertEqual(entry.exchange, 'unittest_exchange')
+        self.assertEqual(entry.routing_key, 'unittest')
+        self.assertEqual(entry.content_type, 'application/json')
+        self.assertEqual(entry.message,
+                         dumps({'hello': 'world'}).encode('utf-8'))
+
+    def test_publish_many_in_outbox(self):
+        registry = self.init_registry_with_bloks(('bus',), None)
+        count = registry.Bus.publish_many('unittest_exchange', [
+            ('unittest', dumps({'number': i}), 'application/json')
+            for i in range(10)
+        ])
+        self.assertEqual(count, 10)
+        self.assertEqual(registry.Bus.Outbox.query().count(), 10)
+
+    def test_rollback_does_not_publish(self):
+        registry = self.init_registry_with_bloks(('bus',), None)
+        savepoint = registry.begin_nested()
+        registry.Bus.publish('unittest_exchange', 'unittest',
+                             dumps({'hello': 'world'}), 'application/json')
+        savepoint.rollback()
+        self.assertEqual(registry.Bus.Outbox.query().count(), 0)
+
+    def test_message_id_kept_by_the_outbox(self):
+        registry = self.init_registry_with_bloks(('bus',), None)
+        Configuration.set('bus_message_id', True)
+        try:
+            registry.Bus.publish('unittest_exchange', 'unittest',
+                                 dumps({'hello': 'world'}),
+                                 'application/json')
+        finally:
+            Configuration.set('bus_message_id', False)
+
+        entry = registry.Bus.Outbox.query().one()
+        self.assertEqual(len(entry.properties['message_id']), 32)
@@ -0,0 +1,52 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from unittest import TestCase
+from anyblok_bus.prefetch import AdaptivePrefetch
+
+
+class TestAdaptivePrefetch(TestCase):
+
+    def get_adaptive(self, **kwargs):
+        adaptive = AdaptivePrefetch(**kwargs)
+        adaptive.interval = 0
+        return adaptive
+
+    def test_bounds(self):
+        self.assertEqual(AdaptivePrefetch(initial=0).prefetch, 1)
+        self.assertEqual(AdaptivePrefetch(initial=50, maximum=10).prefetch, 10)
+
+    def test_not_evaluated_before_interval(self):
+        adaptive = AdaptivePrefetch(initial=1)
+        adaptive.interval = 3600
+        self.assertIsNone(adaptive.record(0.001))
+        self.assertEqual(adaptive.prefetch, 1)
+
+    def test_grow_when_idle(self):
+        adaptive = self.get_adaptive(initial=2, maximum=100)
+        adaptive._start -= 1
+        self.assertEqual(adaptive.record(0.001), 4)
+        adaptive._start -= 1
+        self.assertEqual(adaptive.record(0.001), 8)
+
+    def test_grow_until_maximum(self):
+        adaptive = self.get_adaptive(initial=64, maximum=100)
+        adaptive._start -= 1
+        self.assertEqual(adaptive.record(0.001), 100)
+        adaptive._start -= 1
+        self.assertIsNone(adaptive.record(0.001))
+
+    def test_shrink_when_the_buffer_is_too_long(self):
+        adaptive = self.get_adaptive(initial=100, maximum=100)
+        adaptive._start -= 1
+        # 4 messages by second: at most 4 messages kept by the worker
+        self.assertEqual(adaptive.record(1, count=4), 4)
+
+    def test_stable_when_busy(self):
+        adaptive = self.get_adaptive(initial=4, maximum=100)
+        adaptive._start -= 1
+        self.assertIsNone(adaptive.record(1, count=100))
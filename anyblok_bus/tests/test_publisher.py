@@ -0,0 +1,227 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from unittest import TestCase
+from unittest.mock import patch
+from inspect import getsource
+from json import dumps
+from anyblok.config import Configuration
+from pika.adapters.blocking_connection import BlockingChannel
+from anyblok_bus.connection import get_blocking_connection
+from anyblok_bus.memory import MemoryBroker
+from anyblok_bus.publisher import (
+    AsyncPublisher, BatchChannel, BlockingChannelAdapter, PublisherPool,
+    get_pika_version, publisher_pool)
+from anyblok_bus.bloks.bus.exceptions import PublishException
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, get_broker, memory_url, wait_until)
+
+
+class TestMemoryBatchChannel(TestCase):
+
+    messages = [
+        ('unittest', 'hello', 'text/plain'),
+        ('wrong', 'hello', 'text/plain'),
+        ('unittest', 'hello', 'text/plain', {'message_id': 'id'}),
+    ]
+
+    def setUp(self):
+        self.broker = get_broker()
+        self.connection = get_blocking_connection(memory_url)
+
+    def tearDown(self):
+        if self.connection.is_open:
+            self.connection.close()
+
+        MemoryBroker.reset_all()
+
+    def test_private_api_of_pika(self):
+        # the private api used by the adapter, for the supported versions
+        version = get_pika_version()
+        self.assertGreaterEqual(version, BlockingChannelAdapter.min_version)
+        self.assertLess(version, BlockingChannelAdapter.max_version)
+        self.assertTrue(callable(BlockingChannel._flush_output))
+        self.assertIn('self._impl', getsource(BlockingChannel.__init__))
+
+    def test_pika_version(self):
+        self.assertEqual(get_pika_version('1.3.2'), (1, 3))
+        self.assertFalse(BlockingChannelAdapter.is_supported(
+            self.connection.channel(), '2.0.0'))
+
+    def test_publish_batch(self):
+        channel = BatchChannel(self.connection)
+        self.assertIsNotNone(channel._adapter)
+        self.assertEqual(channel.publish('unittest_exchange', self.messages),
+                         (3, [(1, self.messages[1])], []))
+        self.assertEqual(
+            len(self.broker.queues['unittest_queue'].messages), 2)
+
+    def test_publish_lazily(self):
+        channel = BatchChannel(self.connection)
+        channel.window = 2
+        pending = []
+
+        def encode(message):
+            # only the unconfirmed messages are kept by the channel
+            pending.append(len(channel._pending))
+            return message[1:]
+
+        messages = (('original', 'unittest', str(index), 'text/plain')
+                    for index in range(10))
+        count, unroutable, nacked = channel.publish(
+            'unittest_exchange', messages, encode=encode)
+        self.assertEqual(count, 10)
+        self.assertLessEqual(max(pending), 2)
+        self.assertEqual(
+            len(self.broker.queues['unittest_queue'].messages), 10)
+        count, unroutable, nacked = channel.publish(
+            'unittest_exchange', [('original', 'wrong', 'hello', 'text/plain')],
+            encode=encode)
+        self.assertEqual(unroutable,
+                         [(0, ('original', 'wrong', 'hello', 'text/plain'))])
+
+    def test_publish_without_adapter(self):
+        with patch.object(BlockingChannelAdapter, 'max_version', (1, 0)):
+            channel = BatchChannel(self.connection)
+
+        self.assertIsNone(channel._adapter)
+        self.assertEqual(channel.publish('unittest_exchange', self.messages),
+                         (3, [(1, self.messages[1])], []))
+        self.assertEqual(
+            len(self.broker.queues['unittest_queue'].messages), 2)
+
+
+class TestPublisherPoolProfileUrl(TestCase):
+
+    def test_profile_url_ttl(self):
+        pool = PublisherPool()
+        pool.set_profile_url('profile', memory_url)
+        self.assertEqual(pool.get_profile_url('profile'), memory_url)
+        pool.profile_url_ttl = 0
+        pool.set_profile_url('profile', memory_url)
+        self.assertIsNone(pool.get_profile_url('profile'))
+
+    def test_forget_profile(self):
+        pool = PublisherPool()
+        pool.set_profile_url('profile', memory_url)
+        pool.forget_profile('profile')
+        self.assertIsNone(pool.get_profile_url('profile'))
+
+
+class TestMemoryAsyncPublisher(TestCase):
+
+    def setUp(self):
+        self.broker = get_broker()
+        self.publisher = AsyncPublisher(memory_url, queue_size=10)
+        self.publisher.confirm_timeout = 0.3
+        self.publisher.window = 5
+        self.publisher.start()
+        wait_until(lambda: self.publisher._channel is not None)
+
+    def tearDown(self):
+        self.broker.release_confirms()
+        self.publisher.stop(timeout=1)
+        MemoryBroker.reset_all()
+
+    def publish(self):
+        return self.publisher.publish('unittest_exchange', 'unittest',
+                                      'hello', 'text/plain')
+
+    def test_confirm_window(self):
+        self.broker.hold_confirms = True
+        futures = [self.publish() for x in range(5)]
+        wait_until(lambda: len(self.publisher._pending) == 5)
+        # the window is full, the next messages wait in the queue
+        futures.extend(self.publish() for x in range(10))
+        self.assertTrue(self.publisher._queue.full())
+        with self.assertRaises(PublishException):
+            self.publish()
+
+        self.broker.release_confirms()
+        for future in futures:
+            self.assertTrue(future.result(timeout=1))
+
+        self.assertEqual(len(self.broker.queues['unittest_queue'].messages),
+                         15)
+
+    def test_confirm_timeout(self):
+        self.broker.hold_confirms = True
+        future = self.publish()
+        with self.assertRaises(PublishException):
+            future.result(timeout=3)
+
+        self.assertFalse(self.publisher._pending)
+
+    def test_stop_without_confirm(self):
+        self.broker.hold_confirms = True
+        self.publisher.confirm_timeout = 60
+        future = self.publish()
+        wait_until(lambda: self.publisher._pending)
+        self.publisher.stop(timeout=0.2)
+        with self.assertRaises(PublishException):
+            future.result(timeout=1)
+
+
+class TestMemoryPublish(MemoryWorkerTestCase):
+
+    def test_publish_many_unroutable(self):
+        broker = get_broker()
+        registry = self.init_registry_with_bloks(('bus',), None)
+        registry.Bus.Profile.insert(name=Configuration.get('bus_profile'),
+                                    url=memory_url)
+        messages = [
+            ('unittest', {'hello': 'world'}, 'application/json'),
+            ('wrong', {'hello': 'world'}, 'application/json'),
+            ('unittest', dumps({'hello': 'world'}), 'application/json'),
+        ]
+        with self.assertRaises(PublishException) as ctx:
+            registry.Bus.publish_many('unittest_exchange', messages)
+
+        self.assertEqual(ctx.exception.unroutable, [(1, messages[1])])
+        self.assertEqual(ctx.exception.nacked, [])
+        self.assertEqual(len(broker.queues['unittest_queue'].messages), 2)
+
+    def test_publish_async_without_profile(self):
+        get_broker()
+        registry = self.init_registry_with_bloks(('bus',), None)
+        publisher_pool.forget_profile(Configuration.get('bus_profile'))
+        with self.assertRaises(PublishException):
+            registry.Bus.publish_async('unittest_exchange', 'unittest',
+                                       'hello', 'text/plain')
+
+    def test_publish_async_profile_url_cached(self):
+        broker = get_broker()
+        registry = self.init_registry_with_bloks(('bus',), None)
+        bus_profile = Configuration.get('bus_profile')
+        profile = registry.Bus.Profile.insert(name=bus_profile,
+                                              url=memory_url)
+        future = registry.Bus.publish_async('unittest_exchange', 'unittest',
+                                            'hello', 'text/plain')
+        self.assertTrue(future.result(timeout=1))
+        self.assertEqual(len(broker.queues['unittest_queue'].messages), 1)
+        self.assertEqual(publisher_pool.get_profile_url(bus_profile),
+                         memory_url)
+        profile.description = 'updated'
+        registry.flush()
+        self.assertIsNone(publisher_pool.get_profile_url(bus_profile))
+
+    def test_publish_forget_the_url_on_failure(self):
+        broker = get_broker()
+        registry = self.init_registry_with_bloks(('bus',), None)
+        bus_profile = Configuration.get('bus_profile')
+        registry.Bus.Profile.insert(name=bus_profile, url=memory_url)
+        registry.Bus.publish('unittest_exchange', 'unittest', 'hello',
+                             'text/plain')
+        # publish and publish_async share the cached url
+        self.assertEqual(publisher_pool.get_profile_url(bus_profile),
+                         memory_url)
+        broker.stop()
+        with self.assertRaises(Exception):
+            registry.Bus.publish('unittest_exchange', 'unittest', 'hello',
+                                 'text/plain')
+
+        self.assertIsNone(publisher_pool.get_profile_url(bus_profile))
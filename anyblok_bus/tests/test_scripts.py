@@ -0,0 +1,24 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from unittest import TestCase
+from anyblok_bus.scripts import split_partitions
+
+
+class TestSplitPartitions(TestCase):
+
+    def test_balanced(self):
+        self.assertEqual(
+            split_partitions(
+                [('a', 10), ('b', 7), ('c', 5), ('d', 3), ('e', 1)], 2),
+            [['a', 'd'], ['b', 'c', 'e']])
+
+    def test_less_partitions_than_processes(self):
+        self.assertEqual(split_partitions([('a', 10)], 4), [['a']])
+
+    def test_without_partition(self):
+        self.assertEqual(split_partitions([], 4), [])
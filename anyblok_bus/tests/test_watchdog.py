@@ -0,0 +1,77 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from unittest import TestCase
+from logging import Handler, getLogger
+from threading import Event
+from anyblok_bus.watchdog import Watchdog
+from anyblok_bus.tests.testcase import wait_timeout
+
+
+class LoggedHandler(Handler):
+    """Set the event at the first log of the watchdog"""
+
+    def __init__(self):
+        super(LoggedHandler, self).__init__()
+        self.logged = Event()
+
+    def emit(self, record):
+        self.logged.set()
+
+
+def slow_consumer(logged):
+    # runs until the stack is logged
+    if not logged.wait(wait_timeout):
+        raise AssertionError("The stack is not logged")
+
+
+class TestWatchdog(TestCase):
+
+    def setUp(self):
+        self.watchdog = Watchdog()
+
+    def tearDown(self):
+        self.watchdog.stop()
+
+    def add_handler(self):
+        # added inside assertLogs, which restores the handlers at the exit
+        handler = LoggedHandler()
+        getLogger('anyblok_bus.watchdog').addHandler(handler)
+        return handler.logged
+
+    def test_log_the_stack_of_the_slow_handler(self):
+        with self.assertLogs('anyblok_bus.watchdog', 'WARNING') as logs:
+            logged = self.add_handler()
+            with self.watchdog.watching('slow', 0.02):
+                slow_consumer(logged)
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('slow runs for more than 0.02 seconds', logs.output[0])
+        self.assertIn('slow_consumer', logs.output[0])
+
+    def test_nothing_logged_in_time(self):
+        with self.assertRaises(AssertionError):
+            with self.assertLogs('anyblok_bus.watchdog', 'WARNING'):
+                with self.watchdog.watching('fast', 0.05):
+                    pass
+
+                # the thread of the watchdog is joined
+                self.watchdog.stop()
+
+        self.assertFalse(self.watchdog._watched)
+
+    def test_nearest_deadline(self):
+        with self.assertLogs('anyblok_bus.watchdog', 'WARNING') as logs:
+            logged = self.add_handler()
+            token = self.watchdog.watch('long', 10)
+            with self.watchdog.watching('short', 0.02):
+                slow_consumer(logged)
+
+            self.watchdog.unwatch(token)
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('short', logs.output[0])
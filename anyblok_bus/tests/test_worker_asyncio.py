@@ -0,0 +1,124 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from asyncio import sleep
+from anyblok.config import Configuration
+from anyblok.column import Integer, String
+from anyblok import Declarations
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.consumer import BusConfigurationException
+from anyblok_bus.worker import AsyncioWorker, Worker
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, OneSchema, get_broker, is_settled, memory_url,
+    wait_until)
+
+
+class TestAsyncioWorker(MemoryWorkerTestCase):
+
+    def add_in_registry(self):
+        running = self.running = []
+        concurrent = self.concurrent = []
+
+        @Declarations.register(Declarations.Model)
+        class Test:
+            id = Integer(primary_key=True)
+            label = String()
+            number = Integer()
+
+            @bus_consumer(queue_name='unittest_queue', schema=OneSchema(),
+                          concurrency=3)
+            async def decorated_method(cls, body=None):
+                running.append(body)
+                concurrent.append(len(running))
+                await sleep(0.05)
+                running.remove(body)
+                cls.insert(**body)
+                return MessageStatus.ACK
+
+    def test_consume_async(self):
+        broker = get_broker()
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.publish_messages(registry, 6, invalid=1)
+        worker, thread = self.start_worker(registry, AsyncioWorker)
+        wait_until(lambda: is_settled(broker))
+        self.stop_worker(worker, thread)
+        self.assertEqual(registry.Test.query().count(), 6)
+        self.assertEqual(registry.Bus.Message.query().count(), 1)
+        self.assertFalse(broker.queues['unittest_queue'].messages)
+        # the coroutines are awaited at the same time, at most concurrency
+        self.assertEqual(max(self.concurrent), 3)
+
+    def test_async_consumer_timeout(self):
+        broker = get_broker()
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+
+                @bus_consumer(queue_name='unittest_queue', timeout=0.05)
+                async def decorated_method(cls, body=None):
+                    await sleep(10)
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        self.publish_messages(registry, 1)
+        worker, thread = self.start_worker(registry, AsyncioWorker)
+        wait_until(lambda: is_settled(broker))
+        self.stop_worker(worker, thread)
+        message = registry.Bus.Message.query().one()
+        self.assertIn('Timeout', message.error)
+
+    def test_await_with_changes_in_the_session(self):
+        broker = get_broker()
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+                label = String()
+                number = Integer()
+
+                @bus_consumer(queue_name='unittest_queue', schema=OneSchema(),
+                              concurrency=2)
+                async def decorated_method(cls, body=None):
+                    if body['number']:
+                        # written after the last await
+                        await sleep(0.05)
+                        cls.insert(**body)
+                    else:
+                        # the other coroutine is awaited meanwhile
+                        cls.insert(**body)
+                        await sleep(0.01)
+
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        self.publish_messages(registry, 2)
+        worker, thread = self.start_worker(registry, AsyncioWorker)
+        wait_until(lambda: is_settled(broker))
+        self.stop_worker(worker, thread)
+        # the failed coroutine is rolled back, not the other one
+        self.assertEqual(registry.Test.query().one().number, 1)
+        message = registry.Bus.Message.query().one()
+        self.assertIn('awaits with changes in the session', message.error)
+
+    def test_async_consumer_with_worker(self):
+        get_broker()
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        bus_profile = Configuration.get('bus_profile')
+        registry.Bus.Profile.insert(name=bus_profile, url=memory_url)
+        worker = Worker(registry, bus_profile,
+                        registry.Bus.get_consumers()[0][1])
+        with self.assertRaises(BusConfigurationException):
+            worker.open_channel('unittest_queue', 'Model.Test',
+                                'decorated_method')
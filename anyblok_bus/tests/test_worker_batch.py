@@ -0,0 +1,42 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.column import Integer, String
+from anyblok import Declarations
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, OneSchema, get_broker, is_settled, wait_until)
+
+
+class TestWorkerBatch(MemoryWorkerTestCase):
+
+    def test_consume_batch(self):
+        broker = get_broker()
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+                label = String()
+                number = Integer()
+
+                @bus_consumer(queue_name='unittest_queue', schema=OneSchema(),
+                              batch_size=4, batch_timeout=0.1)
+                def decorated_method(cls, body=None):
+                    cls.multi_insert(*body)
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        self.publish_messages(registry, 5, invalid=1)
+        worker, thread = self.start_worker(registry)
+        wait_until(lambda: is_settled(broker))
+        self.stop_worker(worker, thread)
+        self.assertEqual(registry.Test.query().count(), 5)
+        self.assertEqual(registry.Bus.Message.query().count(), 1)
+        self.assertFalse(broker.queues['unittest_queue'].messages)
@@ -0,0 +1,32 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, get_broker, wait_until)
+
+
+class TestWorkerBreaker(MemoryWorkerTestCase):
+
+    @classmethod
+    def init_configuration_manager(cls, **env):
+        env.update(dict(bus_breaker_errors=2, bus_breaker_cooldown=60))
+        super(TestWorkerBreaker, cls).init_configuration_manager(**env)
+
+    def test_pause_the_consumer(self):
+        broker = get_broker()
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.publish_messages(registry, 0, invalid=5)
+        worker, thread = self.start_worker(registry)
+        queue = broker.queues['unittest_queue']
+        channel = worker._consumer_channels['unittest_queue'].channel
+        # the errors are acked after the save, the other messages are kept
+        # by rabbitmq
+        wait_until(lambda: len(queue.messages) == 3 and not channel._unacked)
+        self.stop_worker(worker, thread)
+        self.assertEqual(registry.Bus.Message.query().count(), 2)
+        self.assertEqual(len(queue.messages), 3)
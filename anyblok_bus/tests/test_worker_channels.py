@@ -0,0 +1,66 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.column import Integer
+from anyblok import Declarations
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, get_broker, wait_until)
+
+
+class TestWorkerChannels(MemoryWorkerTestCase):
+
+    def add_in_registry(self):
+        received = self.received = []
+
+        @Declarations.register(Declarations.Model)
+        class Test:
+            id = Integer(primary_key=True)
+
+            @bus_consumer(queue_name='unittest_queue', weight=3)
+            def hot_method(cls, body=None):
+                received.append('hot')
+                return MessageStatus.ACK
+
+            @bus_consumer(queue_name='other_queue')
+            def cold_method(cls, body=None):
+                received.append('cold')
+                return MessageStatus.ACK
+
+    def test_weighted_consumers(self):
+        broker = get_broker()
+        broker.queue_declare('other_queue')
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        registry.Bus.publish_many('', [
+            (queue, 'message', 'text/plain')
+            for x in range(20) for queue in ('unittest_queue', 'other_queue')])
+        worker, thread = self.start_worker(registry)
+        wait_until(lambda: len(self.received) == 40)
+        self.stop_worker(worker, thread)
+        # 3 hot messages for 1 cold message
+        self.assertGreaterEqual(self.received[:20].count('hot'), 14)
+
+    def test_restart_only_the_closed_channel(self):
+        broker = get_broker()
+        broker.queue_declare('other_queue')
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        worker, thread = self.start_worker(registry)
+        worker.channel_restart_delay = 0.05
+        cold = worker._consumer_channels['other_queue']
+        broker.queue_delete('other_queue')
+        wait_until(lambda: not cold.is_open)
+        registry.Bus.publish('', 'unittest_queue', 'message', 'text/plain')
+        wait_until(lambda: self.received == ['hot'])
+        broker.queue_declare('other_queue')
+        wait_until(lambda: broker.queues['other_queue'].consumers)
+        registry.Bus.publish('', 'other_queue', 'message', 'text/plain')
+        wait_until(lambda: len(self.received) == 2)
+        self.stop_worker(worker, thread)
+        self.assertEqual(self.received, ['hot', 'cold'])
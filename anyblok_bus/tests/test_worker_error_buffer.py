@@ -0,0 +1,47 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.column import Integer, String
+from anyblok import Declarations
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, OneSchema, get_broker, is_settled, wait_until)
+
+
+class TestWorkerErrorBuffer(MemoryWorkerTestCase):
+
+    @classmethod
+    def init_configuration_manager(cls, **env):
+        env.update(dict(bus_error_buffer_size=3, bus_error_buffer_delay=50))
+        super(TestWorkerErrorBuffer, cls).init_configuration_manager(**env)
+
+    def test_save_errors_by_buffer(self):
+        broker = get_broker()
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+                label = String()
+                number = Integer()
+
+                @bus_consumer(queue_name='unittest_queue', schema=OneSchema(),
+                              prefetch=10)
+                def decorated_method(cls, body=None):
+                    cls.insert(**body)
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        self.publish_messages(registry, 2, invalid=4)
+        worker, thread = self.start_worker(registry)
+        # acked after the save
+        wait_until(lambda: is_settled(broker))
+        self.assertEqual(registry.Bus.Message.query().count(), 4)
+        self.stop_worker(worker, thread)
+        self.assertEqual(registry.Test.query().count(), 2)
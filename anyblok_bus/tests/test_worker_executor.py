@@ -0,0 +1,82 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from threading import Barrier, Event, current_thread
+from anyblok.column import Integer
+from anyblok import Declarations
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, get_broker, is_settled, wait_timeout, wait_until)
+
+
+class TestWorkerExecutor(MemoryWorkerTestCase):
+
+    @classmethod
+    def init_configuration_manager(cls, **env):
+        env.update(dict(bus_executor_threads=2))
+        super(TestWorkerExecutor, cls).init_configuration_manager(**env)
+
+    def test_consume_in_executor(self):
+        broker = get_broker()
+        threads = set()
+        # each message waits a message consumed by the other thread
+        barrier = Barrier(2, timeout=wait_timeout)
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+
+                @bus_consumer(queue_name='unittest_queue')
+                def decorated_method(cls, body=None):
+                    threads.add(current_thread().name)
+                    barrier.wait()
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        self.publish_messages(registry, 6)
+        worker, thread = self.start_worker(registry)
+        wait_until(lambda: is_settled(broker))
+        self.stop_worker(worker, thread)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(thread.name, threads)
+        self.assertFalse(broker.queues['unittest_queue'].messages)
+
+    def test_stop_with_running_messages(self):
+        broker = get_broker()
+        running = []
+        handled = []
+        stopping = Event()
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+
+                @bus_consumer(queue_name='unittest_queue')
+                def decorated_method(cls, body=None):
+                    running.append(body)
+                    stopping.wait(wait_timeout)
+                    handled.append(body)
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        self.publish_messages(registry, 6)
+        worker, thread = self.start_worker(registry)
+        wait_until(lambda: len(running) == 2)
+        # the ioloop runs while the running messages are waited
+        worker.stop()
+        stopping.set()
+        thread.join(wait_timeout)
+        self.assertFalse(thread.is_alive())
+        # the running messages are acked, the others are requeued once
+        self.assertGreaterEqual(len(handled), 2)
+        self.assertEqual(
+            len(handled) + len(broker.queues['unittest_queue'].messages), 6)
@@ -0,0 +1,29 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, get_broker, is_settled, wait_until)
+
+
+class TestWorkerGroupCommit(MemoryWorkerTestCase):
+
+    @classmethod
+    def init_configuration_manager(cls, **env):
+        env.update(dict(bus_group_commit_size=4, bus_group_commit_delay=50))
+        super(TestWorkerGroupCommit, cls).init_configuration_manager(**env)
+
+    def test_consume_in_group(self):
+        broker = get_broker()
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.publish_messages(registry, 5, invalid=1)
+        worker, thread = self.start_worker(registry)
+        wait_until(lambda: is_settled(broker))
+        self.stop_worker(worker, thread)
+        self.assertEqual(registry.Test.query().count(), 5)
+        self.assertEqual(registry.Bus.Message.query().count(), 1)
+        self.assertFalse(broker.queues['unittest_queue'].messages)
@@ -0,0 +1,70 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from json import dumps
+from anyblok.column import Integer, String
+from anyblok import Declarations
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.inbox import InboxCache
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, OneSchema, get_broker, is_settled, wait_until)
+
+
+class TestWorkerInbox(MemoryWorkerTestCase):
+
+    def add_in_registry(self):
+
+        @Declarations.register(Declarations.Model)
+        class Test:
+            id = Integer(primary_key=True)
+            label = String()
+            number = Integer()
+
+            @bus_consumer(queue_name='unittest_queue', schema=OneSchema(),
+                          idempotent=True)
+            def decorated_method(cls, body=None):
+                cls.insert(**body)
+                return MessageStatus.ACK
+
+    def publish_twice(self, registry):
+        message = dumps({'label': 'label', 'number': 1})
+        registry.Bus.publish_many('unittest_exchange', [
+            ('unittest', message, 'application/json', {'message_id': 'id'}),
+            ('unittest', message, 'application/json', {'message_id': 'id'}),
+            ('unittest', message, 'application/json'),
+        ])
+
+    def test_consume_once(self):
+        broker = get_broker()
+        InboxCache.get().clear()
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        self.publish_twice(registry)
+        worker, thread = self.start_worker(registry)
+        wait_until(lambda: is_settled(broker))
+        self.stop_worker(worker, thread)
+        # the message without id is always consumed
+        self.assertEqual(registry.Test.query().count(), 2)
+        self.assertEqual(registry.Bus.Inbox.query().count(), 1)
+        self.assertIn(('unittest_queue', 'id'), InboxCache.get())
+        self.assertFalse(broker.queues['unittest_queue'].messages)
+
+    def test_duplicate_found_by_the_inbox(self):
+        broker = get_broker()
+        registry = self.init_registry_with_bloks(
+            ('bus',), self.add_in_registry)
+        worker, thread = self.start_worker(registry)
+        # without cache the duplicate is found by the primary key
+        worker._inbox_cache = InboxCache(size=0)
+        self.publish_twice(registry)
+        wait_until(lambda: is_settled(broker))
+        self.stop_worker(worker, thread)
+        self.assertEqual(registry.Test.query().count(), 2)
+        self.assertEqual(registry.Bus.Inbox.query().count(), 1)
+        self.assertFalse(registry.Bus.Message.query().count())
+        self.assertFalse(broker.queues['unittest_queue'].messages)
@@ -0,0 +1,45 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.column import Integer
+from anyblok import Declarations
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, get_broker, wait_until)
+
+
+class TestWorkerPrefetch(MemoryWorkerTestCase):
+
+    def test_consume_with_prefetch(self):
+        broker = get_broker()
+        queued = []
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+
+                @bus_consumer(queue_name='unittest_queue', prefetch=5)
+                def decorated_method(cls, body=None):
+                    queued.append(
+                        len(broker.queues['unittest_queue'].messages))
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        registry.Bus.publish_many('unittest_exchange', [
+            ('unittest', 'message', 'text/plain') for x in range(10)])
+        worker, thread = self.start_worker(registry)
+        wait_until(lambda: len(queued) == 10)
+        # the QoS is by consumer, the quorum queues refuse the global QoS
+        channel = worker._consumer_channels['unittest_queue'].channel
+        self.assertEqual(channel._global_prefetch_count, 0)
+        self.assertEqual([consumer.prefetch_count
+                          for consumer in channel._consumers.values()], [5])
+        self.stop_worker(worker, thread)
+        self.assertEqual(queued[0], 5)
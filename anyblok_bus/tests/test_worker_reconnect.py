@@ -0,0 +1,35 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from types import SimpleNamespace
+from unittest import TestCase
+from anyblok_bus.worker import ReconnectingWorker
+
+
+class TestReconnectDelay(TestCase):
+
+    def get_worker(self):
+        worker = ReconnectingWorker.__new__(ReconnectingWorker)
+        worker._attempts = 0
+        worker._consumer = SimpleNamespace(was_consuming=False)
+        return worker
+
+    def test_exponential_backoff(self):
+        worker = self.get_worker()
+        delays = [worker._get_reconnect_delay() for x in range(10)]
+        for attempt, delay in enumerate(delays):
+            self.assertLessEqual(delay, min(2 ** attempt, 30))
+            self.assertGreaterEqual(delay, 0)
+
+        worker._consumer.was_consuming = True
+        self.assertLessEqual(worker._get_reconnect_delay(), 1)
+        self.assertEqual(worker._attempts, 1)
+
+    def test_jitter(self):
+        delays = {self.get_worker()._get_reconnect_delay()
+                  for x in range(20)}
+        self.assertGreater(len(delays), 1)
@@ -0,0 +1,56 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.column import Integer, String
+from anyblok import Declarations
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.consumer import BusConfigurationException
+from anyblok_bus.tests.testcase import (
+    MemoryWorkerTestCase, OneSchema, get_broker, is_settled, wait_until)
+
+
+class TestWorkerRetry(MemoryWorkerTestCase):
+
+    def test_retry_before_save(self):
+        broker = get_broker()
+        calls = []
+        saved = []
+
+        def add_in_registry():
+
+            @Declarations.register(Declarations.Model)
+            class Test:
+                id = Integer(primary_key=True)
+                label = String()
+                number = Integer()
+
+                @bus_consumer(queue_name='unittest_queue', deserialize=True,
+                              retry=50, max_retries=2)
+                def decorated_method(cls, body=None):
+                    calls.append(body)
+                    saved.append(cls.registry.Bus.Message.query().count())
+                    OneSchema().load(body)
+                    cls.insert(**body)
+                    return MessageStatus.ACK
+
+        registry = self.init_registry_with_bloks(('bus',), add_in_registry)
+        self.publish_messages(registry, 1, invalid=1)
+        worker, thread = self.start_worker(registry)
+        wait_until(lambda: len(calls) == 4 and is_settled(broker))
+        self.stop_worker(worker, thread)
+        # the valid message and three tries of the invalid one, saved
+        # after the last one
+        self.assertEqual(saved, [0, 0, 0, 0])
+        self.assertEqual(registry.Bus.Message.query().count(), 1)
+        self.assertIn('unittest_queue.retry.100', broker.queues)
+        self.assertFalse(broker.queues['unittest_queue'].messages)
+
+    def test_retry_with_batch(self):
+        with self.assertRaises(BusConfigurationException):
+            bus_consumer(queue_name='unittest_queue', retry=50,
+                         batch_size=10)
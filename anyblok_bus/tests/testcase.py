@@ -0,0 +1,101 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from json import dumps
+from threading import Thread
+from anyblok.tests.testcase import DBTestCase
+from anyblok.config import Configuration
+from anyblok.column import Integer, String
+from anyblok import Declarations
+from marshmallow import Schema, fields
+from anyblok_bus import bus_consumer
+from anyblok_bus.status import MessageStatus
+from anyblok_bus.worker import Worker
+from anyblok_bus.memory import MemoryBroker
+
+memory_url = 'memory://unittest'
+wait_timeout = 10
+
+
+def get_broker():
+    MemoryBroker.reset_all()
+    broker = MemoryBroker.get(memory_url)
+    broker.exchange_declare('unittest_exchange')
+    broker.queue_declare('unittest_queue')
+    broker.queue_bind('unittest_queue', 'unittest_exchange', 'unittest')
+    return broker
+
+
+def wait_until(predicate, timeout=wait_timeout):
+    """Wait until the predicate returns True, it is evaluated at each change
+    of the memory broker, the test fails after the timeout"""
+    broker = MemoryBroker.get(memory_url)
+    if not broker.wait_for(predicate, timeout):
+        raise AssertionError(
+            "Condition not reached after %r seconds" % timeout)
+
+
+def is_settled(broker, queue='unittest_queue'):
+    """Return True if all the messages of the queue are acked"""
+    memory_queue = broker.queues[queue]
+    return not memory_queue.messages and not any(
+        consumer.unacked for consumer in memory_queue.consumers)
+
+
+class OneSchema(Schema):
+    label = fields.String(required=True)
+    number = fields.Integer(required=True)
+
+
+class MemoryWorkerTestCase(DBTestCase):
+
+    @classmethod
+    def init_configuration_manager(cls, **env):
+        bus_profile = Configuration.get('bus_profile') or 'unittest'
+        env.update(dict(bus_profile=bus_profile))
+        super(MemoryWorkerTestCase, cls).init_configuration_manager(**env)
+
+    def tearDown(self):
+        MemoryBroker.reset_all()
+        super(MemoryWorkerTestCase, self).tearDown()
+
+    def start_worker(self, registry, worker_class=Worker):
+        bus_profile = Configuration.get('bus_profile')
+        registry.Bus.Profile.insert(name=bus_profile, url=memory_url)
+        worker = worker_class(registry, bus_profile,
+                              registry.Bus.get_consumers()[0][1],
+                              withautocommit=False)
+        thread = Thread(target=worker.start)
+        thread.start()
+        wait_until(worker.is_ready)
+        return worker, thread
+
+    def stop_worker(self, worker, thread):
+        worker.stop()
+        thread.join(wait_timeout)
+        self.assertFalse(thread.is_alive())
+
+    def add_in_registry(self):
+
+        @Declarations.register(Declarations.Model)
+        class Test:
+            id = Integer(primary_key=True)
+            label = String()
+            number = Integer()
+
+            @bus_consumer(queue_name='unittest_queue', schema=OneSchema())
+            def decorated_method(cls, body=None):
+                cls.insert(**body)
+                return MessageStatus.ACK
+
+    def publish_messages(self, registry, count, invalid=0):
+        registry.Bus.publish_many('unittest_exchange', [
+            ('unittest', dumps({'label': 'label', 'number': x}),
+             'application/json')
+            for x in range(count)] + [
+            ('unittest', dumps({'label': 'label'}), 'application/json')
+            for x in range(invalid)])
@@ -0,0 +1,103 @@
+# This file is a part of the AnyBlok / Bus api project
+#
+#    Copyright (C) 2019 Jean-Sebastien SUZANNE <js.suzanne@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import itertools
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class Watchdog:
+    """Log the stack of the handlers which run longer than their time budget
+
+    ::
+
+        watchdog = Watchdog()
+        with watchdog.watching('queue %r' % queue, timeout=10):
+            consumer(body=body)
+
+    The handlers are watched by a daemon thread, started at the first watch,
+    it only wakes up at the nearest deadline. A python thread can not be
+    killed, the slow handler goes on, its stack is logged once.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._watched = {}
+        self._sequence = itertools.count(1)
+        self._thread = None
+        self._stopping = False
+
+    def watch(self, label, timeout):
+        """Watch the current thread
+
+        :param label: the description of the handler in the log
+        :param timeout: seconds before the log of the stack
+        :rtype: the token given to ``unwatch``
+        """
+        token = next(self._sequence)
+        with self._condition:
+            self._watched[token] = (threading.get_ident(), label, timeout,
+                                    time.monotonic() + timeout)
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(
+                    target=self.run, name='anyblok-bus-watchdog', daemon=True)
+                self._thread.start()
+
+            self._condition.notify()
+
+        return token
+
+    def unwatch(self, token):
+        with self._condition:
+            self._watched.pop(token, None)
+
+    @contextmanager
+    def watching(self, label, timeout):
+        token = self.watch(label, timeout)
+        try:
+            yield
+        finally:
+            self.unwatch(token)
+
+    def run(self):
+        with self._condition:
+            while not self._stopping:
+                now = time.monotonic()
+                for token, watched in list(self._watched.items()):
+                    if watched[3] <= now:
+                        del self._watched[token]
+                        self.dump(*watched[:3])
+
+                deadlines = [watched[3] for watched in self._watched.values()]
+                self._condition.wait(
+                    min(deadlines) - now if deadlines else None)
+
+    @staticmethod
+    def dump(ident, label, timeout):
+        """Log the stack of the thread of the slow handler"""
+        frame = sys._current_frames().get(ident)
+        if frame is None:
+            return
+
+        logger.warning('%s runs for more than %r seconds:\n%s', label,
+                       timeout, ''.join(traceback.format_stack(frame)))
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+            thread, self._thread = self._thread, None
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
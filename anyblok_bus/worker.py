@@ -5,15 +5,97 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+import asyncio
 import functools
+import logging
+import random
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from anyblok.config import Configuration
+from anyblok_bus.connection import (
+    get_asyncio_connection, get_select_connection)
+from anyblok_bus.breaker import CircuitBreaker
+from anyblok_bus.prefetch import AdaptivePrefetch
+from anyblok_bus.consumer import BusConfigurationException
+from anyblok_bus.inbox import DuplicateMessage, InboxCache
 from anyblok_bus.status import MessageStatus
+from anyblok_bus.watchdog import Watchdog
 from logging import getLogger
-from pika import SelectConnection, URLParameters
+from pika.spec import Basic
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError
 
 logger = getLogger(__name__)
 
 
+def nack(channel, delivery_tag):
+    channel.basic_nack(delivery_tag)
+
+
+def reject(channel, delivery_tag):
+    channel.basic_reject(delivery_tag)
+
+
+SETTLEMENTS = {
+    MessageStatus.NACK: nack,
+    MessageStatus.REJECT: reject,
+}
+"""Settlement of the message by status, the other messages are acked, the
+messages in ERROR too because they are saved in ``Model.Bus.Message``"""
+
+
+class ConsumerChannel:
+    """The channel of one consumer of the worker
+
+    Each consumer has its own channel and its own prefetch, the delivery
+    tags are only known by this channel. When the channel is closed, a new
+    ``ConsumerChannel`` is created for the consumer, the messages consumed
+    with the old one can not be settled anymore.
+
+    :param queue: the consumed queue
+    :param model: the registry name of the model
+    :param method: the name of the consumer method
+    :param handler: the consumer method, resolved once by worker
+    """
+
+    def __init__(self, queue, model, method, handler):
+        self.queue = queue
+        self.model = model
+        self.method = method
+        self.handler = handler
+        self.description = description = handler.consumer
+        self.decode = description.decode
+        self.weight = description.weight
+        self.current_weight = 0
+        self.channel = None
+        self.consumer_tag = None
+        self.prefetch = 1
+        self.adaptive_prefetch = None
+        self.breaker = None
+        self.pending = deque()
+        self.batch = []
+        self.batch_timer = None
+        self.running = set()
+        self.publish_sequence = 0
+        self.retries = {}
+
+    @property
+    def is_open(self):
+        return self.channel is not None and self.channel.is_open
+
+    def has_unsettled_before(self, delivery_tag):
+        """Return True if a message older than the delivery tag is not
+        consumed yet"""
+        return (
+            (self.pending and self.pending[0][0].delivery_tag < delivery_tag)
+            or (self.batch and self.batch[0][0].delivery_tag < delivery_tag)
+            or any(tag < delivery_tag for tag in self.running))
+
+
 class Worker:
     """Define consumers to consume the queue défined in the AnyBlok registry
     by the bus_consumer decorator
@@ -33,8 +115,12 @@ class Worker:
     there are limited reasons why the connection may be closed, which
     usually are tied to permission related issues or socket timeouts.
 
-    If the channel is closed, it will indicate a problem with one of the
-    commands that were issued and that should surface in the output as well.
+    Each consumer has its own channel (:class:`ConsumerChannel`). If the
+    channel of a consumer is closed, only this consumer is restarted after
+    ``channel_restart_delay`` seconds, the others go on consuming. The
+    messages received by the consumers are consumed by weighted round
+    robin, a consumer with ``weight=3`` consumes 3 messages when a consumer
+    with the default weight consumes one.
 
     :param registry: anyblok registry instance
     :param profile: the name of the profile which give the url of rabbitmq
@@ -42,33 +128,103 @@ class Worker:
     :param withautocommit: default True, commit all the transaction
     """
 
+    async_consumers = False
+    """True if the worker consumes the consumers declared with async def"""
+
+    channel_restart_delay = 1.
+    """Seconds waited before opening again the closed channel of a
+    consumer"""
+
     def __init__(self, registry, profile, consumers, withautocommit=True):
         self.registry = registry
         self.profile = self.registry.Bus.Profile.query().filter_by(
             name=profile
         ).one()
+        self._url = None
         self.consumers = consumers
         self.withautocommit = withautocommit
-        self._consumer_tags = []
+        self._handlers = {
+            queue: getattr(self.registry.get(model), method)
+            for queue, model, method in consumers}
+        self._group_commit_size = Configuration.get('bus_group_commit_size', 0)
+        self._group_commit_delay = Configuration.get(
+            'bus_group_commit_delay', 100)
+        self._inbox_cache = InboxCache.get()
+        self._error_buffer_size = Configuration.get(
+            'bus_error_buffer_size', 100)
+        self._error_buffer_delay = Configuration.get(
+            'bus_error_buffer_delay', 100)
+        self._breaker_errors = Configuration.get('bus_breaker_errors', 0)
+        self._breaker_error_rate = Configuration.get(
+            'bus_breaker_error_rate', 0)
+        self._watchdog = Watchdog()
+        self._statement_timeout = Configuration.get('bus_statement_timeout')
+        self._executor_threads = Configuration.get('bus_executor_threads', 0)
+        if not self._executor_threads and self.has_timed_consumers():
+            # the ioloop must not be blocked by the slow consumers, else
+            # the heartbeats are missed and rabbitmq drops the connection
+            self._executor_threads = 1
+
+        if self._executor_threads and self._group_commit_size:
+            logger.warning('The group commit is not used with the executor '
+                           'threads')
+            self._group_commit_size = 0
+
+        self._default_prefetch = Configuration.get('bus_prefetch', 1)
+        self._adaptive_prefetch = Configuration.get('bus_prefetch_adaptive')
+        self._prefetch_max = Configuration.get('bus_prefetch_max', 1000)
+        self.reset()
+
+    def reset(self):
+        """Forget the state of the connection, the worker can be started
+        again after the lost of the connection. The profile and the
+        consumers are resolved once by worker"""
+        self._consumer_channels = {}
+        self._dispatch_scheduled = False
+        self._group = []
+        self._group_inbox = []
+        self._group_timer = None
+        self._errors = []
+        self._errors_timer = None
+        self._executor = None
+        if self._executor_threads:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._executor_threads,
+                thread_name_prefix='anyblok-bus-consumer')
 
         self.should_reconnect = False
         self.was_consuming = False
 
         self._connection = None
-        self._channel = None
         self._closing = False
         self._consuming = False
-        # In production, experiment with higher prefetch values
-        # for higher consumer throughput
-        self._prefetch_count = 1
+
+    @property
+    def ioloop(self):
+        """The ioloop of the connection"""
+        return self._connection.ioloop
+
+    def has_timed_consumers(self):
+        """Return True if a consumer called by the ioloop has a timeout"""
+        for handler in self._handlers.values():
+            description = handler.consumer
+            if description.timeout and not (
+                description.is_async and self.async_consumers
+            ):
+                return True
+
+        return False
 
     def get_url(self):
-        """ Retrieve connection url """
-        connection = self.profile
-        if connection:
-            return connection.url.url
+        """ Retrieve connection url, once by worker """
+        if self._url is None:
+            connection = self.profile
+            if not connection:
+                raise Exception("Unknown profile")
+
+            self._url = connection.url.url
 
-        raise Exception("Unknown profile")
+        return self._url
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -80,8 +236,8 @@ class Worker:
         """
         url = self.get_url()
         logger.info('Connecting to %s', url)
-        return SelectConnection(
-            parameters=URLParameters(url),
+        return get_select_connection(
+            url,
             on_open_callback=self.on_connection_open,
             on_open_error_callback=self.on_connection_open_error,
             on_close_callback=self.on_connection_closed)
@@ -107,7 +263,8 @@ class Worker:
         if self.withautocommit:
             self.registry.commit()
 
-        self.open_channel()
+        for queue, model, method in self.consumers:
+            self.open_channel(queue, model, method)
 
     def on_connection_open_error(self, _unused_connection, err):
         """This method is called by pika if the connection to RabbitMQ
@@ -130,9 +287,9 @@ class Worker:
             connection.
 
         """
-        self._channel = None
+        self._consumer_channels = {}
         if self._closing:
-            self._connection.ioloop.stop()
+            self.ioloop.stop()
         else:
             logger.warning('Connection closed, reconnect necessary: %s', reason)
             self.reconnect()
@@ -146,50 +303,131 @@ class Worker:
         self.should_reconnect = True
         self.stop()
 
-    def open_channel(self):
-        """Open a new channel with RabbitMQ by issuing the Channel.Open RPC
-        command. When RabbitMQ responds that the channel is open, the
-        on_channel_open callback will be invoked by pika.
+    def open_channel(self, queue, model, method):
+        """Open a new channel for the consumer with RabbitMQ by issuing the
+        Channel.Open RPC command. When RabbitMQ responds that the channel is
+        open, the on_channel_open callback will be invoked by pika.
 
         """
-        logger.info('Creating a new channel')
-        self._connection.channel(on_open_callback=self.on_channel_open)
-
-    def on_channel_open(self, channel):
+        handler = self._handlers.get(queue)
+        if handler is None:
+            handler = getattr(self.registry.get(model), method)
+
+        description = handler.consumer
+        if description.is_async and not self.async_consumers:
+            raise BusConfigurationException(
+                "The consumer %s:%s is declared with async def, it must be "
+                "consumed by the AsyncioWorker" % (model, method))
+
+        consumer = ConsumerChannel(queue, model, method, handler)
+        consumer.prefetch = self.get_prefetch(description)
+        if self._adaptive_prefetch and not description.prefetch:
+            consumer.adaptive_prefetch = AdaptivePrefetch(
+                initial=consumer.prefetch,
+                maximum=max(consumer.prefetch, self._prefetch_max),
+                minimum=(description.batch_size or self._group_commit_size
+                         or 1))
+
+        if self._breaker_errors or self._breaker_error_rate:
+            consumer.breaker = CircuitBreaker(
+                errors=self._breaker_errors,
+                error_rate=self._breaker_error_rate,
+                window=Configuration.get('bus_breaker_window', 100),
+                cooldown=Configuration.get('bus_breaker_cooldown', 30))
+
+        self._consumer_channels[queue] = consumer
+        logger.info('Creating a new channel for %r', queue)
+        self._connection.channel(
+            on_open_callback=functools.partial(self.on_channel_open, consumer))
+
+    def on_channel_open(self, consumer, channel):
         """This method is invoked by pika when the channel has been opened.
         The channel object is passed in so we can make use of it.
 
-        Since the channel is now open, we'll declare the exchange to use.
+        Since the channel is now open, we'll set the prefetch of the
+        consumer.
 
+        :param ConsumerChannel consumer: The consumer of the channel
         :param pika.channel.Channel channel: The channel object
 
         """
-        logger.info('Channel opened')
-        self._channel = channel
-        self.add_on_channel_close_callback()
-        self.set_qos()
-
-    def add_on_channel_close_callback(self):
-        """This method tells pika to call the on_channel_closed method if
-        RabbitMQ unexpectedly closes the channel.
+        logger.info('Channel opened for %r', consumer.queue)
+        consumer.channel = channel
+        channel.add_on_close_callback(
+            functools.partial(self.on_channel_closed, consumer))
+        channel.add_on_cancel_callback(
+            functools.partial(self.on_consumer_cancelled, consumer))
+        if consumer.description.retry:
+            self.declare_retry_queues(consumer)
+
+        self.set_qos(consumer)
+
+    def declare_retry_queues(self, consumer):
+        """Declare the delay queues of the consumer declared with ``retry``,
+        the messages expire after the delay of the queue and are
+        dead-lettered to the consumed queue. The retried messages are
+        published with the publisher confirms, the original message is
+        acked once the broker confirms the copy
 
         """
-        logger.info('Adding channel close callback')
-        self._channel.add_on_close_callback(self.on_channel_closed)
-
-    def on_channel_closed(self, channel, reason):
+        for queue, delay in consumer.description.get_retry_queues().items():
+            logger.info('Declare the delay queue %r of %d ms', queue, delay)
+            consumer.channel.queue_declare(queue, durable=True, arguments={
+                'x-message-ttl': delay,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': consumer.queue,
+            })
+
+        consumer.channel.confirm_delivery(
+            functools.partial(self.on_retry_confirm, consumer))
+
+    def on_channel_closed(self, consumer, channel, reason):
         """Invoked by pika when RabbitMQ unexpectedly closes the channel.
         Channels are usually closed if you attempt to do something that
         violates the protocol, such as re-declare an exchange or queue with
-        different parameters. In this case, we'll close the connection
-        to shutdown the object.
+        different parameters. In this case, only the consumer of this channel
+        is restarted, the connection is closed when all the channels are
+        closed by the stop of the worker.
 
+        :param ConsumerChannel consumer: The consumer of the channel
         :param pika.channel.Channel: The closed channel
         :param Exception reason: why the channel was closed
 
         """
-        logger.warning('Channel %i was closed: %s', channel, reason)
-        self.close_connection()
+        consumer.pending.clear()
+        del consumer.batch[:]
+        # the messages will be delivered again
+        self._errors = [error for error in self._errors
+                        if error[0] is not consumer]
+        if consumer.batch_timer is not None:
+            self.ioloop.remove_timeout(consumer.batch_timer)
+            consumer.batch_timer = None
+
+        if self._closing:
+            logger.info('Channel %i of %r was closed', channel, consumer.queue)
+            if not any(consumer.is_open
+                       for consumer in self._consumer_channels.values()):
+                self.close_connection()
+
+            return
+
+        logger.warning('Channel %i of %r was closed: %s, restart the '
+                       'consumer in %r seconds', channel, consumer.queue,
+                       reason, self.channel_restart_delay)
+        self.ioloop.call_later(
+            self.channel_restart_delay,
+            functools.partial(self.restart_consumer, consumer))
+
+    def restart_consumer(self, consumer):
+        """Open a new channel for the consumer of the closed channel"""
+        if (
+            self._closing or self._connection is None or
+            not self._connection.is_open or
+            self._consumer_channels.get(consumer.queue) is not consumer
+        ):
+            return
+
+        self.open_channel(consumer.queue, consumer.model, consumer.method)
 
     def on_bindok(self, _unused_frame, userdata):
         """Invoked by pika when the Queue.Bind method has completed. At this
@@ -201,46 +439,110 @@ class Worker:
         """
         logger.info('Queue bound: %s', userdata)
 
-    def set_qos(self):
-        """This method sets up the consumer prefetch to only be delivered
-        one message at a time. The consumer must acknowledge this message
-        before RabbitMQ will deliver another one. You should experiment
-        with different prefetch values to achieve desired performance.
+    def set_qos(self, consumer):
+        """This method sets up the prefetch of the consumer, before its
+        Basic.Consume. The QoS is by consumer, RabbitMQ refuses the
+        consumers of the quorum queues on a channel with a global QoS
+
+        """
+        consumer.channel.basic_qos(
+            prefetch_count=consumer.prefetch,
+            callback=functools.partial(self.on_basic_qos_ok, consumer))
+
+    def set_prefetch(self, consumer, prefetch):
+        """Change the prefetch of a consumer: the prefetch of a consumer
+        can not be changed once it consumes, so it is cancelled and it
+        consumes again with the new prefetch. The delivered messages are
+        still settled on the channel, the messages delivered after the
+        cancel are requeued by pika
+
+        :param ConsumerChannel consumer: the consumer
+        :param int prefetch: the new prefetch
+        """
+        if not consumer.is_open:
+            return
+
+        if consumer.consumer_tag:
+            consumer.channel.basic_cancel(consumer.consumer_tag)
+            consumer.consumer_tag = None
+
+        def on_qos_ok(_unused_frame):
+            if not self._closing and consumer.is_open:
+                self.declare_consumer(consumer)
 
+        consumer.channel.basic_qos(prefetch_count=prefetch,
+                                   callback=on_qos_ok)
+
+    def adapt_prefetch(self, consumer, duration, count=1):
+        """Record the duration of the handler, and change the prefetch of
+        the channel of the consumer if the adaptive mode asks it
+
+        :param ConsumerChannel consumer: the consumer of the messages
+        :param float duration: seconds spent by the handler
+        :param int count: number of handled messages
         """
-        self._channel.basic_qos(
-            prefetch_count=self._prefetch_count, callback=self.on_basic_qos_ok)
+        if consumer.adaptive_prefetch is None:
+            return
+
+        prefetch = consumer.adaptive_prefetch.record(duration, count=count)
+        if prefetch is not None and consumer.is_open:
+            logger.info('Adapt the prefetch of %r to %d', consumer.queue,
+                        prefetch)
+            consumer.prefetch = prefetch
+            self.set_prefetch(consumer, prefetch)
 
-    def on_basic_qos_ok(self, _unused_frame):
+    def on_basic_qos_ok(self, consumer, _unused_frame):
         """Invoked by pika when the Basic.QoS method has completed. At this
         point we will start consuming messages by calling start_consuming
         which will invoke the needed RPC commands to start the process.
 
+        :param ConsumerChannel consumer: The consumer of the channel
         :param pika.frame.Method _unused_frame: The Basic.QosOk response frame
 
         """
-        logger.info('QOS set to: %d', self._prefetch_count)
-        self.start_consuming()
+        logger.info('QOS of %r set to: %d', consumer.queue, consumer.prefetch)
+        self.start_consuming(consumer)
 
-    def start_consuming(self):
-        """This method sets up the consumer by first calling
-        add_on_cancel_callback so that the object is notified if RabbitMQ
-        cancels the consumer. It then issues the Basic.Consume RPC command
-        which returns the consumer tag that is used to uniquely identify the
-        consumer with RabbitMQ. We keep the value to use it when we want to
-        cancel consuming. The on_message method is passed in as a callback pika
-        will invoke when a message is fully received.
+    def start_consuming(self, consumer):
+        """This method issues the Basic.Consume RPC command which returns
+        the consumer tag that is used to uniquely identify the consumer with
+        RabbitMQ. We keep the value to use it when we want to cancel
+        consuming. The worker is ready when all its consumers are consuming.
 
         """
-        logger.info('Issuing consumer related RPC commands')
-        self.add_on_cancel_callback()
-        for queue, model, method in self.consumers:
-            self.declare_consumer(queue, model, method)
-
-        self.was_consuming = True
-        self._consuming = True
-
-    def declare_consumer(self, queue, model, method):
+        logger.info('Issuing consumer related RPC commands for %r',
+                    consumer.queue)
+        self.declare_consumer(consumer)
+        if all(consumer.consumer_tag
+               for consumer in self._consumer_channels.values()):
+            self.was_consuming = True
+            self._consuming = True
+
+    def get_prefetch(self, description):
+        """Return the prefetch of the consumer"""
+        prefetch = description.prefetch or self._default_prefetch
+        if not description.prefetch:
+            # one message by thread, and enough messages for the weight
+            prefetch = max(prefetch, self._executor_threads,
+                           description.weight)
+
+        if description.is_async:
+            # the prefetch limits the number of running coroutines
+            prefetch = description.concurrency or prefetch
+        elif description.batch_size:
+            # the batch can not be filled with a lower prefetch
+            prefetch = max(prefetch, description.batch_size)
+        elif self._group_commit_size:
+            prefetch = max(prefetch, self._group_commit_size)
+
+        return prefetch
+
+    def declare_consumer(self, consumer):
+        if consumer.description.batch_size:
+            return self.declare_batch_consumer(consumer)
+
+        queue = consumer.queue
+        is_async = consumer.description.is_async
 
         def on_message(_unused_channel, basic_deliver, properties, body):
             """Invoked by pika when a message is delivered from RabbitMQ. The
@@ -256,124 +558,866 @@ class Worker:
             :param bytes body: The message body
 
             """
-            logger.info(
-                'Received message on %r # %s from %s',
-                queue, basic_deliver.delivery_tag, properties.app_id)
-            logger.debug(
-                'Received message on %r # %s from %s: %s',
-                queue, basic_deliver.delivery_tag, properties.app_id, body)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    'Received message on %r # %s from %s',
+                    queue, basic_deliver.delivery_tag, properties.app_id)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        'Received message on %r # %s from %s: %s', queue,
+                        basic_deliver.delivery_tag, properties.app_id, body)
+
+            if is_async:
+                self.consume_async_message(
+                    consumer, basic_deliver, properties, body)
+            elif len(self._consumer_channels) == 1:
+                # nothing to share
+                self.dispatch_message(
+                    consumer, basic_deliver, properties, body)
+            else:
+                consumer.pending.append((basic_deliver, properties, body))
+                self.schedule_dispatch()
+
+        return self.basic_consume(consumer, on_message)
+
+    def schedule_dispatch(self):
+        """Call ``dispatch`` at the next iteration of the ioloop, after the
+        reception of the delivered messages"""
+        if not self._dispatch_scheduled:
+            self._dispatch_scheduled = True
+            self.ioloop.call_later(0, self.dispatch)
+
+    def dispatch(self):
+        """Consume one round of the pending messages, the next round is
+        consumed after the reception of the next delivered messages"""
+        self._dispatch_scheduled = False
+        if self._closing:
+            # the pending messages are requeued by the close of the channels
+            return
+
+        for consumer in self._consumer_channels.values():
+            if not consumer.pending:
+                consumer.current_weight = 0
+
+        for index in range(sum(consumer.weight for consumer
+                               in self._consumer_channels.values())):
+            consumer = self.get_next_consumer()
+            if consumer is None:
+                return
+
+            self.dispatch_message(consumer, *consumer.pending.popleft())
+
+        self.schedule_dispatch()
+
+    def get_next_consumer(self):
+        """Return the next consumer with a pending message by smooth
+        weighted round robin, None if no message is pending"""
+        selected = None
+        total = 0
+        for consumer in self._consumer_channels.values():
+            if consumer.pending:
+                consumer.current_weight += consumer.weight
+                total += consumer.weight
+                if (
+                    selected is None or
+                    consumer.current_weight > selected.current_weight
+                ):
+                    selected = consumer
+
+        if selected is not None:
+            selected.current_weight -= total
+
+        return selected
+
+    def dispatch_message(self, consumer, basic_deliver, properties, body):
+        if self._group_commit_size:
+            self.consume_in_group(consumer, basic_deliver, properties, body)
+        else:
+            self.submit(consumer, [basic_deliver.delivery_tag],
+                        self.consume_message, consumer, basic_deliver,
+                        properties, body)
+
+    def submit(self, consumer, delivery_tags, function, *args):
+        """Call the function in the thread pool of the executor mode, else
+        directly in the ioloop
+
+        :param consumer: the consumer of the messages
+        :param delivery_tags: the delivery tags of the consumed messages,
+                              they are nacked if the function fails in the
+                              thread pool
+        """
+        if self._executor is None:
+            return function(*args)
+
+        if self._closing:
+            # delivered before the cancel, requeued by the close of the
+            # channel
+            return
+
+        consumer.running.update(delivery_tags)
+        self._executor.submit(
+            self.run_in_executor, consumer, delivery_tags, function, *args)
+
+    def run_in_executor(self, consumer, delivery_tags, function, *args):
+        """Call the function in a thread of the pool, each thread has its
+        own session of the registry"""
+        try:
+            function(*args)
+        except Exception:
+            logger.exception('Error in the executor, the messages %r are '
+                             'requeued', delivery_tags)
             self.registry.rollback()
-            error = ""
-            try:
-                Model = self.registry.get(model)
-                status = getattr(Model, method)(body=body.decode('utf-8'))
+            self.call_in_ioloop(
+                self.settle_consumed, consumer,
+                [(delivery_tag, MessageStatus.NACK)
+                 for delivery_tag in delivery_tags], 0)
+
+    def call_in_ioloop(self, callback, *args):
+        """Call the callback in the thread of the ioloop, the channel must
+        only be used by this thread"""
+        if self._executor is None:
+            callback(*args)
+        else:
+            self.ioloop.add_callback_threadsafe(
+                functools.partial(callback, *args))
+
+    def settle_consumed(self, consumer, statuses, duration):
+        """Settle the committed messages and adapt the prefetch
+
+        :param consumer: the consumer of the messages
+        :param statuses: list of tuple (delivery_tag, status)
+        :param float duration: seconds spent to consume the messages
+        """
+        consumer.running.difference_update(
+            delivery_tag for delivery_tag, status in statuses)
+        if not consumer.is_open:
+            logger.warning('Channel of %r closed, %d consumed messages can '
+                           'not be acked', consumer.queue, len(statuses))
+            return
+
+        self.settle(consumer, statuses)
+        self.adapt_prefetch(consumer, duration, count=len(statuses))
+        self.check_breaker(consumer, statuses)
+
+    def check_breaker(self, consumer, statuses):
+        """Record the statuses in the circuit breaker of the consumer, the
+        nacked and rejected messages are not recorded
+
+        :param consumer: the consumer of the messages
+        :param statuses: list of tuple (delivery_tag, status)
+        """
+        if consumer.breaker is None:
+            return
+
+        for delivery_tag, status in statuses:
+            if status is MessageStatus.NACK or status is MessageStatus.REJECT:
+                continue
+
+            state = consumer.breaker.record(
+                status is MessageStatus.ERROR or status is None)
+            if state == CircuitBreaker.OPEN:
+                self.open_breaker(consumer)
+            elif state == CircuitBreaker.CLOSED:
+                self.close_breaker(consumer)
+
+    def open_breaker(self, consumer):
+        """Cancel the consumer, the received messages are requeued, they
+        stay in RabbitMQ until the probe of the consumer"""
+        logger.warning('Too many messages in error on %r, the consumer is '
+                       'paused for %r seconds', consumer.queue,
+                       consumer.breaker.cooldown)
+        if not consumer.is_open:
+            return
+
+        if consumer.consumer_tag:
+            consumer.channel.basic_cancel(consumer.consumer_tag)
+            consumer.consumer_tag = None
+
+        if consumer.batch_timer is not None:
+            self.ioloop.remove_timeout(consumer.batch_timer)
+            consumer.batch_timer = None
+
+        deliveries = list(consumer.pending) + consumer.batch
+        consumer.pending.clear()
+        consumer.batch = []
+        for basic_deliver, properties, body in deliveries:
+            consumer.channel.basic_nack(basic_deliver.delivery_tag)
+
+        self.ioloop.call_later(consumer.breaker.cooldown,
+                               functools.partial(self.probe, consumer))
+
+    def probe(self, consumer):
+        """Consume one message after the cooldown of the circuit breaker"""
+        if (
+            self._closing or not consumer.is_open or
+            self._consumer_channels.get(consumer.queue) is not consumer
+        ):
+            return
+
+        logger.info('Probe the consumer of %r with one message',
+                    consumer.queue)
+        consumer.breaker.half_open()
+        self.set_prefetch(consumer, 1)
+
+    def close_breaker(self, consumer):
+        """The probe succeeded, consume again with the prefetch"""
+        logger.info('The consumer of %r is resumed', consumer.queue)
+        self.set_prefetch(consumer, consumer.prefetch)
+
+    def consume_message(self, consumer, basic_deliver, properties, body):
+        """Consume the message in its own transaction, the message is
+        settled after the commit"""
+        self.registry.rollback()
+        error = ""
+        started = time.perf_counter()
+        try:
+            status = self.call_consumer(consumer, properties, body)
+            if logger.isEnabledFor(logging.DEBUG):
                 logger.debug('Message delivery_tag=%r and app_id=%r '
                              'is consumed with status=%r',
                              basic_deliver.delivery_tag, properties.app_id,
                              status)
-            except Exception as e:
-                logger.exception('Error during consumation of queue %r' % queue)
-                self.registry.rollback()
-                status = MessageStatus.ERROR
-                error = str(e)
-
-            if status is MessageStatus.ACK:
-                self._channel.basic_ack(basic_deliver.delivery_tag)
-                logger.info('ack queue %s tag %r',
-                            queue, basic_deliver.delivery_tag)
-            elif status is MessageStatus.NACK:
-                self._channel.basic_nack(basic_deliver.delivery_tag)
-                logger.info('nack queue %s tag %r',
-                            queue, basic_deliver.delivery_tag)
-            elif status is MessageStatus.REJECT:
-                self._channel.basic_reject(basic_deliver.delivery_tag)
-                logger.info('reject queue %s tag %r',
-                            queue, basic_deliver.delivery_tag)
-            elif status is MessageStatus.ERROR or status is None:
-                self.registry.Bus.Message.insert(
-                    content_type=properties.content_type, message=body,
-                    queue=queue, model=model, method=method,
-                    error=error, sequence=basic_deliver.delivery_tag,
-                )
-                self._channel.basic_ack(basic_deliver.delivery_tag)
-                logger.info('save message of the queue %s tag %r',
-                            queue, basic_deliver.delivery_tag)
+        except DuplicateMessage:
+            logger.info('Message %r of the queue %r already consumed',
+                        properties.message_id, consumer.queue)
+            self.registry.rollback()
+            status = MessageStatus.ACK
+        except Exception as e:
+            logger.exception('Error during consumation of queue %r' %
+                             consumer.queue)
+            self.registry.rollback()
+            status = MessageStatus.ERROR
+            error = str(e)
 
+        self.finish_message(consumer, basic_deliver, properties, body,
+                            status, error, started)
+
+    def call_consumer(self, consumer, properties, body):
+        """Call the consumer with the decoded body, in its time budget if
+        it is declared with a timeout
+
+        :exception: DuplicateMessage if the idempotent consumer already
+                    consumed the message, the transaction must be rolled
+                    back
+        """
+        self.check_duplicate(consumer, properties)
+        if consumer.description.timeout is None:
+            status = consumer.handler(body=consumer.decode(
+                body, properties.content_type, properties.content_encoding))
+        else:
+            with self.watch_consumer(consumer):
+                status = consumer.handler(body=consumer.decode(
+                    body, properties.content_type,
+                    properties.content_encoding))
+
+        self.record_consumed(consumer, properties, status)
+        return status
+
+    def check_duplicate(self, consumer, properties):
+        """Raise DuplicateMessage if the message of an idempotent consumer
+        is in the cache of the committed ids of the inbox
+
+        The inbox is not queried, the other duplicates are found by the
+        primary key at the insert of ``record_consumed``: a new message
+        only costs this insert.
+        """
+        if (
+            consumer.description.idempotent and properties.message_id and
+            (consumer.queue, properties.message_id) in self._inbox_cache
+        ):
+            raise DuplicateMessage(properties.message_id)
+
+    def record_consumed(self, consumer, properties, status):
+        """Insert the id of the acked message of an idempotent consumer in
+        ``Model.Bus.Inbox``, in the transaction of the consumer
+
+        :exception: DuplicateMessage if the id is already in the inbox, the
+                    message was consumed by another transaction
+        """
+        if (
+            consumer.description.idempotent and properties.message_id and
+            status is MessageStatus.ACK
+        ):
+            try:
+                self.registry.Bus.Inbox.record(consumer.queue,
+                                               properties.message_id)
+            except IntegrityError:
+                raise DuplicateMessage(properties.message_id)
+
+    def remember_consumed(self, consumer, properties, status):
+        """Add the id of the committed message in the cache of the inbox"""
+        if (
+            consumer.description.idempotent and properties.message_id and
+            status is MessageStatus.ACK
+        ):
+            self._inbox_cache.add((consumer.queue, properties.message_id))
+
+    def watch_consumer(self, consumer):
+        """Return the context of the call of the consumer: the watchdog
+        logs the stack of the consumer if it overruns its timeout, and the
+        timeout is also the statement timeout of the transaction with
+        ``bus_statement_timeout``"""
+        timeout = consumer.description.timeout
+        if timeout is None:
+            return nullcontext()
+
+        if self._statement_timeout:
+            self.set_statement_timeout(timeout)
+
+        return self._watchdog.watching(
+            'The consumer %s:%s of %r' % (consumer.model, consumer.method,
+                                          consumer.queue), timeout)
+
+    def set_statement_timeout(self, timeout):
+        """Cancel the queries of the transaction which run longer than the
+        timeout, only for PostgreSQL"""
+        if self.registry.engine.dialect.name != 'postgresql':
+            return
+
+        self.registry.execute(text(
+            'SET LOCAL statement_timeout = %d' % int(timeout * 1000)))
+
+    def get_error_entry(self, consumer, basic_deliver, properties, body,
+                        error):
+        """Return the entry of ``Model.Bus.Message`` of a message in error"""
+        return self.registry.Bus.Message.get_entry(
+            consumer.queue, consumer.model, consumer.method, body,
+            content_type=properties.content_type,
+            content_encoding=properties.content_encoding,
+            error=error, publish_date=(
+                datetime.fromtimestamp(properties.timestamp)
+                if properties.timestamp else None))
+
+    def finish_message(self, consumer, basic_deliver, properties, body,
+                       status, error, started):
+        """Commit and settle the message, the message in error is saved by
+        the error buffer, it is settled after the save"""
+        if status is MessageStatus.ERROR or status is None:
+            if consumer.description.can_retry(properties):
+                if self.withautocommit:
+                    self.registry.commit()
+
+                self.call_in_ioloop(self.retry_message, consumer,
+                                    basic_deliver, properties, body)
+                return
+
+            entry = self.get_error_entry(consumer, basic_deliver, properties,
+                                         body, error)
+            logger.info('save message of the queue %s tag %r',
+                        consumer.queue, basic_deliver.delivery_tag)
+            if self._error_buffer_size:
+                if self.withautocommit:
+                    self.registry.commit()
+
+                self.call_in_ioloop(self.buffer_error, consumer,
+                                    basic_deliver.delivery_tag, entry)
+                return
+
+            self.registry.Bus.Message.insert_many([entry])
+        elif logger.isEnabledFor(logging.INFO):
+            logger.info('%s queue %s tag %r', status.name.lower(),
+                        consumer.queue, basic_deliver.delivery_tag)
+
+        if self.withautocommit:
+            self.registry.commit()
+
+        self.remember_consumed(consumer, properties, status)
+        self.call_in_ioloop(
+            self.settle_consumed, consumer,
+            [(basic_deliver.delivery_tag, status)],
+            time.perf_counter() - started)
+
+    def retry_message(self, consumer, basic_deliver, properties, body):
+        """Publish the message in error in the delay queue of its next
+        retry, the message is acked when the broker confirms the
+        publication"""
+        delivery_tag = basic_deliver.delivery_tag
+        consumer.running.discard(delivery_tag)
+        if not consumer.is_open:
+            logger.warning('Channel of %r closed, the message in error %r '
+                           'will be delivered again', consumer.queue,
+                           delivery_tag)
+            return
+
+        queue = consumer.description.get_retry_queue(
+            consumer.description.get_retries(properties))
+        logger.info('retry the message of the queue %s tag %r by %s',
+                    consumer.queue, delivery_tag, queue)
+        # the headers are kept, the broker adds the retry in x-death
+        consumer.channel.basic_publish('', queue, body, properties)
+        consumer.publish_sequence += 1
+        consumer.retries[consumer.publish_sequence] = delivery_tag
+        consumer.running.add(delivery_tag)
+        self.check_breaker(consumer, [(delivery_tag, MessageStatus.ERROR)])
+
+    def on_retry_confirm(self, consumer, method_frame):
+        """Invoked by pika when the broker confirms the publications in the
+        delay queues, the original messages are acked, or requeued if the
+        broker nacks the publication
+
+        :param ConsumerChannel consumer: The consumer of the channel
+        :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
+        """
+        method = method_frame.method
+        if method.multiple:
+            sequences = [sequence for sequence in consumer.retries
+                         if sequence <= method.delivery_tag]
+        else:
+            sequences = [method.delivery_tag]
+
+        for sequence in sequences:
+            delivery_tag = consumer.retries.pop(sequence, None)
+            if delivery_tag is None:
+                continue
+
+            consumer.running.discard(delivery_tag)
+            if not consumer.is_open:
+                continue
+
+            # single ack, the group commit does not track its messages
+            if isinstance(method, Basic.Ack):
+                consumer.channel.basic_ack(delivery_tag)
+            else:
+                consumer.channel.basic_nack(delivery_tag)
+
+    def buffer_error(self, consumer, delivery_tag, entry):
+        """Keep the message in error until the flush of the error buffer,
+        every ``bus_error_buffer_size`` messages or after
+        ``bus_error_buffer_delay`` milliseconds
+
+        The buffered messages are not acked, the buffer is also flushed when
+        they fill the prefetch of the consumer, no message would be
+        delivered until the timeout.
+        """
+        consumer.running.add(delivery_tag)
+        self._errors.append((consumer, delivery_tag, entry))
+        self.check_breaker(consumer, [(delivery_tag, MessageStatus.ERROR)])
+        if (
+            len(self._errors) >= self._error_buffer_size or
+            len(consumer.running) >= consumer.prefetch
+        ):
+            self.flush_errors()
+        elif self._errors_timer is None:
+            self._errors_timer = self.ioloop.call_later(
+                self._error_buffer_delay / 1000., self.on_errors_timeout)
+
+    def on_errors_timeout(self):
+        self._errors_timer = None
+        self.flush_errors()
+
+    def flush_errors(self):
+        """Save the buffered messages in error with one insert, and ack
+        them after the commit"""
+        if self._errors_timer is not None:
+            self.ioloop.remove_timeout(self._errors_timer)
+            self._errors_timer = None
+
+        errors, self._errors = self._errors, []
+        if not errors:
+            return
+
+        status = MessageStatus.ERROR
+        try:
+            self.registry.Bus.Message.insert_many(
+                [entry for consumer, delivery_tag, entry in errors])
             if self.withautocommit:
                 self.registry.commit()
 
-        self._consumer_tags.append(
-            self._channel.basic_consume(
-                queue, on_message,
-                arguments=dict(model=model, method=method)
-            )
-        )
+            logger.info('%d messages in error saved', len(errors))
+        except Exception:
+            logger.exception('Save of %d messages in error failed, they are '
+                             'requeued', len(errors))
+            self.registry.rollback()
+            status = MessageStatus.NACK
+
+        consumers = {}
+        for consumer, delivery_tag, entry in errors:
+            consumers.setdefault(consumer, []).append((delivery_tag, status))
+
+        for consumer, statuses in consumers.items():
+            consumer.running.difference_update(
+                delivery_tag for delivery_tag, status in statuses)
+            if consumer.is_open:
+                self.settle(consumer, statuses)
+
+    def consume_in_group(self, consumer, basic_deliver, properties, body):
+        """Consume the message in a savepoint, the transaction is committed
+        every ``bus_group_commit_size`` messages or after
+        ``bus_group_commit_delay`` milliseconds, the messages are acked
+        after the commit
+
+        """
+        if not self._group:
+            self.registry.rollback()
+
+        error = ""
+        started = time.perf_counter()
+        savepoint = self.registry.begin_nested()
+        try:
+            status = self.call_consumer(consumer, properties, body)
+            savepoint.commit()
+        except DuplicateMessage:
+            logger.info('Message %r of the queue %r already consumed',
+                        properties.message_id, consumer.queue)
+            savepoint.rollback()
+            status = MessageStatus.ACK
+        except Exception as e:
+            logger.exception('Error during consumation of queue %r' %
+                             consumer.queue)
+            savepoint.rollback()
+            status = MessageStatus.ERROR
+            error = str(e)
+
+        entry = None
+        if status is MessageStatus.ERROR or status is None:
+            if consumer.description.can_retry(properties):
+                self.retry_message(consumer, basic_deliver, properties, body)
+                return
+
+            entry = self.get_error_entry(consumer, basic_deliver, properties,
+                                         body, error)
+
+        self._group.append(
+            (consumer, basic_deliver.delivery_tag, status, entry))
+        if consumer.description.idempotent:
+            self._group_inbox.append((consumer, properties, status))
+
+        self.adapt_prefetch(consumer, time.perf_counter() - started)
+        if len(self._group) >= self._group_commit_size:
+            self.commit_group()
+        elif self._group_timer is None:
+            self._group_timer = self.ioloop.call_later(
+                self._group_commit_delay / 1000., self.on_group_timeout)
+
+    def on_group_timeout(self):
+        self._group_timer = None
+        self.commit_group()
+
+    def commit_group(self):
+        """Commit the messages consumed in group and settle them"""
+        if self._group_timer is not None:
+            self.ioloop.remove_timeout(self._group_timer)
+            self._group_timer = None
+
+        group, self._group = self._group, []
+        inbox, self._group_inbox = self._group_inbox, []
+        if not group:
+            return
+
+        if not all(consumer.is_open
+                   for consumer, delivery_tag, status, entry in group):
+            # the messages of the closed channel will be delivered again,
+            # the other ones are requeued
+            logger.warning('Channel closed, %d consumed messages are '
+                           'rolled back', len(group))
+            self.registry.rollback()
+            self.nack_group(group)
+            return
+
+        try:
+            self.registry.Bus.Message.insert_many(
+                [entry for consumer, delivery_tag, status, entry in group
+                 if entry is not None])
+            if self.withautocommit:
+                self.registry.commit()
+        except Exception:
+            logger.exception('Commit of %d messages failed, they are '
+                             'requeued', len(group))
+            self.registry.rollback()
+            self.nack_group(group)
+            return
+
+        for consumer, properties, status in inbox:
+            self.remember_consumed(consumer, properties, status)
+
+        consumers = {}
+        for consumer, delivery_tag, status, entry in group:
+            consumers.setdefault(consumer, []).append((delivery_tag, status))
+
+        for consumer, statuses in consumers.items():
+            self.settle(consumer, statuses)
+            self.check_breaker(consumer, statuses)
+
+        logger.info('%d messages committed', len(group))
+
+    def nack_group(self, group):
+        for consumer, delivery_tag, status, entry in group:
+            if consumer.is_open:
+                consumer.channel.basic_nack(delivery_tag)
+
+    def settle(self, consumer, statuses):
+        """Send the nacks, the rejects and the acks of the consumed messages
+
+        :param consumer: the consumer of the messages
+        :param statuses: list of tuple (delivery_tag, status), the messages
+                         with an ERROR status are acked because they are
+                         saved in ``Model.Bus.Message``
+        """
+        acks = []
+        for delivery_tag, status in statuses:
+            settlement = SETTLEMENTS.get(status)
+            if settlement is None:
+                acks.append(delivery_tag)
+            else:
+                settlement(consumer.channel, delivery_tag)
+
+        # the multiple ack must not ack the nacked and rejected messages
+        self.ack(consumer, acks)
+
+    def basic_consume(self, consumer, on_message):
+        logger.info('Consume %r with prefetch %d', consumer.queue,
+                    consumer.prefetch)
+        consumer.consumer_tag = consumer.channel.basic_consume(
+            consumer.queue, on_message,
+            arguments=dict(model=consumer.model, method=consumer.method))
         return True
 
-    def is_ready(self):
-        return self._consuming
+    def declare_batch_consumer(self, consumer):
+        """Declare a consumer which gets the messages by batch
 
-    def add_on_cancel_callback(self):
-        """Add a callback that will be invoked if RabbitMQ cancels the consumer
-        for some reason. If RabbitMQ does cancel the consumer,
-        on_consumer_cancelled will be invoked by pika.
+        The messages are kept until the batch is full or until the oldest
+        one waited ``batch_timeout`` seconds, then they are consumed in one
+        call and one commit.
 
         """
-        logger.info('Adding consumer cancellation callback')
-        self._channel.add_on_cancel_callback(self.on_consumer_cancelled)
+        description = consumer.description
 
-    def on_consumer_cancelled(self, method_frame):
+        def on_message(_unused_channel, basic_deliver, properties, body):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    'Received message on %r # %s from %s: %s', consumer.queue,
+                    basic_deliver.delivery_tag, properties.app_id, body)
+            consumer.batch.append((basic_deliver, properties, body))
+            if len(consumer.batch) >= description.batch_size:
+                self.flush_batch(consumer)
+            elif consumer.batch_timer is None:
+                consumer.batch_timer = self.ioloop.call_later(
+                    description.batch_timeout,
+                    functools.partial(self.on_batch_timeout, consumer))
+
+        return self.basic_consume(consumer, on_message)
+
+    def on_batch_timeout(self, consumer):
+        consumer.batch_timer = None
+        self.flush_batch(consumer)
+
+    def flush_batch(self, consumer):
+        """Consume the messages kept in the batch of the consumer"""
+        if consumer.batch_timer is not None:
+            self.ioloop.remove_timeout(consumer.batch_timer)
+            consumer.batch_timer = None
+
+        deliveries, consumer.batch = consumer.batch, []
+        if deliveries and consumer.is_open:
+            self.submit(consumer, [delivery[0].delivery_tag
+                                   for delivery in deliveries],
+                        self.consume_batch, consumer, deliveries)
+
+    @staticmethod
+    def call_batch_consumer(method, description, deliveries):
+        """Call the consumer with the bodies of the deliveries
+
+        :rtype: list of the statuses, one by delivery
+        """
+        bodies = [description.decode(body, properties.content_type,
+                                     properties.content_encoding)
+                  for basic_deliver, properties, body in deliveries]
+        status = method(body=bodies)
+        if not isinstance(status, (list, tuple)):
+            return [status] * len(deliveries)
+
+        if len(status) != len(deliveries):
+            raise BusConfigurationException(
+                "The consumer returns %d statuses for %d messages" % (
+                    len(status), len(deliveries)))
+
+        return list(status)
+
+    def consume_batch(self, consumer, deliveries):
+        """Consume a batch of deliveries in one transaction
+
+        If the consumer raises an exception, the messages are consumed one by
+        one in savepoints, only the messages in error are saved in
+        ``Model.Bus.Message``. The messages are acked after the commit.
+
+        """
+        logger.info('Received %d messages on %r # %s to %s', len(deliveries),
+                    consumer.queue, deliveries[0][0].delivery_tag,
+                    deliveries[-1][0].delivery_tag)
+        self.commit_group()
+        self.registry.rollback()
+        started = time.perf_counter()
+        errors = [""] * len(deliveries)
+        try:
+            with self.watch_consumer(consumer):
+                statuses = self.call_batch_consumer(
+                    consumer.handler, consumer.description, deliveries)
+        except Exception:
+            logger.exception('Error during consumation of a batch of queue '
+                             '%r, consume the messages one by one',
+                             consumer.queue)
+            self.registry.rollback()
+            statuses = None
+
+        if statuses is None:
+            statuses, errors = self.consume_one_by_one(consumer, deliveries)
+
+        self.registry.Bus.Message.insert_many([
+            self.get_error_entry(consumer, basic_deliver, properties, body,
+                                 error)
+            for (basic_deliver, properties, body), status, error in zip(
+                deliveries, statuses, errors)
+            if status is MessageStatus.ERROR or status is None])
+
+        if self.withautocommit:
+            self.registry.commit()
+
+        logger.info('%d messages of the queue %r consumed',
+                    len(deliveries), consumer.queue)
+        self.call_in_ioloop(
+            self.settle_consumed, consumer,
+            [(basic_deliver.delivery_tag, status)
+             for (basic_deliver, properties, body), status in zip(
+                 deliveries, statuses)],
+            time.perf_counter() - started)
+
+    def consume_one_by_one(self, consumer, deliveries):
+        """Consume each delivery of a batch in a savepoint
+
+        :rtype: tuple (statuses, errors)
+        """
+        statuses = []
+        errors = []
+        for delivery in deliveries:
+            savepoint = self.registry.begin_nested()
+            try:
+                with self.watch_consumer(consumer):
+                    statuses.extend(self.call_batch_consumer(
+                        consumer.handler, consumer.description, [delivery]))
+                errors.append("")
+                savepoint.commit()
+            except Exception as e:
+                logger.exception('Error during consumation of queue %r',
+                                 consumer.queue)
+                savepoint.rollback()
+                statuses.append(MessageStatus.ERROR)
+                errors.append(str(e))
+
+        return statuses, errors
+
+    def ack(self, consumer, delivery_tags):
+        """Ack the messages, with one multiple ack when no message before
+        the last one is still to consume by the consumer
+
+        The nacked and rejected messages must be sent before.
+
+        """
+        if not delivery_tags:
+            return
+
+        last = max(delivery_tags)
+        if (
+            len(delivery_tags) > 1 and
+            not consumer.has_unsettled_before(last)
+        ):
+            consumer.channel.basic_ack(last, multiple=True)
+            return
+
+        for delivery_tag in delivery_tags:
+            consumer.channel.basic_ack(delivery_tag)
+
+    def is_ready(self):
+        return self._consuming
+
+    def on_consumer_cancelled(self, consumer, method_frame):
         """Invoked by pika when RabbitMQ sends a Basic.Cancel for a consumer
-        receiving messages.
+        receiving messages. The channel is closed, then the consumer is
+        restarted.
 
+        :param ConsumerChannel consumer: The cancelled consumer
         :param pika.frame.Method method_frame: The Basic.Cancel frame
 
         """
-        logger.info('Consumer was cancelled remotely, shutting down: %r',
-                    method_frame)
-        if self._channel:
-            self._channel.close()
+        logger.info('Consumer of %r was cancelled remotely: %r',
+                    consumer.queue, method_frame)
+        if consumer.is_open:
+            consumer.channel.close()
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
-        Basic.Cancel RPC command.
+        Basic.Cancel RPC command for each consumer.
 
         """
         self.profile.state = 'disconnected'
         if self.withautocommit:
             self.registry.commit()
 
-        if self._channel:
-            logger.info('Sending a Basic.Cancel RPC command to RabbitMQ')
-            for consumer_tag in self._consumer_tags:
-                cb = functools.partial(self.on_cancelok, userdata=consumer_tag)
-                self._channel.basic_cancel(consumer_tag, cb)
+        if self._group_commit_size:
+            # commit in the thread of the ioloop, before the cancel
+            self.ioloop.add_callback_threadsafe(self.commit_group)
+
+        logger.info('Sending a Basic.Cancel RPC command to RabbitMQ')
+        cancelled = False
+        for consumer in self._consumer_channels.values():
+            if consumer.consumer_tag and consumer.is_open:
+                cancelled = True
+                consumer.channel.basic_cancel(
+                    consumer.consumer_tag,
+                    functools.partial(self.on_cancelok, consumer))
 
-    def on_cancelok(self, _unused_frame, userdata):
+        if not cancelled:
+            self.close_channel()
+
+    def on_cancelok(self, consumer, _unused_frame):
         """This method is invoked by pika when RabbitMQ acknowledges the
-        cancellation of a consumer. At this point we will close the channel.
-        This will invoke the on_channel_closed method once the channel has been
-        closed, which will in-turn close the connection.
+        cancellation of a consumer. When all the consumers are cancelled, we
+        will close the channels. This will invoke the on_channel_closed
+        method once the channels have been closed, which will in-turn close
+        the connection.
 
+        :param ConsumerChannel consumer: The cancelled consumer
         :param pika.frame.Method _unused_frame: The Basic.CancelOk frame
-        :param str|unicode userdata: Extra user data (consumer tag)
 
         """
-        self._consuming = False
         logger.info(
             'RabbitMQ acknowledged the cancellation of the consumer: %s',
-            userdata)
-        self._consumer_tags.remove(_unused_frame.method.consumer_tag)
-        if not len(self._consumer_tags):
+            consumer.consumer_tag)
+        consumer.consumer_tag = None
+        if not any(consumer.consumer_tag and consumer.is_open
+                   for consumer in self._consumer_channels.values()):
+            self._consuming = False
             self.close_channel()
 
     def close_channel(self):
-        """Call to close the channel with RabbitMQ cleanly by issuing the
+        """Call to close the channels with RabbitMQ cleanly by issuing the
         Channel.Close RPC command.
 
+        The channels are closed once their running messages (consumed by
+        the executor, waiting the confirm of their retry) are settled, the
+        ioloop is not blocked meanwhile: the heartbeats and the acks are
+        sent.
         """
-        logger.info('Closing the channel')
-        self._channel.close()
+        self.flush_errors()
+        running = sum(len(consumer.running)
+                      for consumer in self._consumer_channels.values()
+                      if consumer.is_open)
+        if running:
+            logger.info('Waiting the %d running messages', running)
+            self.ioloop.call_later(0.05, self.close_channel)
+            return
+
+        self._close_channel()
+
+    def _close_channel(self):
+        self.flush_errors()
+        logger.info('Closing the channels')
+        opened = [consumer for consumer in self._consumer_channels.values()
+                  if consumer.is_open]
+        if not opened:
+            self.close_connection()
+
+        for consumer in opened:
+            consumer.channel.close()
 
     def start(self):
         """Run the example consumer by connecting to RabbitMQ and then
@@ -381,7 +1425,7 @@ class Worker:
 
         """
         self._connection = self.connect()
-        self._connection.ioloop.start()
+        self.ioloop.start()
 
     def stop(self):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
@@ -400,24 +1444,277 @@ class Worker:
             if self._consuming:
                 self.stop_consuming()
                 try:
-                    self._connection.ioloop.start()
+                    self.ioloop.start()
                 except RuntimeError:
-                    self._connection.ioloop.stop()
-            else:
-                self._connection.ioloop.stop()
-
+                    # the ioloop runs in another thread, it is stopped by
+                    # the close of the connection once the running
+                    # messages are settled
+                    if self._connection is None or (
+                        self._connection.is_closed
+                    ):
+                        self.ioloop.stop()
+            elif self._connection is not None:
+                self.ioloop.stop()
+
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+
+            self._watchdog.stop()
             logger.info('Stopped')
 
 
+class AsyncioIOLoop:
+    """Api of the pika ioloop used by the worker, on an asyncio event loop
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def start(self):
+        if self.loop.is_running():
+            raise RuntimeError('The event loop is already running')
+
+        self.loop.run_forever()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def call_later(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+    def remove_timeout(self, handle):
+        handle.cancel()
+
+    def add_callback_threadsafe(self, callback):
+        self.loop.call_soon_threadsafe(callback)
+
+
+class SharedSessionException(Exception):
+    """An async consumer awaited with changes in the session shared by the
+    coroutines of the worker"""
+
+
+class SessionGuard:
+    """Await the coroutine of an async consumer, step by step, and fail it
+    if it awaits with changes in the session of the registry
+
+    The session is shared by the coroutines of the ``AsyncioWorker``, the
+    changes left by a coroutine before an await would be committed or
+    rolled back by the other coroutines. The pending changes and the
+    objects flushed during a step of the coroutine are checked when it
+    awaits, the changes already in the session before the step are
+    ignored.
+
+    :param registry: the registry of the worker
+    :param coroutine: the coroutine of the consumer
+    """
+
+    def __init__(self, registry, coroutine):
+        self.registry = registry
+        self.coroutine = coroutine
+        self.flushed = set()
+
+    def on_flush(self, session, flush_context):
+        self.flushed.update(self.get_changes(session))
+
+    @staticmethod
+    def get_changes(session):
+        return {id(obj) for changes in (session.new, session.dirty,
+                                        session.deleted)
+                for obj in changes}
+
+    def step(self, session, send, value):
+        """Run the coroutine up to its next await
+
+        :rtype: the future awaited by the coroutine
+        :exception: SharedSessionException
+        :exception: StopIteration at the return of the coroutine
+        """
+        before = self.get_changes(session)
+        self.flushed = set()
+        event.listen(session, 'after_flush', self.on_flush)
+        try:
+            future = send(value)
+        finally:
+            event.remove(session, 'after_flush', self.on_flush)
+
+        if (self.get_changes(session) | self.flushed) - before:
+            self.coroutine.close()
+            raise SharedSessionException(
+                'The consumer awaits with changes in the session shared by '
+                'the coroutines, the database must be written after the '
+                'last await')
+
+        return future
+
+    def __await__(self):
+        session = self.registry.session
+        iterator = self.coroutine.__await__()
+        send, value = iterator.send, None
+        while True:
+            try:
+                future = self.step(session, send, value)
+            except StopIteration as stop:
+                return stop.value
+
+            try:
+                value = yield future
+                send = iterator.send
+            except BaseException as error:
+                # cancelled by the timeout, raised in the coroutine
+                send, value = iterator.throw, error
+
+
+class AsyncioWorker(Worker):
+    """Worker on an asyncio event loop
+
+    The consumers declared with ``async def`` are awaited concurrently, at
+    most ``concurrency`` messages by consumer, the other consumers are
+    called as by the ``Worker``::
+
+        @bus_consumer(queue_name='queue', concurrency=100)
+        async def my_consumer(cls, body):
+            response = await call_partner_api(body)
+            cls.insert(...)  # the database after the last await
+            return MessageStatus.ACK
+
+    The coroutines share the session of the registry: a consumer must not
+    await once it has written in the database, the message is committed
+    just after the return of the coroutine, before the next await of the
+    event loop. The ``SessionGuard`` fails the message of a consumer which
+    awaits with changes in the session.
+    """
+
+    async_consumers = True
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncioWorker, self).__init__(*args, **kwargs)
+        self._loop = asyncio.new_event_loop()
+        self._ioloop = AsyncioIOLoop(self._loop)
+
+    def reset(self):
+        super(AsyncioWorker, self).reset()
+        self._tasks = set()
+
+    @property
+    def ioloop(self):
+        return self._ioloop
+
+    def connect(self):
+        """Connect to RabbitMQ with the asyncio connection of pika
+
+        :rtype: pika.adapters.asyncio_connection.AsyncioConnection
+        """
+        url = self.get_url()
+        logger.info('Connecting to %s', url)
+        return get_asyncio_connection(
+            url,
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=self._loop)
+
+    def start(self):
+        asyncio.set_event_loop(self._loop)
+        super(AsyncioWorker, self).start()
+
+    def consume_async_message(self, consumer, basic_deliver, properties,
+                              body):
+        """Create the task which awaits the consumer"""
+        consumer.running.add(basic_deliver.delivery_tag)
+        task = self._loop.create_task(self.await_consumer(
+            consumer, basic_deliver, properties, body))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def guard_session(self, coroutine):
+        return await SessionGuard(self.registry, coroutine)
+
+    async def await_consumer(self, consumer, basic_deliver, properties,
+                             body):
+        error = ""
+        started = time.perf_counter()
+        try:
+            self.check_duplicate(consumer, properties)
+            coroutine = self.guard_session(consumer.handler(
+                body=consumer.decode(body, properties.content_type,
+                                     properties.content_encoding)))
+            if consumer.description.timeout is not None:
+                coroutine = asyncio.wait_for(
+                    coroutine, consumer.description.timeout)
+
+            status = await coroutine
+            self.record_consumed(consumer, properties, status)
+        except DuplicateMessage:
+            logger.info('Message %r of the queue %r already consumed',
+                        properties.message_id, consumer.queue)
+            self.registry.rollback()
+            status = MessageStatus.ACK
+        except asyncio.TimeoutError:
+            logger.error('The consumer of the queue %r overran its timeout '
+                         'of %r seconds, it is cancelled', consumer.queue,
+                         consumer.description.timeout)
+            self.registry.rollback()
+            status = MessageStatus.ERROR
+            error = 'Timeout of %r seconds' % consumer.description.timeout
+        except Exception as e:
+            logger.exception('Error during consumation of queue %r' %
+                             consumer.queue)
+            self.registry.rollback()
+            status = MessageStatus.ERROR
+            error = str(e)
+
+        try:
+            self.finish_message(consumer, basic_deliver, properties, body,
+                                status, error, started)
+        except Exception:
+            logger.exception('Error at the end of the consumation of queue '
+                             '%r, the message is requeued', consumer.queue)
+            self.registry.rollback()
+            self.settle_consumed(
+                consumer, [(basic_deliver.delivery_tag, MessageStatus.NACK)],
+                0)
+
+    def close_channel(self):
+        """Close the channels once the running coroutines are finished"""
+        if not self._tasks:
+            return super(AsyncioWorker, self).close_channel()
+
+        logger.info('Waiting the %d running async consumers',
+                    len(self._tasks))
+        asyncio.gather(*self._tasks).add_done_callback(
+            lambda future: super(AsyncioWorker, self).close_channel())
+
+
+def get_worker_class(registry, profile, consumers, *args, **kwargs):
+    """Return the AsyncioWorker if one of the consumers is declared with
+    async def, else the Worker"""
+    for queue, model, method in consumers:
+        if getattr(registry.get(model), method).consumer.is_async:
+            return AsyncioWorker
+
+    return Worker
+
+
 class ReconnectingWorker:
+    """Start the worker again when the connection is lost
+
+    The delay before the reconnection is drawn at random between 0 and an
+    exponential backoff, from ``bus_reconnect_delay`` up to
+    ``bus_reconnect_max_delay`` seconds, so the processes disconnected by
+    the restart of rabbitmq do not reconnect at the same time. The worker
+    is reused, the profile and the consumers are not resolved again.
+    """
 
     def __init__(self, *args):
         self.args = args
-        self._reconnect_delay = 0
-        self._consumer = Worker(*args)
+        self._attempts = 0
+        self._stopping = threading.Event()
+        self.worker_class = get_worker_class(*args)
+        self._consumer = self.worker_class(*args)
 
     def start(self):
-        while True:
+        while not self._stopping.is_set():
             try:
                 logger.debug('Start to consume for %r', self.args)
                 self._consumer.start()
@@ -427,22 +1724,26 @@ class ReconnectingWorker:
 
             self._maybe_reconnect()
 
+    def stop(self):
+        """Stop the worker and the reconnections"""
+        self._stopping.set()
+        self._consumer.stop()
+
     def _maybe_reconnect(self):
         logger.debug('Check if the consumer must be restarted %r', self.args)
         if self._consumer.should_reconnect:
             self._consumer.stop()
             reconnect_delay = self._get_reconnect_delay()
-            logger.info('Reconnecting after %d seconds', reconnect_delay)
-            time.sleep(reconnect_delay)
-            self._consumer = Worker(*self.args)
+            logger.info('Reconnecting after %.3f seconds', reconnect_delay)
+            if not self._stopping.wait(reconnect_delay):
+                self._consumer.reset()
 
     def _get_reconnect_delay(self):
         if self._consumer.was_consuming:
-            self._reconnect_delay = 0
-        else:
-            self._reconnect_delay += 1
-
-        if self._reconnect_delay > 30:
-            self._reconnect_delay = 30
+            self._attempts = 0
 
-        return self._reconnect_delay
+        backoff = Configuration.get('bus_reconnect_delay', 1) * 2 ** min(
+            self._attempts, 32)
+        self._attempts += 1
+        return random.uniform(0, min(
+            backoff, Configuration.get('bus_reconnect_max_delay', 30)))
@@ -51,6 +51,8 @@ setup(
     entry_points={
         'console_scripts': [
             'anyblok_bus=anyblok_bus.scripts:anyblok_bus',
+            'anyblok_bus_relay=anyblok_bus.scripts:anyblok_bus_relay',
+            'anyblok_bus_replay=anyblok_bus.scripts:anyblok_bus_replay',
         ],
         'bloks': [
             'bus=anyblok_bus.bloks.bus:Bus',